@@ -1,20 +1,33 @@
 from flask import Flask, request, jsonify, session, send_file
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from flask_session import Session # Import the Session extension
 import sqlite3
 import bcrypt
 import os
+import io
 import uuid
 import time
 import json
 import zipfile
 import hashlib # For Anki checksum
+import marshal
 import shutil # For file operations (copying)
-import tempfile # For creating temporary directories
+import tempfile # For the export copy where sqlite3 cannot serialize
 import logging # Import logging module
 import traceback # Keep for explicit exception logging if needed
 import datetime # Import datetime
+import threading
+import atexit
+import queue
 from functools import wraps
+from contextlib import contextmanager
+from collections import OrderedDict
+try:
+    import orjson # Optional fast JSON backend for the col config blobs
+except ImportError:
+    orjson = None
+from scheduler import schedule, schedule_conf_for
 
 # Add near the top of server/app.py
 from dotenv import load_dotenv
@@ -41,24 +54,253 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 
 # --- Configuration ---
 FLASHCARD_DB_PATH = 'flashcards.db' # We will create user-specific DBs later, this is a placeholder
-EXPORT_DIR = os.path.join(basedir, 'exports') # Path relative to app.py
+EXPORT_CHUNK_SIZE = 1 << 20 # Bytes of the collection compressed per streamed APKG chunk
+EXPORT_COMPRESS_LEVEL = 1 # zlib level for the collection: SQLite pages still shrink several-fold at the fastest level
+USER_DB_DIR = os.path.join(basedir, 'user_dbs') # Per-user flashcard databases, relative to app.py
 DAILY_NEW_LIMIT = 20 # Maximum number of new cards to introduce per day per user
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', '12')) # bcrypt cost (log2 rounds) for new password hashes
+FIELD_SEP = '\x1f' # Anki separator between note fields
+COL_MOD_FLUSH_DELAY = 1.0 # Seconds a col.mod bump may wait before being written
+REVLOG_FLUSH_SIZE = 16 # Buffered review log rows per user that trigger an immediate flush
+REVLOG_FLUSH_DELAY = 2.0 # Seconds a buffered review log row may wait before being written
+READ_MMAP_SIZE = 256 * 1024 * 1024 # Bytes of a user DB a pooled connection may memory-map (reads skip the copy)
+USER_DB_POOL_SIZE = 4 # Idle pooled connections kept per user (per process)
+USER_DB_POOL_MAX_USERS = 64 # Users whose connections are pooled; least recently used are evicted
+USER_DB_CACHE_SIZE = -8000 # Page cache per pooled connection (negative = KiB)
+USER_DB_CACHED_STATEMENTS = 256 # Prepared statements kept per pooled connection
+DECK_DELETE_CHUNK_SIZE = 400 # Deck ids per DELETE (bound twice, under SQLite's old 999-variable limit)
+SERVER_PRIVATE_TABLES = ('decks_index', 'decks_bin') # Server-side tables that are not part of the Anki schema (dropped on export)
+SERVER_PRIVATE_TRIGGERS = ('decks_index_card_insert', 'decks_index_card_delete', 'decks_index_card_move',
+                           'decks_index_card_write', 'decks_index_note_write',
+                           'decks_bin_decks_write', 'decks_bin_conf_write') # Likewise, on cards, notes and col
+SERVER_PRIVATE_INDEXES = ('ix_cards_deck_id',) # Likewise, indexes Anki itself does not create
+
+# --- JSON Helpers ---
+# The col table stores conf/models/decks/dconf as JSON text that is parsed and
+# re-serialized on most deck endpoints; use orjson for that when it is installed.
+if orjson is not None:
+    def json_loads(data):
+        return orjson.loads(data)
+
+    def json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+else:
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+def json_first_key(data):
+    """Returns the first key of a JSON object text without decoding the rest of it (None if empty)."""
+    start = data.find('"')
+    if start < 0:
+        return None
+    return json.decoder.scanstring(data, start + 1)[0]
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider (jsonify, request.get_json) backed by orjson.
+
+    Keeps Flask's sort_keys setting; types orjson cannot encode natively
+    (Decimal, ...) go through DefaultJSONProvider.default as before.
+    """
+
+    def _option(self, sort_keys, indent):
+        option = orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent is not None:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs):
+        option = self._option(kwargs.get('sort_keys', self.sort_keys), kwargs.get('indent'))
+        return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        """jsonify(): hands orjson's bytes straight to the response, skipping
+        the str round trip of DefaultJSONProvider.response."""
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = 2 if (self.compact is None and self._app.debug) or self.compact is False else None
+        option = self._option(self.sort_keys, indent) | orjson.OPT_APPEND_NEWLINE
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=option), mimetype=self.mimetype
+        )
+
+# --- SQL Statements ---
+def _sqlite_has_json():
+    """Checks whether the linked SQLite has the JSON functions (built in since 3.38)."""
+    conn = sqlite3.connect(':memory:')
+    try:
+        conn.execute("SELECT json_extract('{}', '$')")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
+
+SQLITE_HAS_JSON = _sqlite_has_json()
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0) # INSERT/UPDATE/DELETE ... RETURNING
+SQLITE_HAS_AGGREGATE_FILTER = sqlite3.sqlite_version_info >= (3, 30, 0) # aggregate(...) FILTER (WHERE ...)
+SQLITE_HAS_SERIALIZE = hasattr(sqlite3.Connection, 'serialize') # Python 3.11+ (the Docker image runs 3.10)
+
+# Statements run on the write paths, kept as constants so every call hands
+# sqlite3 the same text and hits its per-connection statement cache.
+SQL_UPDATE_CARD_SCHEDULE = """
+    UPDATE cards
+    SET type=?, queue=?, due=?, ivl=?, factor=?, reps=?, lapses=?, left=?, mod=?
+    WHERE id=?
+"""
+# Row ids come from assign_revlog_ids(), so a colliding id is a bug and fails loudly
+SQL_INSERT_REVLOG = """
+    INSERT INTO revlog (id, cid, usn, ease, ivl, lastIvl, factor, time, type)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+# New notes/cards: the columns that are constant for a fresh local add (usn = -1,
+# new-card state, default ease) are literals, so only the varying ones are bound.
+SQL_INSERT_NEW_NOTE = """
+    INSERT INTO notes (id, guid, mid, mod, usn, tags, flds, sfld, csum, flags, data)
+    VALUES (?, ?, ?, ?, -1, ?, ?, ?, ?, 0, '')
+"""
+SQL_INSERT_NEW_CARD = """
+    INSERT INTO cards (id, nid, did, ord, mod, usn, type, queue, due, ivl, factor, reps, lapses, left, odue, odid, flags, data)
+    VALUES (?, ?, ?, 0, ?, -1, 0, 0, ?, 0, 2500, 0, 0, 0, 0, 0, 0, '')
+"""
+# First note model id (same as next(iter(models))), current deck id and its name,
+# read straight out of the col JSON columns by SQLite's JSON functions.
+SQL_SELECT_ADD_CARD_CONTEXT = """
+    SELECT models != '' AND conf != '' AS has_config,
+           (SELECT key FROM json_each(col.models) LIMIT 1) AS model_id,
+           IFNULL(json_extract(conf, '$.curDeck'), 1) AS cur_deck,
+           IFNULL(json_extract(decks, '$."' || IFNULL(json_extract(conf, '$.curDeck'), 1) || '".name'), 'Unknown') AS deck_name
+    FROM col LIMIT 1
+"""
+SQL_INSERT_DECK_INDEX = "INSERT INTO decks_index (id, name, name_key) VALUES (?, ?, ?)"
+SQL_RENAME_DECK_INDEX = "UPDATE decks_index SET name = ?, name_key = ?, version = version + 1 WHERE id = ?"
+SQL_UPDATE_NOTE_FIELDS = "UPDATE notes SET flds = ?, sfld = ?, csum = ?, mod = ? WHERE id = ?"
+SQL_TOUCH_CARD = "UPDATE cards SET mod = ? WHERE id = ?"
+# Card reads of answer_card, get_card and update_card
+SQL_SELECT_CARD_SCHEDULE = "SELECT type, queue, due, ivl, factor, reps, lapses, left, did FROM cards WHERE id = ?"
+# Same columns for several cards at once (/answer_batch); {} is the placeholder list
+SQL_SELECT_CARDS_SCHEDULE = "SELECT id, type, queue, due, ivl, factor, reps, lapses, left, did FROM cards WHERE id IN ({})"
+SQL_SELECT_CARD_FIELDS = "SELECT n.flds, c.id FROM cards c JOIN notes n ON c.nid = n.id WHERE c.id = ?"
+SQL_SELECT_CARD_NOTE = "SELECT n.id, n.flds FROM cards c JOIN notes n ON n.id = c.nid WHERE c.id = ?"
+SQL_SELECT_NOTE_FIELDS = "SELECT flds FROM notes WHERE id = ?"
+# Notes of several cards at once (bulk update); {} is the placeholder list
+SQL_SELECT_CARDS_NOTES = "SELECT c.id, n.id, n.flds FROM cards c JOIN notes n ON n.id = c.nid WHERE c.id IN ({})"
+# Card listing of a deck, newest first: by page (OFFSET) or after a card id (keyset).
+# SQLite cuts the first two fields out of flds (char(31) is FIELD_SEP), so notes
+# with long extra fields or media markup are not copied into Python; front is
+# NULL for a note without a separator.
+_SQL_FLDS_SEP = "instr(n.flds, char(31))"
+_SQL_FLDS_REST = f"substr(n.flds, {_SQL_FLDS_SEP} + 1)"
+_SQL_SELECT_DECK_CARDS = f"""
+    SELECT c.id, n.id AS note_id,
+           CASE WHEN {_SQL_FLDS_SEP} > 0 THEN substr(n.flds, 1, {_SQL_FLDS_SEP} - 1) END AS front,
+           substr({_SQL_FLDS_REST}, 1, CASE WHEN instr({_SQL_FLDS_REST}, char(31)) > 0
+                                            THEN instr({_SQL_FLDS_REST}, char(31)) - 1
+                                            ELSE length(n.flds) END) AS back,
+           c.mod
+    FROM cards c
+    JOIN notes n ON c.nid = n.id
+"""
+SQL_SELECT_DECK_CARDS_PAGE = _SQL_SELECT_DECK_CARDS + """
+    WHERE c.did = ?
+    ORDER BY c.id DESC
+    LIMIT ? OFFSET ?
+"""
+SQL_SELECT_DECK_CARDS_AFTER = _SQL_SELECT_DECK_CARDS + """
+    WHERE c.did = ? AND c.id < ?
+    ORDER BY c.id DESC
+    LIMIT ?
+"""
+# The same page as one JSON array built by SQLite (rows are aggregated in the
+# subquery's order), with the row count and last card id for the cursor
+SQL_DECK_CARDS_JSON = """
+    SELECT json_group_array(json_object('cardId', id, 'noteId', note_id, 'front', front,
+                                        'back', back, 'modified', mod)) FILTER (WHERE front IS NOT NULL),
+           COUNT(*), MIN(id)
+    FROM ({})
+"""
+SQL_SELECT_DECK_CARDS_PAGE_JSON = SQL_DECK_CARDS_JSON.format(SQL_SELECT_DECK_CARDS_PAGE)
+SQL_SELECT_DECK_CARDS_AFTER_JSON = SQL_DECK_CARDS_JSON.format(SQL_SELECT_DECK_CARDS_AFTER)
+# Deck stats: one row per queue (mature = review cards with ivl >= 21 days). The
+# per-queue counts are read from the covering ix_cards_sched alone; only the
+# review cards are looked up in the table, for their ivl.
+SQL_COUNT_DECK_CARDS_BY_QUEUE = """
+    SELECT queue, COUNT(*),
+           CASE WHEN queue = 2 THEN (SELECT COUNT(*) FROM cards WHERE did = ?1 AND queue = 2 AND ivl >= 21) END
+    FROM cards WHERE did = ?1 GROUP BY queue
+"""
+# Review queues (get_next_card). The due card is chosen in a subquery that reads
+# only ix_cards_sched (did, queue, due, plus the implicit rowid = card id), so
+# candidates are filtered and ordered without touching the cards or notes
+# tables; the one chosen card is then joined to its note. All queries return
+# the same columns so the handler can treat their rows alike.
+# Learning spans two queues: `queue IN (1, 3) ORDER BY due` would merge both
+# index ranges in a temp B-tree, so each queue yields its own earliest card
+# straight off the index and only those (at most two) rows are compared.
+SQL_SELECT_DUE_LEARNING_CARD = """
+    SELECT c.id, c.nid, c.queue, n.flds, c.due, c.ivl
+    FROM cards c JOIN notes n ON c.nid = n.id
+    WHERE c.id = (
+        SELECT id FROM (
+            SELECT * FROM (SELECT id, due FROM cards WHERE did = ?1 AND queue = 1 AND due <= ?2 ORDER BY due LIMIT 1)
+            UNION ALL
+            SELECT * FROM (SELECT id, due FROM cards WHERE did = ?1 AND queue = 3 AND due <= ?2 ORDER BY due LIMIT 1)
+        ) ORDER BY due LIMIT 1
+    )
+"""
+SQL_SELECT_DUE_REVIEW_CARD = """
+    SELECT c.id, c.nid, c.queue, n.flds, c.due, c.ivl
+    FROM cards c JOIN notes n ON c.nid = n.id
+    WHERE c.id = (
+        SELECT id FROM cards WHERE did = ? AND queue = 2 AND due <= ? ORDER BY due LIMIT 1
+    )
+"""
+# A uniformly random new card: a random offset into the deck's new cards, both the
+# count and the skip walking the covering ix_cards_sched entries, then a single
+# join. ORDER BY RANDOM() would join and sort every new card's note to keep one.
+SQL_SELECT_RANDOM_NEW_CARD = """
+    SELECT c.id, c.nid, c.queue, n.flds, c.due, c.ivl
+    FROM cards c JOIN notes n ON c.nid = n.id
+    WHERE c.id = (
+        SELECT id FROM cards WHERE did = ?1 AND queue = 0
+        LIMIT 1 OFFSET (SELECT abs(random()) % max(COUNT(*), 1) FROM cards WHERE did = ?1 AND queue = 0)
+    )
+"""
+# (any active card in the deck, any new card in the deck): single index probes
+SQL_SELECT_DECK_HAS_CARDS = """
+    SELECT EXISTS (SELECT 1 FROM cards WHERE did = ?1 AND queue BETWEEN 0 AND 3),
+           EXISTS (SELECT 1 FROM cards WHERE did = ?1 AND queue = 0)
+"""
 
 # --- App Initialization ---
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 CORS(app, supports_credentials=True, origins=["http://localhost:5173", "https://cibernetica.inmetro.gov.br"]) # Allow cross-origin requests, necessary for React dev server
 
 
 # --- Configure Flask-Session ---
 # Choose a directory for session files (must be writable by the Gunicorn user)
-# Ensure this directory exists or is created
 SESSION_FILE_DIR = os.path.join(basedir, 'flask_session') 
-if not os.path.exists(SESSION_FILE_DIR):
-    os.makedirs(SESSION_FILE_DIR) # Create the directory if it doesn't exist
 
-app.config['SESSION_TYPE'] = 'filesystem' # Use filesystem-based sessions
-app.config['SESSION_FILE_DIR'] = SESSION_FILE_DIR
+# SESSION_REDIS_URL (e.g. redis://localhost:6379/0) moves the sessions to Redis,
+# shared by all gunicorn workers without a file read/write per request; the
+# redis package is only needed when it is set.
+SESSION_REDIS_URL = os.getenv('SESSION_REDIS_URL')
+if SESSION_REDIS_URL:
+    import redis
+    app.config['SESSION_TYPE'] = 'redis'
+    app.config['SESSION_REDIS'] = redis.Redis.from_url(SESSION_REDIS_URL)
+else:
+    # Ensure this directory exists or is created
+    if not os.path.exists(SESSION_FILE_DIR):
+        os.makedirs(SESSION_FILE_DIR) # Create the directory if it doesn't exist
+    app.config['SESSION_TYPE'] = 'filesystem' # Use filesystem-based sessions
+    app.config['SESSION_FILE_DIR'] = SESSION_FILE_DIR
 app.config['SESSION_PERMANENT'] = False # Or True with SESSION_LIFETIME if needed
 app.config['SESSION_USE_SIGNER'] = True # Sign the session ID cookie
 app.config['SESSION_COOKIE_SECURE'] = False # Set to True only when using HTTPS
@@ -76,21 +318,37 @@ server_session = Session(app)
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s %(name)s %(threadName)s : %(message)s')
 # You can customize the format further if needed
-app.logger.info(f"Base directory detected: {basedir}")
+app.logger.info("Base directory detected: %s", basedir)
 
 # --- Helper Functions ---
+# Ensure the base directory exists once, at import (exist_ok: no race between
+# workers), so get_user_db_path is a plain string join
+os.makedirs(USER_DB_DIR, exist_ok=True)
+
 def get_user_db_path(user_id):
     """Returns the path to the user's specific flashcard database."""
-    # Ensure the base directory exists, relative to app.py
-    db_dir = os.path.join(basedir, 'user_dbs') # Path relative to app.py
-    if not os.path.exists(db_dir):
-        os.makedirs(db_dir)
-        app.logger.info(f"Created user DB directory: {db_dir}") # Use logger
-    return os.path.join(db_dir, f'user_{user_id}.db')
+    return os.path.join(USER_DB_DIR, f'user_{user_id}.db')
+
+def clock_ms():
+    """Wall clock in integer milliseconds (no float rounding).
+
+    Write handlers read it once and derive every id/mod value from that reading;
+    tests can patch this one function to control time.
+    """
+    return time.time_ns() // 1_000_000
 
 def sha1_checksum(data):
     """Calculates the SHA1 checksum for Anki note syncing."""
-    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+    return hashlib.sha1(data.encode('utf-8'), usedforsecurity=False).hexdigest()
+
+def field_checksum(data):
+    """32-bit notes.csum value for a note's first field.
+
+    Same value as int(sha1_checksum(data), 16) & 0xFFFFFFFF, taken from the raw
+    digest without the hex round trip. Not a security use of SHA1 (allowed on
+    FIPS builds of OpenSSL).
+    """
+    return int.from_bytes(hashlib.sha1(data.encode('utf-8'), usedforsecurity=False).digest()[-4:], 'big')
 
 def get_card_state(card_type, queue, interval):
     """
@@ -119,6 +377,492 @@ def get_card_state(card_type, queue, interval):
         return "Young" if interval < 21 else "Mature"
     return "Unknown"
 
+# --- User DB Connection Pool ---
+# Opening a user DB costs a file open, a schema parse and a cold page cache, so
+# each process keeps up to USER_DB_POOL_SIZE idle connections per user (for the
+# USER_DB_POOL_MAX_USERS most recently used users) and lends them out through
+# get_user_db_conn(). Because a pooled connection outlives the request, the
+# statements sqlite3 prepares on it (cached by SQL text) are reused by later
+# requests instead of being parsed again. Pooled connections run in autocommit mode
+# (isolation_level=None): write handlers open their transaction explicitly with
+# BEGIN / BEGIN IMMEDIATE and finish it with commit(). Handlers need no
+# os.path.exists() check first: a missing file raises UserDbNotFoundError.
+_user_db_pools = OrderedDict() # user_id -> LifoQueue of idle connections, least recently used first
+_user_db_pools_lock = threading.Lock()
+
+class UserDbNotFoundError(LookupError):
+    """Raised by get_user_db_conn() when the user's flashcard database file does not exist."""
+
+def _open_user_db_conn(user_id):
+    """Opens a connection for the pool (mode=rw: never creates a missing database file)."""
+    db_path = get_user_db_path(user_id)
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=rw", uri=True,
+                               check_same_thread=False, isolation_level=None,
+                               cached_statements=USER_DB_CACHED_STATEMENTS)
+    except sqlite3.OperationalError:
+        # Only a failed open pays for the stat() that tells a missing file apart
+        if not os.path.exists(db_path):
+            raise UserDbNotFoundError(f"User database not found for user {user_id}") from None
+        raise
+    # WAL: readers no longer block the writer and commits append to the log instead
+    # of rewriting pages; synchronous=NORMAL then only syncs at checkpoints
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute(f"PRAGMA cache_size = {USER_DB_CACHE_SIZE}")
+    conn.execute(f"PRAGMA mmap_size = {READ_MMAP_SIZE}")
+    ensure_card_indexes(conn)
+    ensure_decks_index(conn) # One-time migration for collections created before decks_index
+    return conn
+
+def _close_user_db_conn(conn):
+    """Closes a pooled connection, first letting PRAGMA optimize refresh the
+    planner statistics (sqlite_stat1) of the tables its queries used."""
+    try:
+        conn.execute("PRAGMA busy_timeout = 0") # Skip it rather than wait on a writer
+        conn.execute("PRAGMA optimize")
+    except sqlite3.Error:
+        pass # Best effort (e.g. the file is gone or locked); closing still matters
+    conn.close()
+
+def _close_idle_conns(pool):
+    """Closes every idle connection left in a pool."""
+    while True:
+        try:
+            _close_user_db_conn(pool.get_nowait())
+        except queue.Empty:
+            return
+
+@contextmanager
+def get_user_db_conn(user_id):
+    """Lends a pooled connection to the user's flashcard database for a with block.
+
+    A transaction still open when the block exits (early return or exception)
+    is rolled back before the connection goes back to the pool.
+    """
+    with _user_db_pools_lock:
+        pool = _user_db_pools.get(user_id)
+        if pool is None:
+            pool = _user_db_pools[user_id] = queue.LifoQueue(maxsize=USER_DB_POOL_SIZE)
+        _user_db_pools.move_to_end(user_id)
+        evicted = []
+        while len(_user_db_pools) > USER_DB_POOL_MAX_USERS:
+            evicted.append(_user_db_pools.popitem(last=False)[1])
+    for evicted_pool in evicted:
+        _close_idle_conns(evicted_pool)
+
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _open_user_db_conn(user_id)
+    conn.row_factory = None # Handlers pick their own row factory
+
+    reusable = True
+    try:
+        yield conn
+    finally:
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            reusable = False
+        with _user_db_pools_lock:
+            # The pool may have been dropped meanwhile (e.g. the user DB was recreated)
+            reusable = reusable and _user_db_pools.get(user_id) is pool
+        if reusable:
+            try:
+                pool.put_nowait(conn)
+            except queue.Full:
+                reusable = False
+        if not reusable:
+            _close_user_db_conn(conn)
+
+def close_user_db_pool(user_id=None):
+    """Closes the idle pooled connections of one user, or of everyone when user_id is None."""
+    with _user_db_pools_lock:
+        if user_id is None:
+            pools = list(_user_db_pools.values())
+            _user_db_pools.clear()
+        else:
+            pool = _user_db_pools.pop(user_id, None)
+            pools = [pool] if pool else []
+    for pool in pools:
+        _close_idle_conns(pool)
+
+# --- Deck Cache ---
+# Parsed col.decks per user, keyed by decks_bin.decks_mod. col.mod cannot be the
+# key: card writes move it too (see bump_col_mod). decks_mod is bumped by a
+# trigger on every write of col.decks, whoever makes it, so an unchanged
+# decks_mod (in any process) means an unchanged decks blob and the cached dict
+# can be reused without json_loads.
+#
+# The same trigger clears decks_bin.data, and save_decks() then stores a marshal
+# copy of the dict there. On a cache miss (another worker wrote the decks) that
+# copy is decoded instead of the JSON text; after any other writer of col.decks
+# it is NULL and the JSON is read as before.
+_decks_cache = {} # user_id -> (decks_mod, decks dict, sorted deck list or None)
+_decks_cache_lock = threading.Lock()
+
+SQL_SELECT_DECKS_SNAPSHOT = """
+    SELECT decks_bin.decks_mod, decks_bin.data, CASE WHEN decks_bin.data IS NULL THEN col.decks END
+    FROM col LEFT JOIN decks_bin ON decks_bin.id = 0
+    LIMIT 1
+"""
+
+def load_decks(conn, user_id):
+    """Returns the user's decks dict (deck id str -> deck), or None if col has no decks.
+
+    The dict is shared with the cache: treat it as read-only and copy before changing it.
+    """
+    row = conn.execute("SELECT decks_mod FROM decks_bin WHERE id = 0").fetchone()
+    with _decks_cache_lock:
+        cached = _decks_cache.get(user_id)
+    if row and cached and cached[0] == row[0]:
+        return cached[1]
+    row = conn.execute(SQL_SELECT_DECKS_SNAPSHOT).fetchone()
+    if not row:
+        return None
+    decks_mod, decks_bin, decks_json = row
+    decks_dict = None
+    if decks_bin is not None:
+        try:
+            decks_dict = marshal.loads(decks_bin)
+        except (ValueError, EOFError, TypeError):
+            # Written by a Python with another marshal format
+            decks_json = conn.execute("SELECT decks FROM col LIMIT 1").fetchone()[0]
+    if decks_dict is None:
+        if not decks_json:
+            return None
+        decks_dict = json_loads(decks_json)
+    if decks_mod is not None: # No version to check the entry against otherwise
+        with _decks_cache_lock:
+            _decks_cache[user_id] = (decks_mod, decks_dict, None)
+    return decks_dict
+
+def load_deck_list(conn, user_id):
+    """Returns the user's decks as [{"id", "name"}] sorted by name, or None if col has no decks.
+
+    Built once per cached decks dict (i.e. per decks_mod); the list is shared, treat it as read-only.
+    """
+    decks_dict = load_decks(conn, user_id)
+    if not decks_dict:
+        return None
+    with _decks_cache_lock:
+        cached = _decks_cache.get(user_id)
+    if cached and cached[1] is decks_dict and cached[2] is not None:
+        return cached[2]
+    decks_list = sorted(({"id": k, "name": v["name"]} for k, v in decks_dict.items()), key=lambda x: x["name"])
+    with _decks_cache_lock:
+        cached = _decks_cache.get(user_id)
+        # Only attach the list if the entry was not replaced meanwhile
+        if cached and cached[1] is decks_dict:
+            _decks_cache[user_id] = (cached[0], decks_dict, decks_list)
+    return decks_list
+
+def save_decks(conn, user_id, decks_dict, mod_time_ms):
+    """Writes col.decks (bumping col.mod past its current value) and caches decks_dict.
+
+    The write bumps decks_bin.decks_mod (trigger), and the marshal snapshot is stored
+    under it in the same transaction.
+    """
+    conn.execute("UPDATE col SET decks = ?, mod = MAX(mod + 1, ?)", (json_dumps(decks_dict), mod_time_ms))
+    params = (marshal.dumps(decks_dict),)
+    if SQLITE_HAS_RETURNING:
+        row = conn.execute("UPDATE decks_bin SET data = ? WHERE id = 0 RETURNING decks_mod", params).fetchone()
+    else:
+        conn.execute("UPDATE decks_bin SET data = ? WHERE id = 0", params)
+        row = conn.execute("SELECT decks_mod FROM decks_bin WHERE id = 0").fetchone()
+    # If the transaction is rolled back, decks_mod no longer matches and the entry is ignored
+    with _decks_cache_lock:
+        if row:
+            _decks_cache[user_id] = (row[0], decks_dict, None)
+        else:
+            _decks_cache.pop(user_id, None)
+
+# decks_index mirrors the id and name of every deck in col.decks so that deck
+# lookups and the case-insensitive name uniqueness check are index lookups, and
+# keeps each deck's card count and version (bumped whenever its card listing may
+# change: cards added, removed, moved or written, note fields edited, deck
+# renamed) up to date through triggers on cards and notes. It is
+# private to the server (dropped from exports); col.decks stays the source of
+# truth and both are written in the same transaction. decks_bin and its trigger
+# on col (see Deck Cache) are created and dropped along with it.
+DECKS_INDEX_SCHEMA = (
+    """
+    CREATE TABLE decks_index (
+        id              integer primary key, /* deck id (key in col.decks) */
+        name            text not null, /* deck name */
+        name_key        text not null unique, /* name.lower(), for case-insensitive uniqueness */
+        card_count      integer not null default 0, /* cards with this did, kept by the triggers below */
+        /* bumped by the triggers below and on rename; starts at the current time in ms so
+           that a deck re-created under the same id does not repeat an earlier version */
+        version         integer not null default (CAST((julianday('now') - 2440587.5) * 86400000 AS integer))
+    )
+    """,
+    """
+    CREATE TABLE decks_bin (
+        id              integer primary key check (id = 0), /* single row */
+        decks_mod       integer not null, /* bumped by every write of col.decks */
+        data            blob, /* marshal.dumps(decks dict) as of decks_mod, NULL if col.decks was written elsewhere */
+        conf_mod        integer not null /* bumped by every write of col.conf or col.dconf */
+    )
+    """,
+    """
+    CREATE TRIGGER decks_bin_decks_write AFTER UPDATE OF decks ON col BEGIN
+        UPDATE decks_bin SET decks_mod = decks_mod + 1, data = NULL WHERE id = 0;
+    END
+    """,
+    """
+    CREATE TRIGGER decks_bin_conf_write AFTER UPDATE OF conf, dconf ON col BEGIN
+        UPDATE decks_bin SET conf_mod = conf_mod + 1 WHERE id = 0;
+    END
+    """,
+    """
+    CREATE TRIGGER decks_index_card_insert AFTER INSERT ON cards BEGIN
+        UPDATE decks_index SET card_count = card_count + 1, version = version + 1 WHERE id = NEW.did;
+    END
+    """,
+    """
+    CREATE TRIGGER decks_index_card_delete AFTER DELETE ON cards BEGIN
+        UPDATE decks_index SET card_count = card_count - 1, version = version + 1 WHERE id = OLD.did;
+    END
+    """,
+    """
+    CREATE TRIGGER decks_index_card_move AFTER UPDATE OF did ON cards WHEN NEW.did != OLD.did BEGIN
+        UPDATE decks_index SET card_count = card_count - 1, version = version + 1 WHERE id = OLD.did;
+        UPDATE decks_index SET card_count = card_count + 1, version = version + 1 WHERE id = NEW.did;
+    END
+    """,
+    """
+    CREATE TRIGGER decks_index_card_write AFTER UPDATE OF mod ON cards BEGIN
+        UPDATE decks_index SET version = version + 1 WHERE id = NEW.did;
+    END
+    """,
+    """
+    CREATE TRIGGER decks_index_note_write AFTER UPDATE OF flds ON notes BEGIN
+        UPDATE decks_index SET version = version + 1 WHERE id IN (SELECT did FROM cards WHERE nid = NEW.id);
+    END
+    """,
+)
+
+# Card lookups by note (delete_card's orphan check) and by deck (deck deletes,
+# listings, scheduling) must be index probes. init_anki_db creates the first two,
+# as Anki does; collections from elsewhere get them when first pooled.
+# ix_cards_deck_id is server-private (see SERVER_PRIVATE_INDEXES): it walks a
+# deck's cards in id order, so a page of the card listing reads only its rows.
+CARD_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_cards_nid ON cards (nid)",
+    "CREATE INDEX IF NOT EXISTS ix_cards_sched ON cards (did, queue, due)",
+    "CREATE INDEX IF NOT EXISTS ix_cards_deck_id ON cards (did, id)",
+)
+
+def ensure_card_indexes(conn):
+    """Creates the card indexes this server relies on if they are missing (a no-op otherwise)."""
+    for statement in CARD_INDEXES:
+        conn.execute(statement)
+
+def ensure_decks_index(conn):
+    """Creates and fills decks_index (and its triggers) if this collection does not have them yet."""
+    names = SERVER_PRIVATE_TABLES + SERVER_PRIVATE_TRIGGERS
+    present = conn.execute(f"SELECT COUNT(*) FROM sqlite_master WHERE name IN ({','.join('?' * len(names))})",
+                           names).fetchone()[0]
+    if present == len(names):
+        return
+    own_transaction = not conn.in_transaction
+    if own_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Rebuild from scratch: an older decks_index may lack columns or triggers
+        for trigger in SERVER_PRIVATE_TRIGGERS:
+            conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        for table in SERVER_PRIVATE_TABLES:
+            conn.execute(f"DROP TABLE IF EXISTS {table}")
+        for statement in DECKS_INDEX_SCHEMA:
+            conn.execute(statement)
+        row = conn.execute("SELECT decks FROM col LIMIT 1").fetchone()
+        decks_dict = json_loads(row[0]) if row and row[0] else {}
+        conn.executemany(SQL_INSERT_DECK_INDEX,
+                         [(int(did), deck['name'], deck['name'].lower()) for did, deck in decks_dict.items()])
+        conn.execute("UPDATE decks_index SET card_count = (SELECT COUNT(*) FROM cards WHERE did = decks_index.id)")
+        # Start past any version a cache may hold for a previous file at this path
+        conn.execute("INSERT INTO decks_bin (id, decks_mod, conf_mod) SELECT 0, MAX(mod, ?1), MAX(mod, ?1) FROM col LIMIT 1",
+                     (clock_ms(),))
+        if own_transaction:
+            conn.commit()
+    except Exception:
+        if own_transaction:
+            conn.rollback()
+        raise
+
+def discard_decks(user_id):
+    """Forgets the cached decks (e.g. the user DB was recreated)."""
+    with _decks_cache_lock:
+        _decks_cache.pop(user_id, None)
+
+# --- Collection Config Cache ---
+# The review endpoints need col.crt, conf's curDeck and the deck options (dconf)
+# on every call. They are cached per user under decks_bin.conf_mod, which a
+# trigger bumps on every write of col.conf or col.dconf (col.mod moves with card
+# writes too, see bump_col_mod), so a matching conf_mod means the cached values
+# are current. crt is read along with conf_mod and checked too.
+_col_conf_cache = {} # user_id -> (conf_mod, crt, current deck id, dconf dict)
+_col_conf_cache_lock = threading.Lock()
+
+def _col_conf_entry(conn, user_id):
+    """Returns the cache entry (conf_mod, crt, current deck id, dconf dict), or None if col is empty."""
+    row = conn.execute("SELECT decks_bin.conf_mod, col.crt FROM col LEFT JOIN decks_bin ON decks_bin.id = 0 "
+                       "LIMIT 1").fetchone()
+    if not row:
+        return None
+    conf_mod, crt = row[0], row[1]
+    with _col_conf_cache_lock:
+        cached = _col_conf_cache.get(user_id)
+    if cached and conf_mod is not None and cached[0] == conf_mod and cached[1] == crt:
+        return cached
+    conf, dconf = conn.execute("SELECT conf, dconf FROM col LIMIT 1").fetchone()
+    entry = (conf_mod, crt, json_loads(conf).get('curDeck', 1), json_loads(dconf))
+    if conf_mod is not None: # No version to check the entry against otherwise
+        with _col_conf_cache_lock:
+            _col_conf_cache[user_id] = entry
+    return entry
+
+def load_col_conf(conn, user_id):
+    """Returns (crt, current deck id) for the user's collection, or None if col is empty."""
+    entry = _col_conf_entry(conn, user_id)
+    return entry[1:3] if entry else None
+
+def load_sched_conf(conn, user_id):
+    """Returns (crt, dconf dict) for scheduling answers, or None if col is empty.
+
+    The dict is shared with the cache: treat it as read-only.
+    """
+    entry = _col_conf_entry(conn, user_id)
+    return (entry[1], entry[3]) if entry else None
+
+def discard_col_conf(user_id):
+    """Forgets the cached config (call after writing col.conf, or when the user DB was recreated)."""
+    with _col_conf_cache_lock:
+        _col_conf_cache.pop(user_id, None)
+
+# --- Collection Mod Coalescing ---
+# Card writes only need col.mod to move forward eventually, so instead of an
+# extra UPDATE on the hot single-row col table per request, the latest value per
+# user is kept here and written by a timer (or on demand, e.g. before export).
+_pending_col_mod = {} # user_id -> latest mod time (ms) not yet written
+_pending_col_mod_lock = threading.Lock()
+_col_mod_timer = None
+
+def bump_col_mod(user_id, mod_time_ms):
+    """Schedules col.mod = mod_time_ms for the user's collection."""
+    global _col_mod_timer
+    with _pending_col_mod_lock:
+        if mod_time_ms > _pending_col_mod.get(user_id, 0):
+            _pending_col_mod[user_id] = mod_time_ms
+        if _col_mod_timer is None:
+            _col_mod_timer = threading.Timer(COL_MOD_FLUSH_DELAY, flush_col_mod)
+            _col_mod_timer.daemon = True
+            _col_mod_timer.start()
+
+def discard_col_mod(user_id):
+    """Drops a pending bump without writing it (e.g. the user DB was recreated)."""
+    with _pending_col_mod_lock:
+        _pending_col_mod.pop(user_id, None)
+
+def flush_col_mod(user_id=None):
+    """Writes pending col.mod bumps for one user, or for everyone when user_id is None."""
+    global _col_mod_timer
+    with _pending_col_mod_lock:
+        if user_id is None:
+            pending = list(_pending_col_mod.items())
+            _pending_col_mod.clear()
+            _col_mod_timer = None
+        else:
+            mod_time_ms = _pending_col_mod.pop(user_id, None)
+            pending = [(user_id, mod_time_ms)] if mod_time_ms else []
+
+    for pending_user_id, mod_time_ms in pending:
+        try:
+            # Pooled connection (autocommit): one short write, no open/PRAGMA cost per flush
+            with get_user_db_conn(pending_user_id) as conn:
+                conn.execute("UPDATE col SET mod = ? WHERE mod < ?", (mod_time_ms, mod_time_ms))
+        except (sqlite3.Error, UserDbNotFoundError) as e:
+            app.logger.error("Error flushing col.mod for user %s: %s", pending_user_id, e)
+
+atexit.register(flush_col_mod)
+
+# --- Review Log Batching ---
+# revlog rows are append-only history; the card UPDATE in answer_card stays
+# synchronous, while the log rows are buffered per user and written with one
+# executemany once REVLOG_FLUSH_SIZE rows pile up or REVLOG_FLUSH_DELAY passes.
+# Rows still buffered when the process dies are lost.
+_pending_revlog = {} # user_id -> list of revlog rows (id, cid, usn, ease, ivl, lastIvl, factor, time, type)
+_pending_revlog_lock = threading.Lock()
+_revlog_timer = None
+
+def queue_revlog(user_id, row):
+    """Buffers one revlog row for the user's collection."""
+    global _revlog_timer
+    with _pending_revlog_lock:
+        rows = _pending_revlog.setdefault(user_id, [])
+        rows.append(row)
+        flush_now = len(rows) >= REVLOG_FLUSH_SIZE
+        if not flush_now and _revlog_timer is None:
+            _revlog_timer = threading.Timer(REVLOG_FLUSH_DELAY, flush_revlog)
+            _revlog_timer.daemon = True
+            _revlog_timer.start()
+    if flush_now:
+        flush_revlog(user_id)
+
+def pending_revlog(user_id):
+    """Returns a copy of the revlog rows buffered for the user."""
+    with _pending_revlog_lock:
+        return list(_pending_revlog.get(user_id, ()))
+
+def discard_revlog(user_id):
+    """Drops buffered rows without writing them (e.g. the user DB was recreated)."""
+    with _pending_revlog_lock:
+        _pending_revlog.pop(user_id, None)
+
+def assign_revlog_ids(conn, rows):
+    """Returns rows with unique, increasing ids past MAX(revlog.id).
+
+    A row keeps its millisecond id unless an earlier row or an existing review
+    already took it. Call inside the write transaction that inserts the rows.
+    """
+    next_id = (conn.execute("SELECT MAX(id) FROM revlog").fetchone()[0] or 0) + 1
+    assigned = []
+    for row in rows:
+        row_id = max(row[0], next_id)
+        assigned.append((row_id,) + tuple(row[1:]))
+        next_id = row_id + 1
+    return assigned
+
+def flush_revlog(user_id=None):
+    """Writes buffered revlog rows for one user, or for everyone when user_id is None."""
+    global _revlog_timer
+    with _pending_revlog_lock:
+        if user_id is None:
+            pending = list(_pending_revlog.items())
+            _pending_revlog.clear()
+            _revlog_timer = None
+        else:
+            rows = _pending_revlog.pop(user_id, None)
+            pending = [(user_id, rows)] if rows else []
+
+    for pending_user_id, rows in pending:
+        try:
+            # Pooled connection; ids are allocated and the batch committed under one
+            # write lock (rolled back by the pool on error)
+            with get_user_db_conn(pending_user_id) as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany(SQL_INSERT_REVLOG, assign_revlog_ids(conn, rows))
+                conn.commit()
+        except (sqlite3.Error, UserDbNotFoundError) as e:
+            app.logger.error("Error flushing %s revlog rows for user %s: %s", len(rows), pending_user_id, e)
+
+atexit.register(flush_revlog)
+
 # --- Database Setup (Placeholders) ---
 # TODO: Implement functions to initialize admin and flashcard databases
 # TODO: Implement functions to get DB connections
@@ -126,6 +870,7 @@ def get_card_state(card_type, queue, interval):
 def init_admin_db():
     """Initializes the admin database and creates the users table if it doesn\'t exist."""
     conn = sqlite3.connect(ADMIN_DB_PATH)
+    conn.execute("PRAGMA journal_mode = WAL") # Persistent, like the user DBs: logins never wait on a registration's commit
     cursor = conn.cursor()
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -137,167 +882,196 @@ def init_admin_db():
     """)
     conn.commit()
     conn.close()
-    app.logger.info(f"Admin database '{ADMIN_DB_PATH}' initialized.") # Use logger
+    app.logger.info("Admin database '%s' initialized.", ADMIN_DB_PATH) # Use logger
+
+# Anki Schema Definition. The indexes are kept apart so that a new collection can
+# be filled first and indexed once (see init_anki_db's create_indexes).
+ANKI_SCHEMA_TABLES_SQL = """
+    CREATE TABLE col (
+        id              integer primary key, /* arbritrary */
+        crt             integer not null, /* creation time (seconds) */
+        mod             integer not null, /* modification time (ms) */
+        scm             integer not null, /* schema modification time (ms) */
+        ver             integer not null, /* Anki version */
+        dty             integer not null, /* dirty (needs sync?) 0 or 1 */
+        usn             integer not null, /* update sequence number */
+        ls              integer not null, /* last sync time (ms) */
+        conf            text not null, /* json config */
+        models          text not null, /* json array of models */
+        decks           text not null, /* json array of decks */
+        dconf           text not null, /* json array of deck confs */
+        tags            text not null /* json array of tags */
+    );
+    CREATE TABLE notes (
+        id              integer primary key, /* epoch ms, first note */
+        guid            text not null, /* globally unique id, random */
+        mid             integer not null, /* model id */
+        mod             integer not null, /* modification time, epoch seconds */
+        usn             integer not null, /* update sequence number, -1 for local */
+        tags            text not null, /* space separated string */
+        flds            text not null, /* field content separated by 0x1f */
+        sfld            integer not null, /* sort field */
+        csum            integer not null, /* sha1 checksum of the first field */
+        flags           integer not null, /* unused */
+        data            text not null /* unused */
+    );
+    CREATE TABLE cards (
+        id              integer primary key, /* epoch ms, first card */
+        nid             integer not null, /* note id */
+        did             integer not null, /* deck id */
+        ord             integer not null, /* template index */
+        mod             integer not null, /* modification time, epoch seconds */
+        usn             integer not null, /* update sequence number, -1 for local */
+        type            integer not null, /* 0=new, 1=lrn, 2=rev, 3=relrn */
+        queue           integer not null, /* -3=sched buried, -2=user buried, -1=suspended, 0=new, 1=lrn, 2=rev, 3=day lrn, 4=preview */
+        due             integer not null, /* new: note id, rev: day, lrn: epoch seconds */
+        ivl             integer not null, /* interval (days for rev, seconds for lrn) */
+        factor          integer not null, /* ease factor (start at 2500) */
+        reps            integer not null, /* reviews */
+        lapses          integer not null, /* lapses */
+        left            integer not null, /* remaining steps in learning */
+        odue            integer not null, /* original due */
+        odid            integer not null, /* original deck id */
+        flags           integer not null, /* unused */
+        data            text not null /* unused */
+    );
+    CREATE TABLE revlog (
+        id              integer primary key, /* epoch ms timestamp */
+        cid             integer not null, /* card id */
+        usn             integer not null, /* update sequence number, -1 for local */
+        ease            integer not null, /* 1=again, 2=hard, 3=good, 4=easy */
+        ivl             integer not null, /* interval */
+        lastIvl         integer not null, /* last interval */
+        factor          integer not null, /* factor */
+        time            integer not null, /* time taken (ms) */
+        type            integer not null /* 0=lrn, 1=rev, 2=relrn, 3=cram */
+    );
+    CREATE TABLE graves (
+        usn             integer not null,
+        oid             integer not null,
+        type            integer not null /* 0=card, 1=note, 2=deck */
+    );
+"""
+ANKI_SCHEMA_INDEXES_SQL = """
+    CREATE INDEX ix_notes_usn ON notes (usn);
+    CREATE INDEX ix_cards_usn ON cards (usn);
+    CREATE INDEX ix_revlog_usn ON revlog (usn);
+    CREATE INDEX ix_cards_nid ON cards (nid);
+    CREATE INDEX ix_cards_sched ON cards (did, queue, due);
+    CREATE INDEX ix_revlog_cid ON revlog (cid);
+    CREATE INDEX ix_notes_csum ON notes (csum);
+"""
+
+# Default col JSON for new collections. Only the creation time and the user's
+# name vary per collection, so the JSON is encoded once at import with
+# placeholders and init_anki_db only substitutes them.
+_CRT_PLACEHOLDER = "__CRT__" # Encoded as "__CRT__" (quoted); replaced by the bare number
+_USER_PLACEHOLDER = "__USER__" # Replaced by the JSON-escaped user name
+
+_DEFAULT_CONF = {
+    "nextPos": 1, "estTimes": True, "activeDecks": [1], "sortType": "noteFld",
+    "timeLim": 0, "sortBackwards": False, "addToCur": True,
+    "curDeck": 1,
+    "newBury": True, "newSpread": 0, "dueCounts": True, "curModel": "1",
+    "collapseTime": 1200
+}
+
+# Model ID needs to be consistent. Using epoch time of creation is common.
+# For simplicity, let's use a fixed large number based on current time
+# NOTE: Using a fixed ID like "1" is simpler if we only ever have one model type.
+_BASIC_MODEL_ID = "1700000000001" # Example fixed ID
+
+_DEFAULT_MODELS = {
+    _BASIC_MODEL_ID: {
+        "id": _BASIC_MODEL_ID,
+        "name": "Basic-Gemini", "type": 0, "mod": _CRT_PLACEHOLDER, "usn": -1,
+        "sortf": 0, "did": 1, # Default deck ID
+        "tmpls": [
+            {
+                "name": "Card 1", "ord": 0, "qfmt": "{{Front}}",
+                "afmt": "{{FrontSide}}\n\n<hr id=answer>\n\n{{Back}}",
+                "bqfmt": "", "bafmt": "", "did": None, "bfont": "Arial", "bsize": 12
+            }
+        ],
+        "flds": [
+            {"name": "Front", "ord": 0, "sticky": False, "rtl": False, "font": "Arial", "size": 20},
+            {"name": "Back", "ord": 1, "sticky": False, "rtl": False, "font": "Arial", "size": 20}
+        ],
+        "css": ".card {\n font-family: arial;\n font-size: 20px;\n text-align: center;\n color: black;\n background-color: white;\n}\n",
+        "latexPre": "\\documentclass[12pt]{article}\n\\special{papersize=3in,5in}\n\\usepackage[utf8]{inputenc}\n\\usepackage{amssymb,amsmath}\n\\pagestyle{empty}\n\\setlength{\\parindent}{0in}\n\\begin{document}",
+        "latexPost": "\\end{document}", "latexsvg": False, "ver": []
+    }
+}
+_DEFAULT_DECKS = {
+    "1": { # Deck ID 1 = User's first empty deck
+        "id": 1,
+        "name": "MyFirstDeck",
+        "mod": _CRT_PLACEHOLDER, "usn": -1,
+        "lrnToday": [0, 0], "revToday": [0, 0], "newToday": [0, 0],
+        "timeToday": [0, 0], "conf": 1, # Refers to dconf ID 1
+        "desc": "Your first flashcard deck",
+        "dyn": 0, "collapsed": False,
+         "extendNew": 10, "extendRev": 50
+    },
+    "2": { # Deck ID 2 = Sample cards deck
+        "id": 2,
+        "name": "Verbal Tenses",
+        "mod": _CRT_PLACEHOLDER, "usn": -1,
+        "lrnToday": [0, 0], "revToday": [0, 0], "newToday": [0, 0],
+        "timeToday": [0, 0], "conf": 1, # Refers to dconf ID 1
+        "desc": f"English verb tenses sample deck for {_USER_PLACEHOLDER}",
+        "dyn": 0, "collapsed": False,
+         "extendNew": 10, "extendRev": 50
+    }
+}
+_DEFAULT_DCONF = { # Deck configurations
+    "1": { # Dconf ID 1
+        "id": 1, "name": "Default", "mod": _CRT_PLACEHOLDER, "usn": -1,
+        "maxTaken": 60, "timer": 0, "autoplay": True, "replayq": True,
+        "new": {"bury": True, "delays": [1, 10], "initialFactor": 2500, "ints": [1, 4, 0], "order": 1, "perDay": 25, "separate": True},
+        "rev": {"bury": True, "ease4": 1.3, "fuzz": 0.05, "ivlFct": 1, "maxIvl": 36500, "perDay": 100, "hardFactor": 1.2},
+        "lapse": {"delays": [10], "leechAction": 1, "leechFails": 8, "minInt": 1, "mult": 0},
+        # Removed "misc" as it's not strictly required for basic function
+    }
+}
 
-def init_anki_db(db_path, user_name="Default User"):
+_COL_CONF_JSON = json_dumps(_DEFAULT_CONF)
+_COL_MODELS_JSON_TEMPLATE = json_dumps(_DEFAULT_MODELS)
+_COL_DECKS_JSON_TEMPLATE = json_dumps(_DEFAULT_DECKS)
+_COL_DCONF_JSON_TEMPLATE = json_dumps(_DEFAULT_DCONF)
+
+def _fill_col_json(template, crt_time, user_name=""):
+    """Substitutes the creation time and user name into a default col JSON template."""
+    filled = template.replace(f'"{_CRT_PLACEHOLDER}"', str(crt_time))
+    if _USER_PLACEHOLDER in filled:
+        filled = filled.replace(_USER_PLACEHOLDER, json_dumps(user_name)[1:-1])
+    return filled
+
+def init_anki_db(db_path, user_name="Default User", create_indexes=True):
     """Initializes a new Anki-compatible SQLite database at the specified path,
     using the provided user_name for the default deck.
+
+    With create_indexes=False the Anki indexes are left out; the caller bulk-loads
+    the collection and then calls create_anki_indexes().
     """
     if os.path.exists(db_path):
-        app.logger.debug(f"Anki DB already exists at '{db_path}'") # Use logger (DEBUG level)
+        app.logger.debug("Anki DB already exists at '%s'", db_path) # Use logger (DEBUG level)
         return # Avoid re-initializing
 
-    app.logger.info(f"Initializing Anki DB schema in '{db_path}'...") # Use logger
+    app.logger.info("Initializing Anki DB schema in '%s'...", db_path) # Use logger
     conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode = WAL") # Persistent; exports are switched back (see _export_collection_image)
     cursor = conn.cursor()
 
-    # Anki Schema Definition
-    cursor.executescript("""
-        CREATE TABLE col (
-            id              integer primary key, /* arbritrary */
-            crt             integer not null, /* creation time (seconds) */
-            mod             integer not null, /* modification time (ms) */
-            scm             integer not null, /* schema modification time (ms) */
-            ver             integer not null, /* Anki version */
-            dty             integer not null, /* dirty (needs sync?) 0 or 1 */
-            usn             integer not null, /* update sequence number */
-            ls              integer not null, /* last sync time (ms) */
-            conf            text not null, /* json config */
-            models          text not null, /* json array of models */
-            decks           text not null, /* json array of decks */
-            dconf           text not null, /* json array of deck confs */
-            tags            text not null /* json array of tags */
-        );
-        CREATE TABLE notes (
-            id              integer primary key, /* epoch ms, first note */
-            guid            text not null, /* globally unique id, random */
-            mid             integer not null, /* model id */
-            mod             integer not null, /* modification time, epoch seconds */
-            usn             integer not null, /* update sequence number, -1 for local */
-            tags            text not null, /* space separated string */
-            flds            text not null, /* field content separated by 0x1f */
-            sfld            integer not null, /* sort field */
-            csum            integer not null, /* sha1 checksum of the first field */
-            flags           integer not null, /* unused */
-            data            text not null /* unused */
-        );
-        CREATE TABLE cards (
-            id              integer primary key, /* epoch ms, first card */
-            nid             integer not null, /* note id */
-            did             integer not null, /* deck id */
-            ord             integer not null, /* template index */
-            mod             integer not null, /* modification time, epoch seconds */
-            usn             integer not null, /* update sequence number, -1 for local */
-            type            integer not null, /* 0=new, 1=lrn, 2=rev, 3=relrn */
-            queue           integer not null, /* -3=sched buried, -2=user buried, -1=suspended, 0=new, 1=lrn, 2=rev, 3=day lrn, 4=preview */
-            due             integer not null, /* new: note id, rev: day, lrn: epoch seconds */
-            ivl             integer not null, /* interval (days for rev, seconds for lrn) */
-            factor          integer not null, /* ease factor (start at 2500) */
-            reps            integer not null, /* reviews */
-            lapses          integer not null, /* lapses */
-            left            integer not null, /* remaining steps in learning */
-            odue            integer not null, /* original due */
-            odid            integer not null, /* original deck id */
-            flags           integer not null, /* unused */
-            data            text not null /* unused */
-        );
-        CREATE TABLE revlog (
-            id              integer primary key, /* epoch ms timestamp */
-            cid             integer not null, /* card id */
-            usn             integer not null, /* update sequence number, -1 for local */
-            ease            integer not null, /* 1=again, 2=hard, 3=good, 4=easy */
-            ivl             integer not null, /* interval */
-            lastIvl         integer not null, /* last interval */
-            factor          integer not null, /* factor */
-            time            integer not null, /* time taken (ms) */
-            type            integer not null /* 0=lrn, 1=rev, 2=relrn, 3=cram */
-        );
-        CREATE TABLE graves (
-            usn             integer not null,
-            oid             integer not null,
-            type            integer not null /* 0=card, 1=note, 2=deck */
-        );
-        CREATE INDEX ix_notes_usn ON notes (usn);
-        CREATE INDEX ix_cards_usn ON cards (usn);
-        CREATE INDEX ix_revlog_usn ON revlog (usn);
-        CREATE INDEX ix_cards_nid ON cards (nid);
-        CREATE INDEX ix_cards_sched ON cards (did, queue, due);
-        CREATE INDEX ix_revlog_cid ON revlog (cid);
-        CREATE INDEX ix_notes_csum ON notes (csum);
-    """)
+    cursor.executescript(ANKI_SCHEMA_TABLES_SQL)
+    if create_indexes:
+        cursor.executescript(ANKI_SCHEMA_INDEXES_SQL)
 
     # Populate 'col' table with default Anki data
-    crt_time = int(time.time())
-    mod_time_ms = int(time.time() * 1000)
+    mod_time_ms = clock_ms()
+    crt_time = mod_time_ms // 1000
     scm_time_ms = mod_time_ms
 
-    default_conf = {
-        "nextPos": 1, "estTimes": True, "activeDecks": [1], "sortType": "noteFld",
-        "timeLim": 0, "sortBackwards": False, "addToCur": True,
-        "curDeck": 1,
-        "newBury": True, "newSpread": 0, "dueCounts": True, "curModel": "1",
-        "collapseTime": 1200
-    }
-
-    # Model ID needs to be consistent. Using epoch time of creation is common.
-    # For simplicity, let's use a fixed large number based on current time
-    # NOTE: Using a fixed ID like "1" is simpler if we only ever have one model type.
-    basic_model_id = "1700000000001" # Example fixed ID
-
-    default_models = {
-        basic_model_id: {
-            "id": basic_model_id,
-            "name": "Basic-Gemini", "type": 0, "mod": crt_time, "usn": -1,
-            "sortf": 0, "did": 1, # Default deck ID
-            "tmpls": [
-                {
-                    "name": "Card 1", "ord": 0, "qfmt": "{{Front}}",
-                    "afmt": "{{FrontSide}}\n\n<hr id=answer>\n\n{{Back}}",
-                    "bqfmt": "", "bafmt": "", "did": None, "bfont": "Arial", "bsize": 12
-                }
-            ],
-            "flds": [
-                {"name": "Front", "ord": 0, "sticky": False, "rtl": False, "font": "Arial", "size": 20},
-                {"name": "Back", "ord": 1, "sticky": False, "rtl": False, "font": "Arial", "size": 20}
-            ],
-            "css": ".card {\n font-family: arial;\n font-size: 20px;\n text-align: center;\n color: black;\n background-color: white;\n}\n",
-            "latexPre": "\\documentclass[12pt]{article}\n\\special{papersize=3in,5in}\n\\usepackage[utf8]{inputenc}\n\\usepackage{amssymb,amsmath}\n\\pagestyle{empty}\n\\setlength{\\parindent}{0in}\n\\begin{document}",
-            "latexPost": "\\end{document}", "latexsvg": False, "ver": []
-        }
-    }
-    default_decks = {
-        "1": { # Deck ID 1 = User's first empty deck
-            "id": 1,
-            "name": "MyFirstDeck",
-            "mod": crt_time, "usn": -1,
-            "lrnToday": [0, 0], "revToday": [0, 0], "newToday": [0, 0],
-            "timeToday": [0, 0], "conf": 1, # Refers to dconf ID 1
-            "desc": "Your first flashcard deck",
-            "dyn": 0, "collapsed": False,
-             "extendNew": 10, "extendRev": 50
-        },
-        "2": { # Deck ID 2 = Sample cards deck
-            "id": 2,
-            "name": "Verbal Tenses",
-            "mod": crt_time, "usn": -1,
-            "lrnToday": [0, 0], "revToday": [0, 0], "newToday": [0, 0],
-            "timeToday": [0, 0], "conf": 1, # Refers to dconf ID 1
-            "desc": f"English verb tenses sample deck for {user_name}",
-            "dyn": 0, "collapsed": False,
-             "extendNew": 10, "extendRev": 50
-        }
-    }
-    default_dconf = { # Deck configurations
-        "1": { # Dconf ID 1
-            "id": 1, "name": "Default", "mod": crt_time, "usn": -1,
-            "maxTaken": 60, "timer": 0, "autoplay": True, "replayq": True,
-            "new": {"bury": True, "delays": [1, 10], "initialFactor": 2500, "ints": [1, 4, 0], "order": 1, "perDay": 25, "separate": True},
-            "rev": {"bury": True, "ease4": 1.3, "fuzz": 0.05, "ivlFct": 1, "maxIvl": 36500, "perDay": 100, "hardFactor": 1.2},
-            "lapse": {"delays": [10], "leechAction": 1, "leechFails": 8, "minInt": 1, "mult": 0},
-            # Removed "misc" as it's not strictly required for basic function
-        }
-    }
-
     cursor.execute(
         "INSERT INTO col (id, crt, mod, scm, ver, dty, usn, ls, conf, models, decks, dconf, tags) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
         (
@@ -309,17 +1083,106 @@ def init_anki_db(db_path, user_name="Default User"):
             0, # dty (dirty flag)
             -1, # usn (update sequence number, -1 for local changes)
             0, # ls (last sync time in ms)
-            json.dumps(default_conf), # conf JSON
-            json.dumps(default_models), # models JSON
-            json.dumps(default_decks), # decks JSON
-            json.dumps(default_dconf), # dconf JSON
-            json.dumps({}) # tags JSON (empty object)
+            _COL_CONF_JSON, # conf JSON
+            _fill_col_json(_COL_MODELS_JSON_TEMPLATE, crt_time), # models JSON
+            _fill_col_json(_COL_DECKS_JSON_TEMPLATE, crt_time, user_name), # decks JSON
+            _fill_col_json(_COL_DCONF_JSON_TEMPLATE, crt_time), # dconf JSON
+            "{}" # tags JSON (empty object)
         )
     )
+    ensure_decks_index(conn)
 
     conn.commit()
     conn.close()
-    app.logger.info(f"Initialized Anki DB schema in '{db_path}'") # Use logger
+    app.logger.info("Initialized Anki DB schema in '%s'", db_path) # Use logger
+
+def create_anki_indexes(db_path):
+    """Creates the Anki indexes on a collection initialized with create_indexes=False."""
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.executescript(f"BEGIN; {ANKI_SCHEMA_INDEXES_SQL} COMMIT;") # One commit for all indexes
+    finally:
+        conn.close()
+
+# --- User DB Setup ---
+# register() builds the new user's collection before answering, so that every
+# worker process finds it as soon as the 201 is out. The collection is prepared
+# under a temporary name and moved into place with os.replace(): any process sees
+# either no file or the complete collection.
+
+# Every new collection starts out the same apart from its timestamps, ids, guids
+# and the user's name, so it is built once as a template next to the user DBs
+# and each registration copies that file and patches the differences. The
+# template's name carries a hash of everything it is built from (see
+# _TEMPLATE_DB_NAME): changing the schema or sample cards builds a new one.
+_template_db_lock = threading.Lock()
+
+def _remove_db_files(path):
+    for leftover in (path, f"{path}-wal", f"{path}-shm"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+def ensure_template_db(db_dir):
+    """Returns the path of the starter collection template in db_dir, building it if missing."""
+    template_path = os.path.join(db_dir, _TEMPLATE_DB_NAME)
+    if os.path.exists(template_path):
+        return template_path
+    with _template_db_lock:
+        if os.path.exists(template_path):
+            return template_path
+        tmp_path = f"{template_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            # Load the sample cards before building the indexes: one sorted build
+            # per index instead of B-tree maintenance on every insert
+            init_anki_db(tmp_path, create_indexes=False)
+            add_initial_flashcards(tmp_path, _BASIC_MODEL_ID, deck_id=2, id_base=TEMPLATE_ID_BASE)  # Sample cards go to deck #2
+            create_anki_indexes(tmp_path)
+            os.replace(tmp_path, template_path) # Another process may win the race; both files are equivalent
+            app.logger.info("Built collection template '%s'", template_path)
+        finally:
+            _remove_db_files(tmp_path)
+    return template_path
+
+def _personalize_user_db(db_path, user_name):
+    """Gives a fresh copy of the template its own timestamps, note/card ids, guids and user name."""
+    now_ms = clock_ms()
+    crt_time = now_ms // 1000
+    decks_json = _fill_col_json(_COL_DECKS_JSON_TEMPLATE, crt_time, user_name)
+    id_shift = now_ms - TEMPLATE_ID_BASE # Same ids a direct build at now_ms would have given
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("BEGIN")
+        conn.execute("UPDATE col SET crt = ?, mod = ?, scm = ?, models = ?, decks = ?, dconf = ?",
+                     (crt_time, now_ms, now_ms, _fill_col_json(_COL_MODELS_JSON_TEMPLATE, crt_time),
+                      decks_json, _fill_col_json(_COL_DCONF_JSON_TEMPLATE, crt_time)))
+        conn.execute("UPDATE decks_bin SET decks_mod = MAX(decks_mod, ?1), conf_mod = MAX(conf_mod, ?1), data = ?2 "
+                     "WHERE id = 0", (now_ms, marshal.dumps(json_loads(decks_json))))
+        note_ids = [row[0] for row in conn.execute("SELECT id FROM notes")]
+        conn.executemany("UPDATE notes SET id = ?, guid = ?, mod = ? WHERE id = ?",
+                         [(note_id + id_shift, uuid.uuid4().hex[:10], crt_time, note_id) for note_id in note_ids])
+        conn.execute("UPDATE cards SET id = id + ?1, nid = nid + ?1, due = due + ?1, mod = ?2",
+                     (id_shift, crt_time)) # New cards are due in note id order
+        # The template's deck versions date from its build: start this collection's at now
+        conn.execute("UPDATE decks_index SET version = ?", (now_ms,))
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+def setup_user_db(user_id, user_name):
+    """Builds the user's flashcard database with the sample cards (no-op if it exists)."""
+    db_path = get_user_db_path(user_id)
+    if os.path.exists(db_path):
+        app.logger.debug("Anki DB already exists at '%s'", db_path)
+        return
+    template_path = ensure_template_db(os.path.dirname(db_path))
+    tmp_path = f"{db_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        shutil.copyfile(template_path, tmp_path)
+        _personalize_user_db(tmp_path, user_name)
+        os.replace(tmp_path, db_path) # Every connection is closed, so no -wal/-shm is left behind
+    finally:
+        _remove_db_files(tmp_path)
 
 # --- API Routes (Placeholders) ---
 
@@ -351,7 +1214,7 @@ def register():
         return jsonify({"error": "Password must be between 10 and 20 characters"}), 400
     
     # Hash the password
-    password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
     
     # Initialize admin database if it doesn't exist yet
     init_admin_db()
@@ -365,6 +1228,7 @@ def register():
         return jsonify({"error": "Username already exists"}), 409
     
     # Insert the new user
+    user_id = None
     try:
         cursor.execute(
             "INSERT INTO users (username, name, password_hash) VALUES (?, ?, ?)",
@@ -372,14 +1236,17 @@ def register():
         )
         conn.commit()
         user_id = cursor.lastrowid
-        conn.close()
         
-        app.logger.info(f"User registered: {username} (ID: {user_id})")
+        # Create user flashcard database (nothing pending or pooled may target the new file)
+        discard_col_mod(user_id)
+        discard_revlog(user_id)
+        close_user_db_pool(user_id)
+        discard_decks(user_id)
+        discard_col_conf(user_id)
+        setup_user_db(user_id, name)
+        conn.close()
         
-        # Create user flashcard database
-        user_db_path = get_user_db_path(user_id)
-        init_anki_db(user_db_path, user_name=name)
-        add_initial_flashcards(user_db_path, "1700000000001", deck_id=2)  # Sample cards go to deck #2
+        app.logger.info("User registered: %s (ID: %s)", username, user_id)
         
         return jsonify({
             "message": "User registered successfully",
@@ -387,8 +1254,12 @@ def register():
         }), 201
     except Exception as e:
         conn.rollback()
+        if user_id is not None:
+            # No collection: free the username again rather than leave a user who gets 404s
+            conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+            conn.commit()
         conn.close()
-        app.logger.exception(f"Error during registration: {e}")
+        app.logger.exception("Error during registration: %s", e)
         return jsonify({"error": "An internal server error occurred"}), 500
 
 @app.route('/login', methods=['POST'])
@@ -423,7 +1294,7 @@ def login():
             session['user_id'] = user['user_id']
             session['username'] = user['username']
             
-            app.logger.info(f"User logged in: {username} (ID: {user['user_id']})")
+            app.logger.info("User logged in: %s (ID: %s)", username, user['user_id'])
             
             return jsonify({
                 "message": "Login successful",
@@ -436,7 +1307,7 @@ def login():
         else:
             return jsonify({"error": "Invalid username or password"}), 401
     except Exception as e:
-        app.logger.exception(f"Error during login: {e}")
+        app.logger.exception("Error during login: %s", e)
         return jsonify({"error": "An internal server error occurred"}), 500
 
 @app.route('/logout', methods=['POST'])
@@ -1184,56 +2055,76 @@ def generate_ai_flashcards():
     
     return cards
 
-def add_initial_flashcards(db_path, model_id, deck_id=1):
-    """Adds the initial set of flashcards about verbal tenses to the user's Anki DB."""
-    cards_to_add = generate_ai_flashcards()
+# The sample cards never change: build them once at import, with the note fields
+# and the 32-bit first-field checksum each note stores, so registration only
+# assigns ids and guids. Rows are (front, fields, csum).
+_INITIAL_CARDS_PRECOMPUTED = tuple(
+    (front, f"{front}{FIELD_SEP}{back}", field_checksum(front))
+    for front, back in generate_ai_flashcards()
+)
+
+def _multi_row_insert_sql(single_row_sql, row_count):
+    """Repeats the VALUES tuple of a one-row INSERT so it inserts row_count rows."""
+    head, values = single_row_sql.rsplit("VALUES", 1)
+    return f"{head}VALUES {', '.join([values.strip()] * row_count)}"
+
+# The sample set has a fixed size, so each table is seeded by one statement
+# (prepared once, one VM run) built here at import
+SQL_INSERT_INITIAL_NOTES = _multi_row_insert_sql(SQL_INSERT_NEW_NOTE, len(_INITIAL_CARDS_PRECOMPUTED))
+SQL_INSERT_INITIAL_CARDS = _multi_row_insert_sql(SQL_INSERT_NEW_CARD, len(_INITIAL_CARDS_PRECOMPUTED))
+
+# Collection template (see User DB Setup): its notes and cards are
+# numbered from TEMPLATE_ID_BASE and shifted to the current time on each copy
+TEMPLATE_ID_BASE = 1
+_TEMPLATE_DB_NAME = "template_{}.db".format(hashlib.sha1(repr((
+    ANKI_SCHEMA_TABLES_SQL, ANKI_SCHEMA_INDEXES_SQL, DECKS_INDEX_SCHEMA, _COL_CONF_JSON,
+    _COL_MODELS_JSON_TEMPLATE, _COL_DECKS_JSON_TEMPLATE, _COL_DCONF_JSON_TEMPLATE,
+    _INITIAL_CARDS_PRECOMPUTED,
+)).encode('utf-8'), usedforsecurity=False).hexdigest()[:12])
+
+def add_initial_flashcards(db_path, model_id, deck_id=1, id_base=None):
+    """Adds the initial set of flashcards about verbal tenses to the user's Anki DB.
+
+    Note and card ids start at id_base (default: the current time in ms).
+    """
     conn = None
     try:
-        conn = sqlite3.connect(db_path)
+        conn = sqlite3.connect(db_path, isolation_level=None)
+        # The DB is already in WAL mode (init_anki_db); only sync at checkpoints
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA temp_store = MEMORY")
         cursor = conn.cursor()
 
-        current_time_sec = int(time.time())
-        current_time_ms = int(current_time_sec * 1000)
+        current_time_ms = clock_ms()
+        current_time_sec = current_time_ms // 1000
+        if id_base is None:
+            id_base = current_time_ms
         # deck_id is now passed as parameter
-        usn = -1 # Local changes
-
-        for i, (front, back) in enumerate(cards_to_add):
-            note_id = current_time_ms + i # Simple unique ID generation
-            card_id = note_id + 1 # Ensure card ID is different from note ID
-            guid = str(uuid.uuid4())[:10] # Short unique ID
-            fields = f"{front}\x1f{back}" # Fields separated by 0x1f
-            checksum = sha1_checksum(front) # Checksum of the first field (sort field)
-
-            # Insert Note
-            cursor.execute("""
-                INSERT INTO notes (id, guid, mid, mod, usn, tags, flds, sfld, csum, flags, data)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (note_id, guid, model_id, current_time_sec, usn, "verbal_tenses", fields, front, int(checksum, 16) & 0xFFFFFFFF, 0, ""))
-
-            # Insert Card (New card state)
-            cursor.execute("""
-                INSERT INTO cards (id, nid, did, ord, mod, usn, type, queue, due, ivl, factor, reps, lapses, left, odue, odid, flags, data)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                card_id, note_id, deck_id, 0, current_time_sec, usn,
-                0, # type = new
-                0, # queue = new
-                note_id, # due = note id for new cards (or ord)
-                0, # ivl
-                2500, # factor (initial ease)
-                0, # reps
-                0, # lapses
-                0, # left (steps remaining, starts at 0 for simple new cards)
-                0, # odue (original due)
-                0, # odid (original deck id)
-                0, # flags
-                "" # data
-            ))
 
+        # Parameters of the multi-row INSERTs, flattened row after row
+        # Notes and cards get disjoint, ascending id ranges (base..base+N and
+        # base+N..base+2N) so no card id ever shadows a note id and both
+        # B-trees are filled append-only
+        count = len(_INITIAL_CARDS_PRECOMPUTED)
+        note_ids = range(id_base, id_base + count)
+        card_ids = range(id_base + count, id_base + 2 * count)
+        notes_params = []
+        cards_params = []
+        for note_id, card_id, (front, fields, checksum) in zip(note_ids, card_ids, _INITIAL_CARDS_PRECOMPUTED):
+            guid = uuid.uuid4().hex[:10] # Short unique ID
+            notes_params += (note_id, guid, model_id, current_time_sec, "verbal_tenses",
+                             fields, front, checksum)
+            cards_params += (card_id, note_id, deck_id, current_time_sec, note_id) # due = note id for new cards
+
+        # One transaction and one statement per table (usn = -1 and the
+        # new-card state are literals in the shared INSERT statements)
+        conn.execute("BEGIN")
+        cursor.execute(SQL_INSERT_INITIAL_NOTES, notes_params)
+        cursor.execute(SQL_INSERT_INITIAL_CARDS, cards_params)
         conn.commit()
     except Exception as e:
-        app.logger.error(f"Error adding initial flashcards to {db_path}: {e}") # Use logger
-        if conn: conn.rollback() # Rollback changes if error occurs
+        app.logger.error("Error adding initial flashcards to %s: %s", db_path, e) # Use logger
+        if conn and conn.in_transaction: conn.rollback() # Rollback changes if error occurs
         raise # Re-raise the exception to be caught by the caller
     finally:
         if conn:
@@ -1241,49 +2132,39 @@ def add_initial_flashcards(db_path, model_id, deck_id=1):
 
 # --- Helper Functions for Review Logic ---
 
-def _getDbConnection(userDbPath):
-    """Establishes and returns a database connection with row factory."""
+def _getCollectionConfig(conn, userId):
+    """Fetches essential configuration from the col table (through the per-user caches)."""
     try:
-        conn = sqlite3.connect(userDbPath)
-        conn.row_factory = sqlite3.Row
-        return conn
-    except sqlite3.Error as e:
-        app.logger.error(f"Database connection error to {userDbPath}: {e}")
-        raise  # Re-raise the exception to be handled by the caller
-
-def _getCollectionConfig(cursor):
-    """Fetches essential configuration from the col table."""
-    try:
-        cursor.execute("SELECT crt, conf, decks FROM col LIMIT 1")
-        colData = cursor.fetchone()
-        if not colData:
+        colConf = load_col_conf(conn, userId)
+        if not colConf:
             raise ValueError("Collection configuration could not be read")
 
-        confDict = json.loads(colData['conf'])
-        decksDict = json.loads(colData['decks'])
-        currentDeckId = confDict.get('curDeck', 1)
+        collectionCreationTime, currentDeckId = colConf
+        decksDict = load_decks(conn, userId) or {}
         deckName = decksDict.get(str(currentDeckId), {}).get('name', 'Default')
 
         return {
-            "collectionCreationTime": colData['crt'],
+            "collectionCreationTime": collectionCreationTime,
             "currentDeckId": currentDeckId,
             "deckName": deckName
         }
     except (sqlite3.Error, json.JSONDecodeError, KeyError, ValueError) as e:
-        app.logger.error(f"Error processing collection config: {e}")
+        app.logger.error("Error processing collection config: %s", e)
         raise ValueError("Failed to process collection configuration")
 
 def _calculateDayCutoff(collectionCreationTime):
     """Calculates the current time and day cutoff based on collection creation."""
-    now = int(time.time())
+    now = clock_ms() // 1000
     # Calculate days since collection creation time, this is how Anki determines the 'day'
     dayCutoff = (now - collectionCreationTime) // 86400
     return now, dayCutoff
 
-def _countNewCardsReviewedToday(cursor, dayCutoff, collectionCreationTime):
-    """Counts cards marked as 'new' (type=0) in today's review log."""
+def _countNewCardsReviewedToday(cursor, userId, dayCutoff, collectionCreationTime):
+    """Counts cards marked as 'new' (type=0) in today's review log, including buffered rows."""
     # Calculate the timestamp for the start of the current day relative to collection creation
     startOfDayTimestampMs = (collectionCreationTime + dayCutoff * 86400) * 1000
+    pendingCount = sum(1 for row in pending_revlog(userId)
+                       if row[0] >= startOfDayTimestampMs and row[8] == 0)
     try:
         cursor.execute("""
             SELECT COUNT(*) 
@@ -1291,55 +2172,37 @@ def _countNewCardsReviewedToday(cursor, dayCutoff, collectionCreationTime):
             WHERE id >= ? AND type = 0
         """, (startOfDayTimestampMs,))
         countResult = cursor.fetchone()
-        return countResult[0] if countResult else 0
+        return (countResult[0] if countResult else 0) + pendingCount
     except sqlite3.Error as e:
-        app.logger.error(f"Error counting new cards reviewed today: {e}")
+        app.logger.error("Error counting new cards reviewed today: %s", e)
         return 0 # Fail safe: assume 0 if error occurs
 
 def _fetchLearningCard(cursor, currentDeckId, now):
     """Fetches the next due learning/relearning card."""
     try:
-        cursor.execute("""
-            SELECT c.id, c.nid, c.queue, n.flds
-            FROM cards c JOIN notes n ON c.nid = n.id
-            WHERE c.did = ? AND (c.queue = 1 OR c.queue = 3) AND c.due <= ?
-            ORDER BY c.due
-            LIMIT 1
-        """, (currentDeckId, now))
+        cursor.execute(SQL_SELECT_DUE_LEARNING_CARD, (currentDeckId, now))
         return cursor.fetchone()
     except sqlite3.Error as e:
-        app.logger.error(f"Error fetching learning card: {e}")
+        app.logger.error("Error fetching learning card: %s", e)
         return None
 
 def _fetchReviewCard(cursor, currentDeckId, dayCutoff):
     """Fetches the next due review card."""
     try:
-        cursor.execute("""
-            SELECT c.id, c.nid, c.queue, n.flds, c.due, c.ivl
-            FROM cards c JOIN notes n ON c.nid = n.id
-            WHERE c.did = ? AND c.queue = 2 AND c.due <= ?
-            ORDER BY c.due
-            LIMIT 1
-        """, (currentDeckId, dayCutoff))
+        cursor.execute(SQL_SELECT_DUE_REVIEW_CARD, (currentDeckId, dayCutoff))
         return cursor.fetchone()
     except sqlite3.Error as e:
-        app.logger.error(f"Error fetching review card: {e}")
+        app.logger.error("Error fetching review card: %s", e)
         return None
 
 def _fetchNewCard(cursor, currentDeckId):
     """Fetches the next new card randomly.""" # <-- Updated docstring
     try:
-        # Order by RANDOM() to select a random new card
-        cursor.execute("""
-            SELECT c.id, c.nid, c.queue, n.flds
-            FROM cards c JOIN notes n ON c.nid = n.id
-            WHERE c.did = ? AND c.queue = 0
-            ORDER BY RANDOM() 
-            LIMIT 1
-        """, (currentDeckId,))
+        # Random offset into the deck's new cards
+        cursor.execute(SQL_SELECT_RANDOM_NEW_CARD, (currentDeckId,))
         return cursor.fetchone()
     except sqlite3.Error as e:
-        app.logger.error(f"Error fetching new card: {e}")
+        app.logger.error("Error fetching new card: %s", e)
         return None
 
 def _formatCardResponse(cardData):
@@ -1348,9 +2211,9 @@ def _formatCardResponse(cardData):
         return None
     
     try:
-        fields = cardData['flds'].split('\x1f') # Anki separator
-        front = fields[0]
-        back = fields[1] if len(fields) > 1 else ""
+        # First two fields only: partition stops at each separator, no list of all fields
+        front, _, rest = cardData['flds'].partition(FIELD_SEP) # Anki separator
+        back = rest.partition(FIELD_SEP)[0]
         
         # Store the current card ID in the session for the answer endpoint
         session['currentCardId'] = cardData['id']
@@ -1363,7 +2226,7 @@ def _formatCardResponse(cardData):
             "queue": cardData['queue']
         }
     except Exception as e:
-        app.logger.error(f"Error formatting card response: {e} for cardData: {cardData}")
+        app.logger.error("Error formatting card response: %s for cardData: %s", e, cardData)
         # Clear potentially inconsistent session data
         session.pop('currentCardId', None)
         session.pop('currentNoteId', None)
@@ -1387,98 +2250,93 @@ def login_required(f):
 def get_next_card():
     """Fetches the next card due for review using prioritized queues and daily limits."""
     userId = session['user_id']
-    userDbPath = get_user_db_path(userId)
     
-    if not os.path.exists(userDbPath):
-        app.logger.error(f"User database not found for user {userId} at {userDbPath}")
-        return jsonify({"error": "User database not found. Please re-register or contact support."}), 404
-    
-    conn = None
     try:
-        conn = _getDbConnection(userDbPath)
-        cursor = conn.cursor()
+        with get_user_db_conn(userId) as conn:
+            conn.row_factory = sqlite3.Row # Reset by the pool when the connection is returned
+            cursor = conn.cursor()
 
-        # Fetch configuration and calculate time cutoffs
-        try:
-            config = _getCollectionConfig(cursor)
-            collectionCreationTime = config['collectionCreationTime']
-            currentDeckId = config['currentDeckId']
-            deckName = config['deckName']
-        except ValueError as e:
-            # Error logged in helper, return error response
-            return jsonify({"error": str(e)}), 500
-
-        now, dayCutoff = _calculateDayCutoff(collectionCreationTime)
+            # Fetch configuration and calculate time cutoffs
+            try:
+                config = _getCollectionConfig(conn, userId)
+                collectionCreationTime = config['collectionCreationTime']
+                currentDeckId = config['currentDeckId']
+                deckName = config['deckName']
+            except ValueError as e:
+                # Error logged in helper, return error response
+                return jsonify({"error": str(e)}), 500
+
+            now, dayCutoff = _calculateDayCutoff(collectionCreationTime)
         
-        # Count new cards reviewed today
-        newCardsSeenToday = _countNewCardsReviewedToday(cursor, dayCutoff, collectionCreationTime)
+            # Count new cards reviewed today
+            newCardsSeenToday = _countNewCardsReviewedToday(cursor, userId, dayCutoff, collectionCreationTime)
         
-        app.logger.debug(f"User {userId}, Deck {currentDeckId}: Day Cutoff={dayCutoff}, Now={now}, New Seen={newCardsSeenToday}/{DAILY_NEW_LIMIT}")
-
-        nextCardData = None
+            app.logger.debug("User %s, Deck %s: Day Cutoff=%s, Now=%s, New Seen=%s/%s",
+                             userId, currentDeckId, dayCutoff, now, newCardsSeenToday, DAILY_NEW_LIMIT)
 
-        # 1. Check for Learning Cards
-        nextCardData = _fetchLearningCard(cursor, currentDeckId, now)
-        if nextCardData:
-            app.logger.debug(f"Found learning card {nextCardData['id']}")
+            nextCardData = None
 
-        # 2. Check for Due Review Cards
-        if not nextCardData:
-            nextCardData = _fetchReviewCard(cursor, currentDeckId, dayCutoff)
+            # 1. Check for Learning Cards
+            nextCardData = _fetchLearningCard(cursor, currentDeckId, now)
             if nextCardData:
-                # Log details if a review card (Young or Mature) is fetched
-                app.logger.info(f"Found review card {nextCardData['id']} (queue={nextCardData['queue']}). Card Due: {nextCardData['due']}, Card Interval: {nextCardData['ivl']} days. Current Day Cutoff: {dayCutoff}")
+                app.logger.debug("Found learning card %s", nextCardData['id'])
 
-        # 3. Check for New Cards (respecting limit)
-        if not nextCardData:
-            if newCardsSeenToday < DAILY_NEW_LIMIT:
-                nextCardData = _fetchNewCard(cursor, currentDeckId)
+            # 2. Check for Due Review Cards
+            if not nextCardData:
+                nextCardData = _fetchReviewCard(cursor, currentDeckId, dayCutoff)
                 if nextCardData:
-                    app.logger.debug(f"Found new card {nextCardData['id']}")
+                    # Log details if a review card (Young or Mature) is fetched
+                    app.logger.info("Found review card %s (queue=%s). Card Due: %s, Card Interval: %s days. Current Day Cutoff: %s",
+                                    nextCardData['id'], nextCardData['queue'], nextCardData['due'], nextCardData['ivl'], dayCutoff)
+
+            # 3. Check for New Cards (respecting limit)
+            if not nextCardData:
+                if newCardsSeenToday < DAILY_NEW_LIMIT:
+                    nextCardData = _fetchNewCard(cursor, currentDeckId)
+                    if nextCardData:
+                        app.logger.debug("Found new card %s", nextCardData['id'])
+                    else:
+                         app.logger.debug("No more new cards available in deck.")
                 else:
-                     app.logger.debug("No more new cards available in deck.")
-            else:
-                app.logger.debug(f"Daily new card limit ({DAILY_NEW_LIMIT}) reached.")
+                    app.logger.debug("Daily new card limit (%s) reached.", DAILY_NEW_LIMIT)
 
-        # Format and return card if found
-        if nextCardData:
-            responsePayload = _formatCardResponse(nextCardData)
-            if responsePayload:
-                 return jsonify(responsePayload), 200
+            # Format and return card if found
+            if nextCardData:
+                responsePayload = _formatCardResponse(nextCardData)
+                if responsePayload:
+                     return jsonify(responsePayload), 200
+                else:
+                    # Error formatting or card invalid, treat as internal error
+                    return jsonify({"error": "Failed to process card data."}), 500
             else:
-                # Error formatting or card invalid, treat as internal error
-                return jsonify({"error": "Failed to process card data."}), 500
-        else:
-            # No card found in any queue (or new limit reached)
-            session.pop('currentCardId', None)
-            session.pop('currentNoteId', None)
+                # No card found in any queue (or new limit reached)
+                session.pop('currentCardId', None)
+                session.pop('currentNoteId', None)
             
-            # Check total remaining cards for message accuracy
-            cursor.execute("SELECT COUNT(*) as card_count FROM cards WHERE did = ? AND queue >= 0 AND queue <= 3", (currentDeckId,))
-            countResult = cursor.fetchone()
-            totalCardsInDeck = countResult['card_count'] if countResult else 0
+                # Check for remaining cards for message accuracy (existence is enough)
+                hasActiveCards, hasNewCards = cursor.execute(SQL_SELECT_DECK_HAS_CARDS, (currentDeckId,)).fetchone()
             
-            message = f"No cards available for review in deck '{deckName}'."
-            if totalCardsInDeck > 0:
-                if newCardsSeenToday >= DAILY_NEW_LIMIT and _fetchNewCard(cursor, currentDeckId) is not None:
-                    message = f"Daily limit of {DAILY_NEW_LIMIT} new cards reached for deck '{deckName}'."
-                else: 
-                    message = f"No cards due for deck '{deckName}' right now."
+                message = f"No cards available for review in deck '{deckName}'."
+                if hasActiveCards:
+                    if newCardsSeenToday >= DAILY_NEW_LIMIT and hasNewCards:
+                        message = f"Daily limit of {DAILY_NEW_LIMIT} new cards reached for deck '{deckName}'."
+                    else: 
+                        message = f"No cards due for deck '{deckName}' right now."
                     
-            app.logger.info(message) # Log the final message
-            return jsonify({"message": message}), 200
+                app.logger.info(message) # Log the final message
+                return jsonify({"message": message}), 200
             
+    except UserDbNotFoundError:
+        app.logger.error("User database not found for user %s", userId)
+        return jsonify({"error": "User database not found. Please re-register or contact support."}), 404
     except sqlite3.Error as e:
-        app.logger.error(f"Database error in get_next_card for user {userId}: {e}")
+        app.logger.error("Database error in get_next_card for user %s: %s", userId, e)
         # Use traceback.format_exc() for detailed debug logs if needed
         # app.logger.error(traceback.format_exc())
         return jsonify({"error": f"A database error occurred."}), 500
     except Exception as e:
-        app.logger.exception(f"Unexpected error in get_next_card for user {userId}: {e}")
+        app.logger.exception("Unexpected error in get_next_card for user %s: %s", userId, e)
         return jsonify({"error": "An internal server error occurred."}), 500
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/answer', methods=['POST'])
 @login_required
@@ -1488,7 +2346,6 @@ def answer_card():
     Note: ease 1 = Again, 2 = Hard, 3 = Good, 4 = Easy
     """
     user_id = session['user_id']
-    user_db_path = get_user_db_path(user_id)
     
     # Get the current card ID from the session
     current_card_id = session.get('currentCardId')
@@ -1506,7 +2363,7 @@ def answer_card():
     
     # Validate ease value
     if ease not in [1, 2, 3, 4]:
-        app.logger.warning(f"Invalid ease value: {ease}")
+        app.logger.warning("Invalid ease value: %s", ease)
         return jsonify({"error": "Invalid ease rating (must be 1, 2, 3, or 4)"}), 400
     
     # Make sure we have a current card in the session
@@ -1515,271 +2372,238 @@ def answer_card():
         return jsonify({"error": "Missing card information in session or invalid request. Please get a card first."}), 400
     
     # Process the answer
-    conn = None
     try:
-        app.logger.info(f"Processing answer for card {current_card_id} (note {current_note_id}) with ease {ease}")
-        
-        conn = sqlite3.connect(user_db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        # First, verify the card exists
-        cursor.execute("SELECT * FROM cards WHERE id = ?", (current_card_id,))
-        card = cursor.fetchone()
-        if not card:
-            app.logger.warning(f"Card not found: {current_card_id}")
-            return jsonify({"error": "Card not found"}), 404
-        
-        # Card properties to update
-        current_type = card['type']  # Current card type
-        current_queue = card['queue']  # Current queue (e.g., new, learning, review)
-        current_due = card['due']  # Current due date/time
-        current_interval = card['ivl']  # Current interval
-        current_factor = card['factor']  # Current ease factor
-        current_reps = card['reps']  # Review count
-        current_lapses = card['lapses']  # Number of times card was forgotten
-        current_left = card['left']  # Learning steps left
-        
-        # Get collection config for scheduling
-        cursor.execute("SELECT conf, crt FROM col LIMIT 1") # <-- Fetch crt as well
-        col_data = cursor.fetchone()
-        if not col_data:
-            app.logger.error("Collection configuration not found")
-            return jsonify({"error": "Database error occurred during review update"}), 500
-        
-        coll_conf = json.loads(col_data['conf'])
-        collectionCreationTime = col_data['crt'] # <-- Store crt
-        
-        # Get deck-specific configuration 
-        deck_id = card['did']
-        # No need to fetch decks/dconf again if we already have col_data
-        # cursor.execute("SELECT decks, dconf FROM col LIMIT 1")
-        # col_data_deck = cursor.fetchone() # This is redundant
-        # decks_dict = json.loads(col_data_deck['decks'])
-        # dconf_dict = json.loads(col_data_deck['dconf'])
-
-        # Fetch decks and dconf from col table (assuming they exist as TEXT columns)
-        cursor.execute("SELECT decks, dconf FROM col LIMIT 1")
-        deck_config_data = cursor.fetchone()
-        if not deck_config_data:
-             app.logger.error("Decks or Dconf configuration not found in col table")
-             return jsonify({"error": "Database configuration error"}), 500
-
-        decks_dict = json.loads(deck_config_data['decks'])
-        dconf_dict = json.loads(deck_config_data['dconf'])
-        
-        # Get the deck's configuration id
-        deck_conf_id = decks_dict[str(deck_id)].get('conf', 1)  # Default to 1 if not found
-        deck_conf = dconf_dict[str(deck_conf_id)]
-        
-        # Get the configuration settings for the current card state
-        if current_type == 0:  # 0 = new
-            schedule_conf = deck_conf['new']
-        elif current_type == 1:  # 1 = learning
-            schedule_conf = deck_conf['lapse'] if current_queue == 1 else deck_conf['new']
-        elif current_type == 2:  # 2 = review
-            schedule_conf = deck_conf['rev']
-        elif current_type == 3:  # 3 = relearning
-            schedule_conf = deck_conf['lapse']
-        else:
-            schedule_conf = deck_conf['new']  # Default fallback
-        
-        # Anki scheduling algorithm simplified - this is a very simplified version!
-        new_interval = current_interval
-        new_factor = current_factor
-        new_due = current_due
-        new_queue = current_queue
-        new_type = current_type
-        new_left = current_left
-        
-        # Get the current time and calculate day cutoff relative to collection creation
-        now = int(time.time())
-        # today = now // 86400 # Don't use epoch day
-        dayCutoff = (now - collectionCreationTime) // 86400 # <-- Use dayCutoff
-        
-        # Log this review in the revlog table
-        review_id = int(time.time() * 1000)  # Timestamp as ID
-        review_log_type = current_type # Default log type
-        
-        # Calculate new interval based on ease and current state
-        if current_queue == 0:  # New card
-            if ease == 1:  # Again
-                new_queue = 1  # Learning
-                new_type = 1  # Learning
-                new_left = schedule_conf['delays'][0]  # Reset steps
-                new_due = now + (new_left * 60)  # Due in X minutes
-            else:  # Hard, Good, Easy
-                new_queue = 1  # Learning
-                new_type = 1  # Learning
-                step_index = 0 if ease == 2 else 1  # 2=Hard -> first step, 3=Good -> second step
-                if step_index < len(schedule_conf['delays']):
-                    new_left = schedule_conf['delays'][step_index]
-                    new_due = now + (new_left * 60)  # Due in X minutes
-                else:
-                    # Graduate to review
-                    new_queue = 2  # Review
-                    new_type = 2  # Review
-                    new_interval = 1  # 1 day for first review
-                    new_due = dayCutoff + new_interval  # <-- Use dayCutoff
-                    new_left = 0  # No more steps
-        
-        elif current_queue == 1:  # Learning/relearning card
-            if ease == 1:  # Again
-                # Reset to first step
-                new_left = schedule_conf['delays'][0]
-                new_due = now + (new_left * 60)  # Due in X minutes
-            elif ease == 2:  # Hard - stay in same position
-                new_due = now + (current_left * 60)  # Due in same X minutes
-            else:  # Good or Easy
-                if current_left == 0 or ease == 4:  # Last step or marked easy
-                    # Graduate to review
-                    new_queue = 2  # Review
-                    new_type = 2  # Review
-                    new_interval = 1  # 1 day for first review
-                    new_due = dayCutoff + new_interval  # <-- Use dayCutoff
-                    new_left = 0  # No more steps
-                else:
-                    # Move to next step
-                    step_index = 1  # Skip to next step
-                    if step_index < len(schedule_conf['delays']):
-                        new_left = schedule_conf['delays'][step_index]
-                        new_due = now + (new_left * 60)  # Due in X minutes
-                    else:
-                        # Graduate to review
-                        new_queue = 2  # Review
-                        new_type = 2  # Review
-                        new_interval = 1  # 1 day for first review
-                        new_due = dayCutoff + new_interval  # <-- Use dayCutoff
-                        new_left = 0  # No more steps
+        app.logger.info("Processing answer for card %s (note %s) with ease %s", current_card_id, current_note_id, ease)
+        
+        # A failure before commit leaves the transaction open; the pool rolls it back
+        with get_user_db_conn(user_id) as conn:
+            conn.row_factory = sqlite3.Row # Reset by the pool when the connection is returned
+            cursor = conn.cursor()
+            # The card is read, rescheduled and written back under one write lock:
+            # a second answer for the same card (double submit, another worker)
+            # waits and then schedules from this answer's result
+            conn.execute("BEGIN IMMEDIATE")
+        
+            # First, verify the card exists (only the columns the scheduler reads)
+            cursor.execute(SQL_SELECT_CARD_SCHEDULE, (current_card_id,))
+            card_row = cursor.fetchone()
+            if not card_row:
+                app.logger.warning("Card not found: %s", current_card_id)
+                return jsonify({"error": "Card not found"}), 404
+            # The scheduling rules read these fields many times; plain dict lookups
+            # are cheaper than sqlite3.Row's by-name column search
+            card = dict(card_row)
+        
+            # Card properties to update
+            current_type = card['type']  # Current card type
+            current_queue = card['queue']  # Current queue (e.g., new, learning, review)
+            current_interval = card['ivl']  # Current interval
+            current_reps = card['reps']  # Review count
+        
+            # Collection config for scheduling: crt, deck options and decks, all
+            # cached per col.mod (normally no JSON is parsed here)
+            sched_conf = load_sched_conf(conn, user_id)
+            decks_dict = load_decks(conn, user_id)
+            if not sched_conf or not decks_dict:
+                app.logger.error("Collection configuration not found")
+                return jsonify({"error": "Database configuration error"}), 500
+            collectionCreationTime, dconf_dict = sched_conf
+
+            # Get deck-specific configuration
+            deck_id = card['did']
+
+            # Get the deck's configuration id
+            deck_conf_id = decks_dict[str(deck_id)].get('conf', 1)  # Default to 1 if not found
+            deck_conf = dconf_dict[str(deck_conf_id)]
+        
+            # Get the configuration settings for the current card state
+            schedule_conf = schedule_conf_for(deck_conf, current_type, current_queue)
+        
+            # Read the clock once: the revlog id and the card's mod/scheduling share it
+            now_ms = clock_ms()
+            now = now_ms // 1000
+            dayCutoff = (now - collectionCreationTime) // 86400
+
+            # Log this review in the revlog table
+            review_id = now_ms  # Timestamp as ID
+
+            # Anki scheduling algorithm simplified (scheduler.py)
+            result = schedule(card, ease, now, dayCutoff, deck_conf, schedule_conf)
+            new_queue, new_type, new_due, new_interval, new_factor, new_left, final_lapses, review_log_type = result
+
+            # Update the card and commit: the only write of this transaction
+            # (the revlog row and col.mod are buffered, see below)
+            cursor.execute(SQL_UPDATE_CARD_SCHEDULE, (
+                new_type, new_queue, new_due, new_interval, new_factor,
+                current_reps + 1, final_lapses, # Use final_lapses
+                new_left, now, current_card_id
+            ))
+            conn.commit()
+
+            # Enhanced logging for review with state transitions
+            # (skipped entirely, including the note lookup, when INFO is disabled)
+            if app.logger.isEnabledFor(logging.INFO):
+                # Get card front text for logging
+                cursor.execute(SQL_SELECT_NOTE_FIELDS, (current_note_id,))
+                note_data = cursor.fetchone()
+                front_text = "Unknown"
+                if note_data and note_data[0]:
+                    front = note_data[0].partition(FIELD_SEP)[0]
+                    front_text = front[:15] + "..." if len(front) > 15 else front
+
+                # Calculate old and new states
+                old_state = get_card_state(current_type, current_queue, current_interval)
+                new_state = get_card_state(new_type, new_queue, new_interval)
+
+                # Get username for logging
+                username = session.get('username', 'Unknown')
+
+                # Log the review with state transition
+                app.logger.info('User %s (%s) reviewed card %s ("%s") ease=%s: %s → %s',
+                                user_id, username, current_card_id, front_text, ease, old_state, new_state)
+
+            # Log this review (buffered, written in batches)
+            queue_revlog(user_id, (
+                review_id, current_card_id, -1, ease, new_interval, current_interval,
+                new_factor, time_taken, review_log_type # <-- Use calculated review_log_type
+            ))
+
+            # Update collection modification time (written lazily)
+            bump_col_mod(user_id, now_ms)
         
-        elif current_queue == 2:  # Review card
-            if ease == 1:  # Again (fail)
-                # Card lapses, move to relearning
-                new_queue = 1  # Learning (relearning)
-                new_type = 3  # Relearning
-                new_lapses = current_lapses + 1
-                # Correctly access lapse delays from deck_conf
-                lapse_conf = deck_conf.get('lapse', {})
-                lapse_delays = lapse_conf.get('delays', [10]) # Default delay if missing
-                lapse_mult = lapse_conf.get('mult', 0.0) # Lapse interval multiplier
-
-                if len(lapse_delays) > 0:
-                    new_left = lapse_delays[0]
-                    new_due = now + (new_left * 60)
-                    new_interval = 0 # Interval is 0 during learning/relearning steps
-                else:
-                    # No relearning steps defined, reschedule based on lapse multiplier
-                    new_queue = 2  # Stay in review queue
-                    new_type = 2  # Still a review card conceptually
-                    new_interval = max(1, int(current_interval * lapse_mult)) # Apply multiplier
-                    new_due = dayCutoff + new_interval
-                    new_left = 0
-                review_log_type = 2 # Type 2 for relearn/lapse
-            else:  # Hard, Good, Easy
-                # Calculate new interval based on ease button
-                # Get review config safely
-                rev_conf = deck_conf.get('rev', {})
-                hard_factor = rev_conf.get('hardFactor', 1.2)
-                easy_bonus = rev_conf.get('ease4', 1.3) # Called ease4 in Anki JSON
-                interval_factor = rev_conf.get('ivlFct', 1.0) # General interval factor
-
-                if ease == 2:  # Hard
-                    # factor_adjust = 0.8 # This isn't how factor is adjusted
-                    interval_adjust = hard_factor
-                    factor_change = -150 # Anki-like adjustment
-                elif ease == 3:  # Good
-                    # factor_adjust = 1.0 # Replaced
-                    interval_adjust = interval_factor # Use the general interval factor
-                    factor_change = 0 # No change for Good in basic Anki SM2 variant
-                else:  # ease == 4, Easy
-                    # factor_adjust = 1.3 # Replaced
-                    interval_adjust = easy_bonus * interval_factor # Easy bonus applies on top
-                    factor_change = 150 # Anki-like adjustment
-                
-                # Update interval: apply interval factor and specific ease multiplier
-                # The calculation is more complex in real Anki, involving fuzz factor etc.
-                # Simplified: Interval = Previous Interval * Ease Multiplier * General Interval Factor
-                new_interval = max(current_interval + 1, int(current_interval * interval_adjust * interval_factor))
-                
-                # Update ease factor (min 1300)
-                # factor_change = 0 if ease == 2 else 15 if ease == 3 else 30  # Old logic
-                new_factor = max(1300, current_factor + factor_change)
-                
-                # Calculate due date
-                new_due = dayCutoff + new_interval # <-- Use dayCutoff
-                
-                # Keep in review queue
-                new_queue = 2
-                new_type = 2
-                review_log_type = 1 # Type 1 for review success
+            # Clear the current card from the session
+            session.pop('currentCardId', None)
+            session.pop('currentNoteId', None)
         
-        # Final assignment for lapses (only increases on review lapse)
-        final_lapses = current_lapses + (1 if ease == 1 and current_queue == 2 else 0)
+            return jsonify({"message": "Answer processed successfully"}), 200
+    
+    except UserDbNotFoundError:
+        app.logger.error("User database not found for user %s", user_id)
+        return jsonify({"error": "User database not found"}), 404
+    except sqlite3.Error as e:
+        app.logger.exception("Database error during review update: %s", e)
+        return jsonify({"error": "Database error occurred during review update"}), 500
+    except Exception as e:
+        app.logger.exception("Error processing review: %s", e)
+        return jsonify({"error": f"Error processing review: {str(e)}"}), 500
 
-        # Update the card
-        cursor.execute("""
-            UPDATE cards 
-            SET type=?, queue=?, due=?, ivl=?, factor=?, reps=?, lapses=?, left=?, mod=?
-            WHERE id=?
-        """, (
-            new_type, new_queue, new_due, new_interval, new_factor,
-            current_reps + 1, final_lapses, # Use final_lapses
-            new_left, now, current_card_id
-        ))
-        
-        # Log this review
-        cursor.execute("""
-            INSERT INTO revlog (id, cid, usn, ease, ivl, lastIvl, factor, time, type)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            review_id, current_card_id, -1, ease, new_interval, current_interval,
-            new_factor, time_taken, review_log_type # <-- Use calculated review_log_type
-        ))
+MAX_BATCH_ANSWERS = 500 # Upper bound on answers accepted by a single /answer_batch call
 
-        # Enhanced logging for review with state transitions
-        # Get card front text for logging
-        cursor.execute("SELECT flds FROM notes WHERE id = ?", (current_note_id,))
-        note_data = cursor.fetchone()
-        front_text = "Unknown"
-        if note_data and note_data[0]:
-            fields = note_data[0].split('\x1f')
-            front_text = fields[0][:15] + "..." if len(fields[0]) > 15 else fields[0]
+@app.route('/answer_batch', methods=['POST'])
+@login_required
+def answer_batch():
+    """Processes several answers at once (e.g. reviews recorded offline).
+    Expects: {'answers': [{'cardId': ..., 'ease': 1-4, 'timeTaken': milliseconds (optional)}, ...]}.
+    Answers are applied in order, so a card answered twice is scheduled from its
+    first answer's result. All answers are recorded or none are.
+    """
+    user_id = session['user_id']
 
-        # Calculate old and new states
-        old_state = get_card_state(current_type, current_queue, current_interval)
-        new_state = get_card_state(new_type, new_queue, new_interval)
+    data = request.get_json()
+    items = data.get('answers') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "A non-empty list of answers is required"}), 400
+    if len(items) > MAX_BATCH_ANSWERS:
+        return jsonify({"error": f"At most {MAX_BATCH_ANSWERS} answers can be submitted at once"}), 400
+
+    answers = []
+    for item in items:
+        if not isinstance(item, dict):
+            return jsonify({"error": "Each answer must be an object"}), 400
+        card_id = item.get('cardId')
+        ease = item.get('ease')
+        if not isinstance(card_id, int) or isinstance(card_id, bool):
+            return jsonify({"error": "Each answer needs an integer cardId"}), 400
+        if ease not in [1, 2, 3, 4]:
+            return jsonify({"error": "Invalid ease rating (must be 1, 2, 3, or 4)"}), 400
+        time_taken = item.get('timeTaken', 0)
+        if not isinstance(time_taken, int) or isinstance(time_taken, bool) or time_taken < 0:
+            return jsonify({"error": "timeTaken must be a non-negative integer (milliseconds)"}), 400
+        answers.append((card_id, ease, time_taken))
 
-        # Get username for logging
-        username = session.get('username', 'Unknown')
+    try:
+        # Reviews still buffered from /answer are written first, so the log keeps
+        # answer order and the batch's ids start past them
+        flush_revlog(user_id)
+
+        with get_user_db_conn(user_id) as conn:
+            cursor = conn.cursor()
+            # One write lock, one UPDATE batch, one revlog batch and one commit for the lot
+            conn.execute("BEGIN IMMEDIATE")
+
+            card_ids = list(dict.fromkeys(card_id for card_id, _, _ in answers))
+            cursor.execute(SQL_SELECT_CARDS_SCHEDULE.format(", ".join("?" * len(card_ids))), card_ids)
+            cards = {}
+            for row in cursor.fetchall():
+                cards[row[0]] = dict(zip(('type', 'queue', 'due', 'ivl', 'factor', 'reps', 'lapses', 'left', 'did'), row[1:]))
+            missing = [card_id for card_id in card_ids if card_id not in cards]
+            if missing:
+                app.logger.warning("Cards not found in answer batch: %s", missing)
+                return jsonify({"error": f"Card {missing[0]} not found"}), 404
+
+            sched_conf = load_sched_conf(conn, user_id)
+            decks_dict = load_decks(conn, user_id)
+            if not sched_conf or not decks_dict:
+                app.logger.error("Collection configuration not found")
+                return jsonify({"error": "Database configuration error"}), 500
+            collectionCreationTime, dconf_dict = sched_conf
+
+            # Read the clock once; revlog ids count up from it, one millisecond per
+            # answer, past any review logged or buffered meanwhile (assign_revlog_ids
+            # below moves them past the ones already written)
+            now_ms = clock_ms()
+            now = now_ms // 1000
+            dayCutoff = (now - collectionCreationTime) // 86400
+            first_review_id = max([now_ms] + [row[0] + 1 for row in pending_revlog(user_id)])
+
+            deck_confs = {}
+            revlog_rows = []
+            for offset, (card_id, ease, time_taken) in enumerate(answers):
+                card = cards[card_id]
+                deck_conf = deck_confs.get(card['did'])
+                if deck_conf is None:
+                    deck_conf_id = decks_dict[str(card['did'])].get('conf', 1)  # Default to 1 if not found
+                    deck_conf = deck_confs[card['did']] = dconf_dict[str(deck_conf_id)]
+                schedule_conf = schedule_conf_for(deck_conf, card['type'], card['queue'])
+                result = schedule(card, ease, now, dayCutoff, deck_conf, schedule_conf)
+                revlog_rows.append((
+                    first_review_id + offset, card_id, -1, ease, result.ivl, card['ivl'],
+                    result.factor, time_taken, result.log_type
+                ))
+                card.update(type=result.type, queue=result.queue, due=result.due, ivl=result.ivl,
+                            factor=result.factor, left=result.left, lapses=result.lapses, reps=card['reps'] + 1)
+
+            # Only each card's final state is written
+            cursor.executemany(SQL_UPDATE_CARD_SCHEDULE, [
+                (card['type'], card['queue'], card['due'], card['ivl'], card['factor'],
+                 card['reps'], card['lapses'], card['left'], now, card_id)
+                for card_id, card in cards.items()
+            ])
+            cursor.executemany(SQL_INSERT_REVLOG, assign_revlog_ids(conn, revlog_rows))
+            conn.commit()
 
-        # Log the review with state transition
-        app.logger.info(f"User {user_id} ({username}) reviewed card {current_card_id} (\"{front_text}\") ease={ease}: {old_state} → {new_state}")
+        # Update collection modification time (written lazily)
+        bump_col_mod(user_id, now_ms)
 
-        # Update collection modification time
-        cursor.execute("UPDATE col SET mod = ?", (int(time.time() * 1000),))
+        # The card on screen may have been answered by the batch
+        if session.get('currentCardId') in cards:
+            session.pop('currentCardId', None)
+            session.pop('currentNoteId', None)
 
-        # Commit the changes
-        conn.commit()
-        
-        # Clear the current card from the session
-        session.pop('currentCardId', None)
-        session.pop('currentNoteId', None)
-        
-        return jsonify({"message": "Answer processed successfully"}), 200
-    
+        username = session.get('username', 'Unknown')
+        app.logger.info("User %s (%s) submitted %d answers for %d cards", user_id, username, len(answers), len(cards))
+
+        return jsonify({"message": f"{len(answers)} answers processed successfully"}), 200
+
+    except UserDbNotFoundError:
+        app.logger.error("User database not found for user %s", user_id)
+        return jsonify({"error": "User database not found"}), 404
     except sqlite3.Error as e:
-        app.logger.exception(f"Database error during review update: {e}")
-        if conn:
-            conn.rollback()
+        app.logger.exception("Database error during batch review update: %s", e)
         return jsonify({"error": "Database error occurred during review update"}), 500
     except Exception as e:
-        app.logger.exception(f"Error processing review: {e}")
-        if conn:
-            conn.rollback()
+        app.logger.exception("Error processing review batch: %s", e)
         return jsonify({"error": f"Error processing review: {str(e)}"}), 500
-    finally:
-        if conn:
-            conn.close()
 
 # --- APKG Export Logic ---
 @app.route('/export', methods=['GET'])
@@ -1787,167 +2611,244 @@ def answer_card():
 def export_deck():
     user_id = session['user_id']
     username = session.get('username', 'user') # Get username for filename
-    user_db_path = get_user_db_path(user_id)
 
-    if not os.path.exists(user_db_path):
-        return jsonify({"error": "User database not found."}), 404
+    # The exported collection must carry the latest col.mod and review history
+    flush_col_mod(user_id)
+    flush_revlog(user_id)
 
-    temp_dir = None
-    apkg_path = None
     try:
-        # Create a temporary directory for staging the APKG contents
-        temp_dir = tempfile.mkdtemp()
-        app.logger.info(f"Created temporary directory for export: {temp_dir}") # Use logger
-
-        # 1. Copy the user's database to the temp dir as collection.anki2
-        anki2_path = os.path.join(temp_dir, 'collection.anki2')
-        shutil.copy2(user_db_path, anki2_path) # copy2 preserves metadata
-        app.logger.info(f"Copied user DB to {anki2_path}") # Use logger
-
-        # 2. Create the media file (required by Anki, even if empty)
-        media_path = os.path.join(temp_dir, 'media')
-        with open(media_path, 'w') as f:
-            json.dump({}, f) # Empty JSON object for no media
-        app.logger.info(f"Created empty media file at {media_path}") # Use logger
-
-        # 3. Create the APKG zip file
+        # 1. Snapshot the user's database into memory as a plain collection file
+        # (SQLite backup: consistent, includes pages still in the WAL file, and
+        # needs no temporary files)
+        with get_user_db_conn(user_id) as conn:
+            collection = _export_collection_image(conn)
+        app.logger.info("Copied user DB for export (%s bytes)", len(collection)) # Use logger
+
+        # 2. Stream the APKG zip to the user as it is compressed (no APKG file is written)
         timestamp = time.strftime("%Y%m%d_%H%M%S")
         apkg_filename = f"{username}_export_{timestamp}.apkg"
-        apkg_path = os.path.join(EXPORT_DIR, apkg_filename)
-
-        # Ensure export directory exists
-        if not os.path.exists(EXPORT_DIR):
-            os.makedirs(EXPORT_DIR)
-            app.logger.info(f"Created export directory: {EXPORT_DIR}")
-
-        with zipfile.ZipFile(apkg_path, 'w', zipfile.ZIP_DEFLATED) as zf:
-            zf.write(anki2_path, arcname='collection.anki2')
-            zf.write(media_path, arcname='media')
-        app.logger.info(f"Created APKG file at {apkg_path}") # Use logger
-
-        # 4. Send the file to the user
+        apkg_stream = io.BufferedReader(_ChunkReader(_iter_apkg_chunks(collection)),
+                                        buffer_size=EXPORT_CHUNK_SIZE)
         return send_file(
-            apkg_path,
+            apkg_stream,
             as_attachment=True,
             download_name=apkg_filename,
             mimetype='application/zip' # Standard mimetype for zip/apkg
         )
 
+    except UserDbNotFoundError:
+        # Raised by the pooled open (mode=rw), so the common case pays no stat()
+        return jsonify({"error": "User database not found."}), 404
     except Exception as e:
-        app.logger.exception(f"Error during APKG export for user {user_id}: {e}") # Use logger.exception
-        # Clean up temporary directory if it exists, even on error
-        if temp_dir and os.path.exists(temp_dir):
-            try:
-                shutil.rmtree(temp_dir)
-                app.logger.info(f"Cleaned up temporary directory: {temp_dir}") # Use logger
-            except Exception as cleanup_err:
-                app.logger.error(f"Error cleaning up temp directory {temp_dir}: {cleanup_err}") # Use logger
-        # Clean up partial apkg file if it exists
-        if apkg_path and os.path.exists(apkg_path):
-             try:
-                 os.remove(apkg_path)
-                 app.logger.info(f"Cleaned up partial APKG file: {apkg_path}") # Use logger
-             except Exception as cleanup_err:
-                 app.logger.error(f"Error cleaning up APKG file {apkg_path}: {cleanup_err}") # Use logger
-
+        app.logger.exception("Error during APKG export for user %s: %s", user_id, e) # Use logger.exception
         return jsonify({"error": "Failed to generate export file."}), 500
+
+class _ZipSink(io.RawIOBase):
+    """Write-only, unseekable file that collects what ZipFile writes until take()."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+class _ChunkReader(io.RawIOBase):
+    """Readable file over an iterator of bytes chunks; closing it closes the iterator."""
+
+    def __init__(self, chunks):
+        super().__init__()
+        self._chunks = chunks
+        self._pending = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._pending:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = memoryview(chunk)
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._chunks.close()
+        super().close()
+
+def _iter_apkg_chunks(collection):
+    """Yields the APKG zip of a collection file image piece by piece.
+
+    ZipFile writes to an unseekable sink, so entry sizes go into data descriptors
+    and nothing has to be rewritten; the tiny media manifest (required by Anki,
+    even if empty) is stored uncompressed.
+    """
+    sink = _ZipSink()
+    view = memoryview(collection)
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED, compresslevel=EXPORT_COMPRESS_LEVEL) as zf:
+        with zf.open('collection.anki2', 'w') as dst:
+            for offset in range(0, len(view), EXPORT_CHUNK_SIZE):
+                dst.write(view[offset:offset + EXPORT_CHUNK_SIZE])
+                data = sink.take()
+                if data:
+                    yield data
+        zf.writestr('media', '{}', compress_type=zipfile.ZIP_STORED) # Empty JSON object for no media
+    yield sink.take()
+
+def _export_collection_image(conn):
+    """Returns the bytes of a plain Anki collection file copied from a user DB connection.
+
+    The copy is made with the backup API, in memory where sqlite3 can serialize
+    (else in a temporary file); the server-private tables, triggers and indexes
+    are dropped from it and its header is switched back to the default rollback
+    journal, so the file is self-contained without a -wal companion.
+    """
+    tmp_path = None
+    if SQLITE_HAS_SERIALIZE:
+        export_conn = sqlite3.connect(':memory:')
+    else:
+        fd, tmp_path = tempfile.mkstemp(suffix='.anki2')
+        os.close(fd)
+        export_conn = sqlite3.connect(tmp_path)
+    try:
+        conn.backup(export_conn)
+        for trigger in SERVER_PRIVATE_TRIGGERS:
+            export_conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        for index in SERVER_PRIVATE_INDEXES:
+            export_conn.execute(f"DROP INDEX IF EXISTS {index}")
+        for table in SERVER_PRIVATE_TABLES:
+            export_conn.execute(f"DROP TABLE IF EXISTS {table}")
+        export_conn.commit()
+        if tmp_path is None:
+            image = bytearray(export_conn.serialize())
+        else:
+            export_conn.execute("PRAGMA journal_mode = DELETE") # Checkpoints the copy into the file
+            export_conn.close()
+            with open(tmp_path, 'rb') as f:
+                image = bytearray(f.read())
     finally:
-        # Clean up the temporary directory after sending or on error (if not already done)
-        if temp_dir and os.path.exists(temp_dir):
-            try:
-                shutil.rmtree(temp_dir)
-                app.logger.info(f"Cleaned up temporary directory after request: {temp_dir}") # Use logger
-            except Exception as cleanup_err:
-                app.logger.error(f"Error cleaning up temp directory {temp_dir} in finally block: {cleanup_err}") # Use logger
-        # Clean up the created APKG file from the server *after* sending is complete
-        # Note: Flask's send_file typically handles this if using TemporaryFile,
-        # but since we save it first, we clean it up manually. Be careful with background tasks.
-        # For simplicity here, we assume sync processing and clean up immediately.
-        # In a production scenario, might need a background job for cleanup.
-        if apkg_path and os.path.exists(apkg_path):
-             try:
-                 # This might be too soon if send_file is async in some setups,
-                 # but usually okay for standard Flask development server.
-                 # Consider adding a small delay or using Flask's after_request handler.
-                 # time.sleep(1) # Small delay as a simple precaution
-                 os.remove(apkg_path)
-                 app.logger.info(f"Cleaned up APKG file after request: {apkg_path}") # Use logger
-             except Exception as cleanup_err:
-                 app.logger.error(f"Error cleaning up APKG file {apkg_path} in finally block: {cleanup_err}") # Use logger
+        export_conn.close()
+        if tmp_path is not None:
+            for leftover in (tmp_path, f"{tmp_path}-wal", f"{tmp_path}-shm"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+    # An in-memory database cannot change journal mode; write the header's file
+    # format read/write versions directly (1 = rollback journal, 2 = WAL)
+    image[18:20] = b"\x01\x01"
+    return image
 
 # --- Add Card Logic ---
-@app.route('/add_card', methods=['POST'])
-@login_required
-def add_new_card():
-    user_id = session['user_id']
-    user_db_path = get_user_db_path(user_id)
+MAX_BULK_CARDS = 500 # Upper bound on cards accepted by a single /add_cards call
 
-    data = request.get_json()
-    front = data.get('front')
-    back = data.get('back')
+def _insert_new_cards(cursor, model_id, deck_id, cards, current_time_ms):
+    """Inserts (front, back) pairs as new notes and cards with one executemany each.
 
-    if not front or not back:
-        return jsonify({"error": "Front and back content cannot be empty"}), 400
+    Note ids take [base, base + n) and card ids [base + n, base + 2n), where base is
+    the current time in ms pushed past the largest existing id, so ids stay unique
+    and increasing even when several adds land in the same millisecond.
+    Returns the list of (note_id, card_id) pairs.
+    """
+    current_time_sec = current_time_ms // 1000
+    cursor.execute("SELECT MAX(IFNULL((SELECT MAX(id) FROM notes), 0), IFNULL((SELECT MAX(id) FROM cards), 0))")
+    base_id = max(current_time_ms, cursor.fetchone()[0] + 1)
+    count = len(cards)
+
+    notes_rows = []
+    cards_rows = []
+    for i, (front, back) in enumerate(cards):
+        note_id = base_id + i
+        card_id = base_id + count + i
+        guid = uuid.uuid4().hex[:10] # Unique ID for sync
+        fields = f"{front}{FIELD_SEP}{back}"
+        checksum = field_checksum(front) # Checksum of the first field
+        notes_rows.append((
+            note_id, guid, model_id, current_time_sec, "",
+            fields, front, checksum
+        ))
+        cards_rows.append((card_id, note_id, deck_id, current_time_sec, note_id)) # due = note id for new cards
 
-    conn = None
-    try:
-        conn = sqlite3.connect(user_db_path)
+    cursor.executemany(SQL_INSERT_NEW_NOTE, notes_rows)
+    cursor.executemany(SQL_INSERT_NEW_CARD, cards_rows)
+    return [(note_row[0], card_row[0]) for note_row, card_row in zip(notes_rows, cards_rows)]
+
+def _add_cards_to_current_deck(user_id, cards):
+    """Adds (front, back) pairs to the user's current deck in a single transaction.
+
+    Returns (deck_id, deck_name, [(note_id, card_id), ...]).
+    Raises ValueError if the collection configuration is missing or invalid.
+    """
+    with get_user_db_conn(user_id) as conn:
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
+        # Read the config and insert under one write lock (rolled back by the pool on error)
+        conn.execute("BEGIN IMMEDIATE")
+
+        # Get current model ID, current deck ID and deck name in one read
+        if SQLITE_HAS_JSON:
+            # Let SQLite pull the three values out of the JSON columns
+            cursor.execute(SQL_SELECT_ADD_CARD_CONTEXT)
+            col_data = cursor.fetchone()
+            if not col_data or not col_data['has_config']:
+                raise ValueError("Collection configuration not found or invalid")
+            model_id = col_data['model_id']
+            current_deck_id = col_data['cur_deck']
+            deck_name = col_data['deck_name']
+        else:
+            cursor.execute("SELECT models, conf, decks FROM col LIMIT 1")
+            col_data = cursor.fetchone()
+            if not col_data or not col_data['models'] or not col_data['conf']:
+                raise ValueError("Collection configuration not found or invalid")
 
-        # Get current model ID and current deck ID
-        cursor.execute("SELECT models, conf FROM col LIMIT 1")
-        col_data = cursor.fetchone()
-        if not col_data or not col_data['models'] or not col_data['conf']:
-            return jsonify({"error": "Collection configuration not found or invalid"}), 500
+            # Only the first model's id is needed: skip decoding templates and CSS
+            model_id = json_first_key(col_data['models'])
+            conf_dict = json_loads(col_data['conf'])
+            current_deck_id = conf_dict.get('curDeck', 1) # Get current deck ID
 
-        models = json.loads(col_data['models'])
-        conf_dict = json.loads(col_data['conf'])
-        model_id = next(iter(models), None)
-        current_deck_id = conf_dict.get('curDeck', 1) # Get current deck ID
+            deck_name = "Unknown"
+            if col_data['decks']:
+                decks_dict = json_loads(col_data['decks'])
+                deck_name = decks_dict.get(str(current_deck_id), {}).get('name', 'Unknown')
 
         if not model_id:
-             return jsonify({"error": "Default note model not found in collection"}), 500
+            raise ValueError("Default note model not found in collection")
 
-        # deck_id = 1 # No longer assume deck 1
+        # Read the clock once so note/card ids and every mod field agree
+        current_time_ms = clock_ms()
+        ids = _insert_new_cards(cursor, model_id, current_deck_id, cards, current_time_ms)
+        conn.commit()
 
-        # --- Generate New Note/Card Data --- #
-        current_time_sec = int(time.time())
-        current_time_ms = int(current_time_sec * 1000)
-        note_id = current_time_ms # Use timestamp for unique Note ID
-        card_id = note_id + 1 # Simple unique Card ID
-        guid = str(uuid.uuid4())[:10] # Unique ID for sync
-        fields = f"{front}\x1f{back}" # Fields separated by 0x1f
-        checksum = sha1_checksum(front) # Checksum of the first field
-        usn = -1 # Update Sequence Number (-1 indicates local change)
+    # --- Update Collection Mod Time (written lazily) --- #
+    bump_col_mod(user_id, current_time_ms)
+    return current_deck_id, deck_name, ids
 
-        # --- Insert Note --- #
-        cursor.execute("""
-            INSERT INTO notes (id, guid, mid, mod, usn, tags, flds, sfld, csum, flags, data)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            note_id, guid, model_id, current_time_sec, usn, "",
-            fields, front, int(checksum, 16) & 0xFFFFFFFF, 0, ""
-        ))
-        app.logger.info(f"Inserted note {note_id} for user {user_id}") # Use logger
+@app.route('/add_card', methods=['POST'])
+@login_required
+def add_new_card():
+    user_id = session['user_id']
 
-        # --- Insert Card (assign to current_deck_id) --- #
-        cursor.execute("""
-            INSERT INTO cards (id, nid, did, ord, mod, usn, type, queue, due, ivl, factor, reps, lapses, left, odue, odid, flags, data)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            card_id, note_id, current_deck_id, 0, # <<< Use current_deck_id for did
-            current_time_sec, usn,
-            0, 0, note_id, # type, queue, due
-            0, 2500, 0, 0, 0, 0, 0, 0, "" # ivl, factor, reps, lapses, left, odue, odid, flags, data
-        ))
-        # Get deck name for enhanced logging
-        cursor.execute("SELECT decks FROM col LIMIT 1")
-        decks_data = cursor.fetchone()
-        deck_name = "Unknown"
-        if decks_data and decks_data['decks']:
-            decks_dict = json.loads(decks_data['decks'])
-            deck_name = decks_dict.get(str(current_deck_id), {}).get('name', 'Unknown')
+    data = request.get_json()
+    front = data.get('front')
+    back = data.get('back')
+
+    if not front or not back:
+        return jsonify({"error": "Front and back content cannot be empty"}), 400
+
+    try:
+        current_deck_id, deck_name, ids = _add_cards_to_current_deck(user_id, [(front, back)])
+        note_id, card_id = ids[0]
 
         # Get username for logging
         username = session.get('username', 'Unknown')
@@ -1956,25 +2857,69 @@ def add_new_card():
         front_truncated = front[:15] + "..." if len(front) > 15 else front
 
         # Enhanced logging with full context
-        app.logger.info(f"User {user_id} ({username}) created card {card_id} in deck {current_deck_id} ({deck_name}): \"{front_truncated}\"")
-
-        # --- Update Collection Mod Time --- #
-        cursor.execute("UPDATE col SET mod = ?", (int(time.time() * 1000),))
-        conn.commit()
+        app.logger.info('User %s (%s) created card %s in deck %s (%s): "%s"',
+                        user_id, username, card_id, current_deck_id, deck_name, front_truncated)
 
         return jsonify({"message": "Card added successfully", "note_id": note_id, "card_id": card_id}), 201
 
+    except UserDbNotFoundError:
+        app.logger.error("User database not found for user %s", user_id)
+        return jsonify({"error": "User database not found"}), 404
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 500
     except sqlite3.Error as e:
-        app.logger.error(f"Database error adding card for user {user_id}: {e}") # Use logger
-        if conn: conn.rollback()
+        app.logger.error("Database error adding card for user %s: %s", user_id, e) # Use logger
         return jsonify({"error": "Database error occurred while adding card"}), 500
     except Exception as e:
-        app.logger.exception(f"Error adding card for user {user_id}: {e}") # Use logger.exception
-        if conn: conn.rollback()
+        app.logger.exception("Error adding card for user %s: %s", user_id, e) # Use logger.exception
+        return jsonify({"error": "An internal server error occurred"}), 500
+
+@app.route('/add_cards', methods=['POST'])
+@login_required
+def add_new_cards():
+    """Adds several cards to the current deck in one transaction.
+    Expects: {'cards': [{'front': ..., 'back': ...}, ...]} in the request body.
+    """
+    user_id = session['user_id']
+
+    data = request.get_json()
+    items = data.get('cards') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "A non-empty list of cards is required"}), 400
+    if len(items) > MAX_BULK_CARDS:
+        return jsonify({"error": f"At most {MAX_BULK_CARDS} cards can be added at once"}), 400
+
+    cards = []
+    for item in items:
+        front = item.get('front') if isinstance(item, dict) else None
+        back = item.get('back') if isinstance(item, dict) else None
+        if not front or not back:
+            return jsonify({"error": "Front and back content cannot be empty"}), 400
+        cards.append((front, back))
+
+    try:
+        current_deck_id, deck_name, ids = _add_cards_to_current_deck(user_id, cards)
+
+        username = session.get('username', 'Unknown')
+        app.logger.info("User %s (%s) created %s cards in deck %s (%s)",
+                        user_id, username, len(ids), current_deck_id, deck_name)
+
+        return jsonify({
+            "message": f"{len(ids)} cards added successfully",
+            "cards": [{"note_id": note_id, "card_id": card_id} for note_id, card_id in ids]
+        }), 201
+
+    except UserDbNotFoundError:
+        app.logger.error("User database not found for user %s", user_id)
+        return jsonify({"error": "User database not found"}), 404
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 500
+    except sqlite3.Error as e:
+        app.logger.error("Database error adding cards for user %s: %s", user_id, e)
+        return jsonify({"error": "Database error occurred while adding cards"}), 500
+    except Exception as e:
+        app.logger.exception("Error adding cards for user %s: %s", user_id, e)
         return jsonify({"error": "An internal server error occurred"}), 500
-    finally:
-        if conn:
-            conn.close()
 
 # --- Deck Management API ---
 
@@ -1983,38 +2928,27 @@ def add_new_card():
 def get_decks():
     """Fetches the list of decks for the current user."""
     user_id = session['user_id']
-    user_db_path = get_user_db_path(user_id)
-    conn = None
     try:
-        conn = sqlite3.connect(user_db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT decks FROM col LIMIT 1")
-        col_data = cursor.fetchone()
-        if not col_data or not col_data['decks']:
+        with get_user_db_conn(user_id) as conn:
+            # List of objects expected by frontend, sorted by name; built once per col.mod
+            decks_list = load_deck_list(conn, user_id)
+        if not decks_list:
             return jsonify({"error": "Collection data not found or invalid"}), 500
 
-        decks_dict = json.loads(col_data['decks'])
-        # Convert dictionary to list of objects expected by frontend
-        decks_list = [{"id": k, "name": v["name"]} for k, v in decks_dict.items()]
-        # Sort by name for consistency
-        decks_list.sort(key=lambda x: x["name"])
-
         return jsonify(decks_list), 200
 
+    except UserDbNotFoundError:
+        app.logger.error("User database not found for user %s", user_id)
+        return jsonify({"error": "User database not found"}), 404
     except Exception as e:
-        app.logger.exception(f"Error fetching decks for user {user_id}: {e}") # Use logger.exception
+        app.logger.exception("Error fetching decks for user %s: %s", user_id, e) # Use logger.exception
         return jsonify({"error": "Failed to fetch decks"}), 500
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/decks', methods=['POST'])
 @login_required
 def create_deck():
     """Creates a new deck for the current user."""
     user_id = session['user_id']
-    user_db_path = get_user_db_path(user_id)
 
     data = request.get_json()
     deck_name = data.get('name')
@@ -2022,141 +2956,129 @@ def create_deck():
         return jsonify({"error": "Deck name cannot be empty"}), 400
     deck_name = deck_name.strip()
 
-    conn = None
     try:
-        conn = sqlite3.connect(user_db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        with get_user_db_conn(user_id) as conn:
+            # Hold the write lock across the read-modify-write of the decks JSON
+            conn.execute("BEGIN IMMEDIATE")
 
-        # Fetch current decks and dconf
-        cursor.execute("SELECT decks, dconf FROM col LIMIT 1")
-        col_data = cursor.fetchone()
-        if not col_data:
-            return jsonify({"error": "Collection data not found"}), 500
-
-        decks_dict = json.loads(col_data['decks'])
-        dconf_dict = json.loads(col_data['dconf'])
-
-        # Generate new deck ID (using epoch ms)
-        new_deck_id = str(int(time.time() * 1000))
-
-        # Check for duplicate name (case-insensitive)
-        if any(d['name'].lower() == deck_name.lower() for d in decks_dict.values()):
-            return jsonify({"error": "A deck with this name already exists"}), 409
-
-        # Create new deck entry - using dconf ID '1' for simplicity for now
-        new_deck = {
-            "id": new_deck_id,
-            "name": deck_name,
-            "mod": int(time.time()),
-            "usn": -1,
-            "lrnToday": [0, 0], "revToday": [0, 0], "newToday": [0, 0],
-            "timeToday": [0, 0], "conf": 1, # Use default dconf '1'
-            "desc": "", "dyn": 0, "collapsed": False,
-            "extendNew": 10, "extendRev": 50
-        }
-        decks_dict[new_deck_id] = new_deck
+            # Fetch current decks
+            decks_dict = load_decks(conn, user_id)
+            if decks_dict is None:
+                return jsonify({"error": "Collection data not found"}), 500
 
-        # Update col table
-        current_mod_time = int(time.time() * 1000)
-        cursor.execute("UPDATE col SET decks = ?, mod = ?",
-                       (json.dumps(decks_dict), current_mod_time))
-        conn.commit()
+            # Read the clock once: the deck id, deck mod and col mod all derive from it
+            current_mod_time = clock_ms()
+
+            # Generate new deck ID (using epoch ms, kept above every existing deck id)
+            max_deck_id = conn.execute("SELECT MAX(id) FROM decks_index").fetchone()[0] or 0
+            new_deck_id = str(max(current_mod_time, max_deck_id + 1))
+
+            # Add to decks_index; its unique name_key rejects a duplicate name (case-insensitive)
+            try:
+                conn.execute(SQL_INSERT_DECK_INDEX, (int(new_deck_id), deck_name, deck_name.lower()))
+            except sqlite3.IntegrityError:
+                return jsonify({"error": "A deck with this name already exists"}), 409
+
+            # Create new deck entry - using dconf ID '1' for simplicity for now
+            new_deck = {
+                "id": new_deck_id,
+                "name": deck_name,
+                "mod": current_mod_time // 1000,
+                "usn": -1,
+                "lrnToday": [0, 0], "revToday": [0, 0], "newToday": [0, 0],
+                "timeToday": [0, 0], "conf": 1, # Use default dconf '1'
+                "desc": "", "dyn": 0, "collapsed": False,
+                "extendNew": 10, "extendRev": 50
+            }
+            decks_dict = dict(decks_dict) # The cached dict is shared
+            decks_dict[new_deck_id] = new_deck
+
+            # Update col table
+            save_decks(conn, user_id, decks_dict, current_mod_time)
+            conn.commit()
 
-        app.logger.info(f"Created new deck '{deck_name}' (ID: {new_deck_id}) for user {user_id}") # Use logger
+        app.logger.info("Created new deck '%s' (ID: %s) for user %s", deck_name, new_deck_id, user_id) # Use logger
         return jsonify({"id": new_deck_id, "name": deck_name}), 201
 
     except Exception as e:
-        app.logger.exception(f"Error creating deck for user {user_id}: {e}") # Use logger.exception
-        if conn: conn.rollback()
+        app.logger.exception("Error creating deck for user %s: %s", user_id, e) # Use logger.exception
         return jsonify({"error": "Failed to create deck"}), 500
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/decks/current', methods=['PUT'])
 @login_required
 def set_current_deck():
     """Sets the current deck for the user."""
     user_id = session['user_id']
-    user_db_path = get_user_db_path(user_id)
 
     data = request.get_json()
     deck_id = data.get('deckId') # Expecting deckId parameter in camelCase
     if deck_id is None:
         return jsonify({"error": "Missing deckId"}), 400
 
-    conn = None
     try:
-        conn = sqlite3.connect(user_db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-
-        # Fetch current config and decks to validate deck_id
-        cursor.execute("SELECT conf, decks FROM col LIMIT 1")
-        col_data = cursor.fetchone()
-        if not col_data:
-            return jsonify({"error": "Collection data not found"}), 500
-
-        conf_dict = json.loads(col_data['conf'])
-        decks_dict = json.loads(col_data['decks'])
-
-        # Validate deck ID exists
-        if str(deck_id) not in decks_dict:
-            return jsonify({"error": "Invalid deck ID"}), 404
-
-        # Update current deck ID in conf
-        conf_dict['curDeck'] = int(deck_id) # Store as integer
-
-        # Update col table
-        current_mod_time = int(time.time() * 1000)
-        cursor.execute("UPDATE col SET conf = ?, mod = ?",
-                       (json.dumps(conf_dict), current_mod_time))
-        conn.commit()
+        with get_user_db_conn(user_id) as conn:
+            # Hold the write lock across the read-modify-write of the conf JSON
+            conn.execute("BEGIN IMMEDIATE")
+
+            # Validate deck_id against the (cached) decks
+            decks_dict = load_decks(conn, user_id)
+            if decks_dict is None:
+                return jsonify({"error": "Collection data not found"}), 500
+            if str(deck_id) not in decks_dict:
+                return jsonify({"error": "Invalid deck ID"}), 404
+
+            # Update current deck ID in conf (stored as integer); the write bumps
+            # decks_bin.conf_mod, which keys the config cache
+            current_mod_time = clock_ms()
+            if SQLITE_HAS_JSON:
+                # Patch the one key in place instead of a json round trip of conf
+                conn.execute("UPDATE col SET conf = json_set(conf, '$.curDeck', ?), mod = MAX(mod + 1, ?)",
+                             (int(deck_id), current_mod_time))
+            else:
+                conf_dict = json_loads(conn.execute("SELECT conf FROM col LIMIT 1").fetchone()[0])
+                conf_dict['curDeck'] = int(deck_id)
+                conn.execute("UPDATE col SET conf = ?, mod = MAX(mod + 1, ?)",
+                             (json_dumps(conf_dict), current_mod_time))
+            conn.commit()
+        discard_col_conf(user_id)
 
-        app.logger.info(f"Set current deck to {deck_id} for user {user_id}") # Use logger
+        app.logger.info("Set current deck to %s for user %s", deck_id, user_id) # Use logger
         return jsonify({"message": "Current deck updated successfully"}), 200
 
+    except UserDbNotFoundError:
+        app.logger.error("User database not found for user %s", user_id)
+        return jsonify({"error": "User database not found"}), 404
     except Exception as e:
-        app.logger.exception(f"Error setting current deck for user {user_id}: {e}") # Use logger.exception
-        if conn: conn.rollback()
+        app.logger.exception("Error setting current deck for user %s: %s", user_id, e) # Use logger.exception
         return jsonify({"error": "Failed to set current deck"}), 500
-    finally:
-        if conn:
-            conn.close()
+
+# Stats bucket of every queue except review (2), which is split into Young/Mature
+STATS_QUEUE_BUCKETS = {0: "New", 1: "Learning", 3: "Relearning", -1: "Suspended", -2: "Buried", -3: "Buried"}
 
 @app.route('/decks/<int:deckId>/stats', methods=['GET'])
 @login_required
 def get_deck_stats(deckId):
     """Calculates and returns CURRENT card status counts for a specific deck."""
     user_id = session['user_id']
-    user_db_path = get_user_db_path(user_id)
     # Timeframe parameter is ignored
     # timeframe = request.args.get('timeframe', 'today') 
 
     # Remove timestamp calculation
     # start_timestamp_ms = ... 
 
-    app.logger.debug(f"Deck stats requested for deck: {deckId}") # Simplified log
+    app.logger.debug("Deck stats requested for deck: %s", deckId) # Simplified log
 
-    conn = None
     try:
-        conn = sqlite3.connect(user_db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        with get_user_db_conn(user_id) as conn:
+            # Verify deck exists (as before, against the cached decks)
+            decks_dict = load_decks(conn, user_id)
+            if not decks_dict:
+                 return jsonify({"error": "Collection data not found."}), 500
+            if str(deckId) not in decks_dict:
+                 return jsonify({"error": "Deck not found or access denied."}), 404
 
-        # Verify deck exists (as before)
-        cursor.execute("SELECT decks FROM col LIMIT 1")
-        col_data = cursor.fetchone()
-        if not col_data or not col_data['decks']:
-             return jsonify({"error": "Collection data not found."}), 500
-        decks_dict = json.loads(col_data['decks'])
-        if str(deckId) not in decks_dict:
-             return jsonify({"error": "Deck not found or access denied."}), 404
-
-        # Query cards for the specific deck - id no longer needed for filtering New
-        cursor.execute("SELECT queue, ivl FROM cards WHERE did = ?", (deckId,))
-        cards = cursor.fetchall()
+            # SQLite counts the deck's cards per queue; only those few rows come back
+            queue_counts = conn.execute(SQL_COUNT_DECK_CARDS_BY_QUEUE, (deckId,)).fetchall()
 
         counts = {
             "New": 0, "Learning": 0, "Relearning": 0,
@@ -2164,27 +3086,15 @@ def get_deck_stats(deckId):
         }
         total_cards = 0
 
-        for card in cards:
-            total_cards += 1
-            queue = card['queue']
-            ivl = card['ivl']
-            # card_creation_ms = card['id'] # No longer needed
-
-            if queue == 0:
-                counts["New"] += 1 # Count ALL new cards
-            elif queue == 1:
-                counts["Learning"] += 1
-            elif queue == 3:
-                counts["Relearning"] += 1
-            elif queue == 2:
-                if ivl >= 21:
-                    counts["Mature"] += 1
-                else:
-                    counts["Young"] += 1
-            elif queue == -1:
-                counts["Suspended"] += 1
-            elif queue == -2 or queue == -3:
-                counts["Buried"] += 1
+        for queue, count, mature in queue_counts:
+            total_cards += count
+            if queue == 2:
+                counts["Mature"] += mature
+                counts["Young"] += count - mature
+            else:
+                bucket = STATS_QUEUE_BUCKETS.get(queue)
+                if bucket:
+                    counts[bucket] += count
 
         response_data = {
             "counts": counts,
@@ -2194,63 +3104,62 @@ def get_deck_stats(deckId):
 
         return jsonify(response_data), 200
 
+    except UserDbNotFoundError:
+        app.logger.error("User database not found for user %s", user_id)
+        return jsonify({"error": "User database not found"}), 404
     except sqlite3.Error as e:
-        app.logger.error(f"Database error fetching stats for deck {deckId}, user {user_id}: {e}")
+        app.logger.error("Database error fetching stats for deck %s, user %s: %s", deckId, user_id, e)
         return jsonify({"error": "Database error occurred while fetching statistics."}), 500
     except Exception as e:
-        app.logger.exception(f"Error fetching stats for deck {deckId}, user {user_id}: {e}")
+        app.logger.exception("Error fetching stats for deck %s, user %s: %s", deckId, user_id, e)
         return jsonify({"error": "An internal server error occurred"}), 500
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/cards/<cardId>', methods=['GET'])
 @login_required
 def get_card(cardId):
     user_id = session['user_id']
-    db_path = get_user_db_path(user_id)
-    
-    # Check if user's database exists
-    if not os.path.exists(db_path):
-        app.logger.error(f"Database not found for user {user_id}")
-        return jsonify({"error": "User database not found"}), 404
     
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
+        with get_user_db_conn(user_id) as conn:
+            # Query to get the card details
+            result = conn.execute(SQL_SELECT_CARD_FIELDS, (cardId,)).fetchone()
         
-        # Query to get the card details
-        cursor.execute("""
-            SELECT n.flds, c.id
-            FROM cards c
-            JOIN notes n ON c.nid = n.id
-            WHERE c.id = ?
-        """, (cardId,))
-        
-        result = cursor.fetchone()
         if not result:
-            app.logger.warning(f"Card {cardId} not found")
+            app.logger.warning("Card %s not found", cardId)
             return jsonify({"error": "Card not found"}), 404
         
-        # Parse fields from the note
-        fields = result[0].split('\x1f')  # Anki separator for fields
-        if len(fields) < 2:
-            app.logger.error(f"Card {cardId} has invalid field format")
+        # Parse the first two fields from the note
+        front, sep, rest = result[0].partition(FIELD_SEP)
+        if not sep:
+            app.logger.error("Card %s has invalid field format", cardId)
             return jsonify({"error": "Invalid card format"}), 500
+        back = rest.partition(FIELD_SEP)[0]
         
         # Return the card details using camelCase
         return jsonify({
             "cardId": result[1],
-            "front": fields[0],
-            "back": fields[1]
+            "front": front,
+            "back": back
         })
         
+    except UserDbNotFoundError:
+        app.logger.error("Database not found for user %s", user_id)
+        return jsonify({"error": "User database not found"}), 404
     except Exception as e:
-        app.logger.exception(f"Error fetching card {cardId}: {str(e)}")
+        app.logger.exception("Error fetching card %s: %s", cardId, e)
         return jsonify({"error": f"Error fetching card: {str(e)}"}), 500
-    finally:
-        if 'conn' in locals():
-            conn.close()
+
+def _replace_front_back(current_fields, front, back):
+    """Returns a note's flds with the front and back (first two) fields replaced.
+
+    Later fields are kept as-is. Returns None if flds has fewer than two fields.
+    """
+    _, sep, rest = current_fields.partition(FIELD_SEP)
+    if not sep:
+        return None
+    _, extra_sep, extra_fields = rest.partition(FIELD_SEP)
+    # Rejoin with the Anki separator
+    return f"{front}{FIELD_SEP}{back}{extra_sep}{extra_fields}"
 
 @app.route('/cards/<cardId>', methods=['PUT'])
 @login_required
@@ -2269,123 +3178,204 @@ def update_card(cardId):
         return jsonify({"error": "Front and back fields cannot be empty"}), 400
     
     user_id = session['user_id']
-    db_path = get_user_db_path(user_id)
     
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        # Get the note ID for this card
-        cursor.execute("SELECT nid FROM cards WHERE id = ?", (cardId,))
-        result = cursor.fetchone()
-        
-        if not result:
-            app.logger.warning(f"Card {cardId} not found")
-            return jsonify({"error": "Card not found"}), 404
+        with get_user_db_conn(user_id) as conn:
+            # Returning early or raising leaves the transaction to the pool, which rolls it back
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.cursor()
         
-        note_id = result[0]
+            # Get the note ID and current fields for this card, keeping any
+            # additional fields beyond front/back
+            result = cursor.execute(SQL_SELECT_CARD_NOTE, (cardId,)).fetchone()
         
-        # Update the note's fields
-        # First, get the current fields to maintain any additional fields beyond front/back
-        cursor.execute("SELECT flds FROM notes WHERE id = ?", (note_id,))
-        current_fields = cursor.fetchone()[0]
+            if not result:
+                app.logger.warning("Card %s not found", cardId)
+                return jsonify({"error": "Card not found"}), 404
         
-        # Split into individual fields
-        field_list = current_fields.split('\x1f')
+            note_id, current_fields = result
         
-        # Update just the front and back fields (first two)
-        if len(field_list) >= 2:
-            field_list[0] = front
-            field_list[1] = back
-            
-            # Rejoin with the Anki separator
-            new_fields = '\x1f'.join(field_list)
+            new_fields = _replace_front_back(current_fields, front, back)
+            if new_fields is None:
+                app.logger.error("Card %s has invalid field structure", cardId)
+                return jsonify({"error": "Card has invalid field structure"}), 500
             
             # Calculate a new checksum for the first field
-            checksum = int(sha1_checksum(field_list[0]), 16) & 0xFFFFFFFF
+            checksum = field_checksum(front)
             
-            # Begin transaction
-            conn.execute("BEGIN")
-            
-            # Update the note
-            current_time = int(time.time())
-            cursor.execute("""
-                UPDATE notes 
-                SET flds = ?, sfld = ?, csum = ?, mod = ? 
-                WHERE id = ?
-            """, (new_fields, field_list[0], checksum, current_time, note_id))
+            # Update the note (clock read once for notes, cards and col mod)
+            current_time_ms = clock_ms()
+            current_time = current_time_ms // 1000
+            cursor.execute(SQL_UPDATE_NOTE_FIELDS, (new_fields, front, checksum, current_time, note_id))
             
             # Update card modification time
-            cursor.execute("UPDATE cards SET mod = ? WHERE id = ?", (current_time, cardId))
-            
-            # Update collection modification time
-            cursor.execute("UPDATE col SET mod = ?", (int(time.time() * 1000),))
-            
-            # Commit the transaction
+            cursor.execute(SQL_TOUCH_CARD, (current_time, cardId))
             conn.commit()
+
+        # Update collection modification time (written lazily)
+        bump_col_mod(user_id, current_time_ms)
             
-            app.logger.info(f"Successfully updated card {cardId}")
-            return jsonify({"success": True, "message": "Card updated successfully"})
-        else:
-            app.logger.error(f"Card {cardId} has invalid field structure")
-            return jsonify({"error": "Card has invalid field structure"}), 500
+        app.logger.info("Successfully updated card %s", cardId)
+        return jsonify({"success": True, "message": "Card updated successfully"})
             
+    except UserDbNotFoundError:
+        app.logger.error("Database not found for user %s", user_id)
+        return jsonify({"error": "User database not found"}), 404
     except Exception as e:
-        app.logger.exception(f"Error updating card {cardId}: {str(e)}")
-        if 'conn' in locals():
-            conn.rollback()
+        app.logger.exception("Error updating card %s: %s", cardId, e)
         return jsonify({"error": f"Error updating card: {str(e)}"}), 500
-    finally:
-        if 'conn' in locals():
-            conn.close()
+
+@app.route('/cards', methods=['PUT'])
+@login_required
+def update_cards():
+    """Updates the front and back of several cards in one transaction.
+    Expects: {'cards': [{'cardId': ..., 'front': ..., 'back': ...}, ...]} in the request body.
+    """
+    user_id = session['user_id']
+
+    data = request.get_json()
+    items = data.get('cards') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "A non-empty list of cards is required"}), 400
+    if len(items) > MAX_BULK_CARDS:
+        return jsonify({"error": f"At most {MAX_BULK_CARDS} cards can be updated at once"}), 400
+
+    updates = []
+    for item in items:
+        if not isinstance(item, dict):
+            return jsonify({"error": "Each card must be an object"}), 400
+        card_id = item.get('cardId')
+        front = item.get('front')
+        back = item.get('back')
+        if not isinstance(card_id, int) or isinstance(card_id, bool):
+            return jsonify({"error": "Each card needs an integer cardId"}), 400
+        if not isinstance(front, str) or not isinstance(back, str) or not front.strip() or not back.strip():
+            return jsonify({"error": "Front and back fields cannot be empty"}), 400
+        updates.append((card_id, front.strip(), back.strip()))
+
+    try:
+        with get_user_db_conn(user_id) as conn:
+            cursor = conn.cursor()
+            # One write lock and one commit for the lot (rolled back by the pool on error)
+            conn.execute("BEGIN IMMEDIATE")
+
+            card_ids = list(dict.fromkeys(card_id for card_id, _, _ in updates))
+            cursor.execute(SQL_SELECT_CARDS_NOTES.format(", ".join("?" * len(card_ids))), card_ids)
+            notes = {}
+            card_notes = {}
+            for card_id, note_id, flds in cursor.fetchall():
+                card_notes[card_id] = note_id
+                notes[note_id] = flds
+            missing = [card_id for card_id in card_ids if card_id not in card_notes]
+            if missing:
+                app.logger.warning("Cards not found in bulk update: %s", missing)
+                return jsonify({"error": f"Card {missing[0]} not found"}), 404
+
+            # Later entries for the same note win, as with one request per card
+            new_notes = {}
+            for card_id, front, back in updates:
+                note_id = card_notes[card_id]
+                new_fields = _replace_front_back(notes[note_id], front, back)
+                if new_fields is None:
+                    app.logger.error("Card %s has invalid field structure", card_id)
+                    return jsonify({"error": "Card has invalid field structure"}), 500
+                notes[note_id] = new_fields
+                new_notes[note_id] = (new_fields, front)
+
+            # Clock read once for notes, cards and col mod
+            current_time_ms = clock_ms()
+            current_time = current_time_ms // 1000
+            cursor.executemany(SQL_UPDATE_NOTE_FIELDS, [
+                (new_fields, front, field_checksum(front), current_time, note_id)
+                for note_id, (new_fields, front) in new_notes.items()
+            ])
+            cursor.executemany(SQL_TOUCH_CARD, [(current_time, card_id) for card_id in card_ids])
+            conn.commit()
+
+        # Update collection modification time (written lazily)
+        bump_col_mod(user_id, current_time_ms)
+
+        app.logger.info("User %s updated %d cards", user_id, len(card_ids))
+        return jsonify({"success": True, "message": f"{len(card_ids)} cards updated successfully"})
+
+    except UserDbNotFoundError:
+        app.logger.error("Database not found for user %s", user_id)
+        return jsonify({"error": "User database not found"}), 404
+    except Exception as e:
+        app.logger.exception("Error updating cards for user %s: %s", user_id, e)
+        return jsonify({"error": f"Error updating cards: {str(e)}"}), 500
+
+def _delete_card_and_orphan_note(cursor, card_id):
+    """Deletes a card, and its note when no other card uses it.
+
+    Returns (card, flds): card is the deleted card's (nid, did, type, queue, ivl),
+    or None if it does not exist; flds is the deleted note's fields, or None
+    when the note was kept.
+    """
+    if SQLITE_HAS_RETURNING:
+        card_rows = cursor.execute("""
+            DELETE FROM cards WHERE id = ? RETURNING nid, did, type, queue, ivl
+        """, (card_id,)).fetchall()
+        if not card_rows:
+            return None, None
+        card = card_rows[0]
+        note_rows = cursor.execute("""
+            DELETE FROM notes WHERE id = ? AND NOT EXISTS (SELECT 1 FROM cards WHERE nid = ?)
+            RETURNING flds
+        """, (card[0], card[0])).fetchall()
+    else:
+        card = cursor.execute("SELECT nid, did, type, queue, ivl FROM cards WHERE id = ?", (card_id,)).fetchone()
+        if not card:
+            return None, None
+        cursor.execute("DELETE FROM cards WHERE id = ?", (card_id,))
+        note_rows = cursor.execute("""
+            SELECT flds FROM notes WHERE id = ? AND NOT EXISTS (SELECT 1 FROM cards WHERE nid = ?)
+        """, (card[0], card[0])).fetchall()
+        if note_rows:
+            cursor.execute("DELETE FROM notes WHERE id = ?", (card[0],))
+    return card, (note_rows[0][0] if note_rows else None)
 
 @app.route('/cards/<cardId>', methods=['DELETE'])
 @login_required
 def delete_card(cardId):
     user_id = session['user_id']
-    db_path = get_user_db_path(user_id)
-    
-    # Check if user's database exists
-    if not os.path.exists(db_path):
-        app.logger.error(f"Database not found for user {user_id}")
-        return jsonify({"error": "User database not found"}), 404
     
     try:
-        conn = sqlite3.connect(db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        with get_user_db_conn(user_id) as conn:
+            cursor = conn.cursor()
 
-        # First, get card details for enhanced logging (BEFORE deletion)
-        cursor.execute("""
-            SELECT c.nid, c.did, c.type, c.queue, c.ivl, n.flds
-            FROM cards c
-            JOIN notes n ON c.nid = n.id
-            WHERE c.id = ?
-        """, (cardId,))
-        card_data = cursor.fetchone()
-
-        if not card_data:
-            app.logger.warning(f"Card {cardId} not found")
-            return jsonify({"error": "Card not found"}), 404
+            # Begin transaction
+            conn.execute("BEGIN IMMEDIATE")
+
+            # Delete the card (and its note if no other card uses it), getting
+            # back the details needed for enhanced logging
+            card_data, fields = _delete_card_and_orphan_note(cursor, cardId)
 
-        note_id = card_data['nid']
-        deck_id = card_data['did']
-        card_type = card_data['type']
-        card_queue = card_data['queue']
-        card_interval = card_data['ivl']
-        fields = card_data['flds']
+            if not card_data:
+                app.logger.warning("Card %s not found", cardId)
+                return jsonify({"error": "Card not found"}), 404
+
+            note_id, deck_id, card_type, card_queue, card_interval = card_data
+            if fields is None:
+                # The note is still used by another card
+                fields = cursor.execute(SQL_SELECT_NOTE_FIELDS, (note_id,)).fetchone()[0]
+
+            # Get deck name
+            decks_dict = load_decks(conn, user_id)
+
+            # Commit the transaction
+            conn.commit()
+
+        # Update collection modification time (written lazily)
+        bump_col_mod(user_id, clock_ms())
 
-        # Get deck name
-        cursor.execute("SELECT decks FROM col LIMIT 1")
-        decks_data = cursor.fetchone()
         deck_name = "Unknown"
-        if decks_data and decks_data['decks']:
-            decks_dict = json.loads(decks_data['decks'])
+        if decks_dict:
             deck_name = decks_dict.get(str(deck_id), {}).get('name', 'Unknown')
 
         # Get card front text
-        field_list = fields.split('\x1f')
-        front_text = field_list[0][:15] + "..." if len(field_list[0]) > 15 else field_list[0]
+        front = fields.partition(FIELD_SEP)[0]
+        front_text = front[:15] + "..." if len(front) > 15 else front
 
         # Get card state
         card_state = get_card_state(card_type, card_queue, card_interval)
@@ -2393,139 +3383,106 @@ def delete_card(cardId):
         # Get username
         username = session.get('username', 'Unknown')
 
-        # Begin transaction
-        conn.execute("BEGIN")
-
-        # Delete the card
-        cursor.execute("DELETE FROM cards WHERE id = ?", (cardId,))
-
-        # Check if there are any other cards associated with this note
-        cursor.execute("SELECT COUNT(*) FROM cards WHERE nid = ?", (note_id,))
-        other_cards_count = cursor.fetchone()[0]
-
-        # If no other cards use this note, delete the note too
-        if other_cards_count == 0:
-            cursor.execute("DELETE FROM notes WHERE id = ?", (note_id,))
-
-        # Update collection modification time
-        cursor.execute("UPDATE col SET mod = ?", (int(time.time() * 1000),))
-
-        # Commit the transaction
-        conn.commit()
-
         # Enhanced logging AFTER successful commit
-        app.logger.info(f"User {user_id} ({username}) deleted card {cardId} from deck {deck_id} ({deck_name}): \"{front_text}\" [state: {card_state}]")
+        app.logger.info("User %s (%s) deleted card %s from deck %s (%s): \"%s\" [state: %s]",
+                        user_id, username, cardId, deck_id, deck_name, front_text, card_state)
         return jsonify({"success": True, "message": "Card deleted successfully"})
         
+    except UserDbNotFoundError:
+        app.logger.error("Database not found for user %s", user_id)
+        return jsonify({"error": "User database not found"}), 404
     except Exception as e:
-        app.logger.exception(f"Error deleting card {cardId}: {str(e)}")
-        if 'conn' in locals():
-            conn.rollback()
+        app.logger.exception("Error deleting card %s: %s", cardId, e)
         return jsonify({"error": f"Error deleting card: {str(e)}"}), 500
-    finally:
-        if 'conn' in locals():
-            conn.close()
+
+def delete_decks(conn, user_id, decks_dict, deck_ids, mod_time_ms):
+    """Deletes decks with their cards and orphaned notes; returns the number of cards deleted.
+
+    Runs inside the caller's transaction: decks are removed from decks_index and the
+    cards and notes of the non-empty ones deleted in chunks of DECK_DELETE_CHUNK_SIZE
+    decks, then col.decks is written once.
+    """
+    card_count = 0
+    for i in range(0, len(deck_ids), DECK_DELETE_CHUNK_SIZE):
+        chunk = deck_ids[i:i + DECK_DELETE_CHUNK_SIZE]
+        placeholders = ','.join('?' * len(chunk))
+        # Empty decks (card_count is kept by the decks_index triggers) need no card/note deletes
+        nonempty = [row[0] for row in conn.execute(
+            f"SELECT id FROM decks_index WHERE id IN ({placeholders}) AND card_count > 0", chunk)]
+        conn.execute(f"DELETE FROM decks_index WHERE id IN ({placeholders})", chunk)
+        if not nonempty:
+            continue
+        placeholders = ','.join('?' * len(nonempty))
+        # Notes whose every card is in these decks go first, while their cards still exist
+        conn.execute(f"""
+            DELETE FROM notes
+            WHERE id IN (SELECT nid FROM cards WHERE did IN ({placeholders}))
+              AND NOT EXISTS (SELECT 1 FROM cards c WHERE c.nid = notes.id AND c.did NOT IN ({placeholders}))
+        """, nonempty + nonempty)
+        card_count += conn.execute(f"DELETE FROM cards WHERE did IN ({placeholders})", nonempty).rowcount
+
+    # Remove the decks from (a copy of) the decks JSON and write it once
+    removed = {str(deck_id) for deck_id in deck_ids}
+    save_decks(conn, user_id, {did: deck for did, deck in decks_dict.items() if did not in removed}, mod_time_ms)
+    return card_count
 
 @app.route('/decks/<int:deckId>', methods=['DELETE'])
 @login_required
 def delete_deck(deckId):
     """Delete a specific deck and all its cards"""
     user_id = session['user_id']
-    user_db_path = get_user_db_path(user_id)
-    
-    # Check if user DB exists
-    if not os.path.exists(user_db_path):
-        app.logger.error(f"User database not found for user {user_id}")
-        return jsonify({"error": "User database not found"}), 500
     
     try:
-        conn = sqlite3.connect(user_db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        # First check if the deck exists in the col table's decks JSON
-        cursor.execute("SELECT decks FROM col LIMIT 1")
-        col_data = cursor.fetchone()
+        with get_user_db_conn(user_id) as conn:
+            # Hold the write lock across the read-modify-write of the decks JSON
+            conn.execute("BEGIN IMMEDIATE")
+
+            # First check if the deck exists in the col table's decks JSON
+            decks_dict = load_decks(conn, user_id)
         
-        if not col_data or not col_data['decks']:
-            conn.close()
-            app.logger.warning(f"Collection data not found or invalid")
-            return jsonify({"error": "Collection data not found"}), 500
+            if decks_dict is None:
+                app.logger.warning("Collection data not found or invalid")
+                return jsonify({"error": "Collection data not found"}), 500
             
-        decks_dict = json.loads(col_data['decks'])
-        deck_id_str = str(deckId)
-        
-        if deck_id_str not in decks_dict:
-            conn.close()
-            app.logger.warning(f"Attempt to delete non-existent deck {deckId}")
-            return jsonify({"error": "Deck not found"}), 404
-        
-        deck_name = decks_dict[deck_id_str]['name']
-        app.logger.info(f"Deleting deck '{deck_name}' (ID: {deckId}) for user {user_id}")
-        
-        # Start a transaction
-        cursor.execute("BEGIN TRANSACTION")
-        
-        # Count cards in the deck
-        cursor.execute("SELECT COUNT(*) FROM cards WHERE did = ?", (deckId,))
-        card_count = cursor.fetchone()[0]
+            deck_id_str = str(deckId)
         
-        # Get the IDs of notes associated with this deck's cards
-        cursor.execute("SELECT DISTINCT nid FROM cards WHERE did = ?", (deckId,))
-        note_ids = [row[0] for row in cursor.fetchall()]
+            if deck_id_str not in decks_dict:
+                app.logger.warning("Attempt to delete non-existent deck %s", deckId)
+                return jsonify({"error": "Deck not found"}), 404
         
-        # Delete cards in this deck
-        cursor.execute("DELETE FROM cards WHERE did = ?", (deckId,))
-        app.logger.debug(f"Deleted {card_count} cards from deck {deckId}")
+            deck_name = decks_dict[deck_id_str]['name']
+            app.logger.info("Deleting deck '%s' (ID: %s) for user %s", deck_name, deckId, user_id)
         
-        # For each note, check if it has any remaining cards
-        # If not, delete the note
-        for note_id in note_ids:
-            cursor.execute("SELECT COUNT(*) FROM cards WHERE nid = ?", (note_id,))
-            remaining_cards = cursor.fetchone()[0]
-            if remaining_cards == 0:
-                cursor.execute("DELETE FROM notes WHERE id = ?", (note_id,))
-                app.logger.debug(f"Deleted orphaned note {note_id}")
+            # Delete the deck, its cards and their orphaned notes (same path as bulk deletes)
+            card_count = delete_decks(conn, user_id, decks_dict, [deckId], clock_ms())
+            app.logger.debug("Deleted %s cards from deck %s", card_count, deckId)
         
-        # Remove the deck from the decks JSON
-        del decks_dict[deck_id_str]
-        
-        # Update the col table with the modified decks JSON
-        current_time_ms = int(time.time() * 1000)
-        cursor.execute("UPDATE col SET decks = ?, mod = ?", 
-                     (json.dumps(decks_dict), current_time_ms))
-        
-        # Commit the transaction
-        conn.commit()
+            # Commit the transaction
+            conn.commit()
 
-        # Enhanced logging with username
-        username = session.get('username', 'Unknown')
-        app.logger.info(f"User {user_id} ({username}) deleted deck {deckId} ({deck_name}) with {card_count} cards")
+            # Enhanced logging with username
+            username = session.get('username', 'Unknown')
+            app.logger.info("User %s (%s) deleted deck %s (%s) with %s cards", user_id, username, deckId, deck_name, card_count)
 
-        return jsonify({
-            "message": f"Deck '{deck_name}' and {card_count} cards deleted successfully"
-        }), 200
+            return jsonify({
+                "message": f"Deck '{deck_name}' and {card_count} cards deleted successfully"
+            }), 200
         
+    except UserDbNotFoundError:
+        app.logger.error("User database not found for user %s", user_id)
+        return jsonify({"error": "User database not found"}), 500
     except sqlite3.Error as e:
-        app.logger.exception(f"Database error deleting deck {deckId}: {str(e)}")
-        if 'conn' in locals() and conn:
-            conn.rollback()
+        app.logger.exception("Database error deleting deck %s: %s", deckId, e)
         return jsonify({"error": "Failed to delete deck due to database error"}), 500
     except Exception as e:
-        app.logger.exception(f"Error deleting deck {deckId}: {str(e)}")
-        if 'conn' in locals() and conn:
-            conn.rollback()
+        app.logger.exception("Error deleting deck %s: %s", deckId, e)
         return jsonify({"error": "Failed to delete deck"}), 500
-    finally:
-        if 'conn' in locals() and conn:
-            conn.close()
 
 @app.route('/decks/<int:deckId>/rename', methods=['PUT'])
 @login_required
 def rename_deck(deckId):
     """Rename a specific deck"""
     user_id = session['user_id']
-    user_db_path = get_user_db_path(user_id)
     
     # Get new deck name from request
     data = request.get_json()
@@ -2536,78 +3493,71 @@ def rename_deck(deckId):
     new_deck_name = data['name'].strip()
     
     try:
-        conn = sqlite3.connect(user_db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+        with get_user_db_conn(user_id) as conn:
+            cursor = conn.cursor()
         
-        # First get the decks from the col table
-        cursor.execute("SELECT decks FROM col LIMIT 1")
-        col_data = cursor.fetchone()
+            # Hold the write lock across the read-modify-write of the decks JSON
+            conn.execute("BEGIN IMMEDIATE")
+
+            # First get the decks from the col table
+            decks_dict = load_decks(conn, user_id)
         
-        if not col_data or not col_data['decks']:
-            app.logger.warning("Collection data not found or invalid")
-            return jsonify({"error": "Collection data not found"}), 500
+            if decks_dict is None:
+                app.logger.warning("Collection data not found or invalid")
+                return jsonify({"error": "Collection data not found"}), 500
             
-        decks_dict = json.loads(col_data['decks'])
-        deck_id_str = str(deckId)
+            deck_id_str = str(deckId)
         
-        # Check if the deck exists
-        if deck_id_str not in decks_dict:
-            app.logger.warning(f"Attempt to rename non-existent deck {deckId}")
-            return jsonify({"error": "Deck not found"}), 404
+            # Check if the deck exists
+            if deck_id_str not in decks_dict:
+                app.logger.warning("Attempt to rename non-existent deck %s", deckId)
+                return jsonify({"error": "Deck not found"}), 404
         
-        old_deck_name = decks_dict[deck_id_str]['name']
+            old_deck_name = decks_dict[deck_id_str]['name']
         
-        # Check if another deck with the same name already exists
-        # Case insensitive comparison
-        for did, deck in decks_dict.items():
-            if did != deck_id_str and deck['name'].lower() == new_deck_name.lower():
-                app.logger.warning(f"Attempt to rename deck to existing name: {new_deck_name}")
+            # Rename in decks_index; its unique name_key rejects a name another deck
+            # already has (case insensitive comparison)
+            try:
+                cursor.execute(SQL_RENAME_DECK_INDEX, (new_deck_name, new_deck_name.lower(), deckId))
+            except sqlite3.IntegrityError:
+                app.logger.warning("Attempt to rename deck to existing name: %s", new_deck_name)
                 return jsonify({"error": "A deck with this name already exists"}), 409
         
-        # Update the deck name
-        decks_dict[deck_id_str]['name'] = new_deck_name
-        decks_dict[deck_id_str]['mod'] = int(time.time())  # Update modification time
+            # Update the deck name (on copies: the cached dict is shared)
+            current_time_ms = clock_ms()
+            decks_dict = dict(decks_dict)
+            decks_dict[deck_id_str] = dict(decks_dict[deck_id_str], name=new_deck_name,
+                                           mod=current_time_ms // 1000)  # Update modification time
         
-        # Update the collection
-        current_time_ms = int(time.time() * 1000)
-        cursor.execute("UPDATE col SET decks = ?, mod = ?", 
-                      (json.dumps(decks_dict), current_time_ms))
-        conn.commit()
+            # Update the collection
+            save_decks(conn, user_id, decks_dict, current_time_ms)
+            conn.commit()
         
-        app.logger.info(f"Renamed deck from '{old_deck_name}' to '{new_deck_name}'")
-        return jsonify({
-            "message": f"Deck renamed from '{old_deck_name}' to '{new_deck_name}' successfully",
-            "id": deckId,
-            "name": new_deck_name
-        }), 200
+            app.logger.info("Renamed deck from '%s' to '%s'", old_deck_name, new_deck_name)
+            return jsonify({
+                "message": f"Deck renamed from '{old_deck_name}' to '{new_deck_name}' successfully",
+                "id": deckId,
+                "name": new_deck_name
+            }), 200
         
+    except UserDbNotFoundError:
+        app.logger.error("User database not found for user %s", user_id)
+        return jsonify({"error": "User database not found"}), 404
     except sqlite3.Error as e:
-        app.logger.exception(f"Database error renaming deck {deckId}: {str(e)}")
-        if 'conn' in locals() and conn:
-            conn.rollback()
+        app.logger.exception("Database error renaming deck %s: %s", deckId, e)
         return jsonify({"error": "Failed to rename deck due to database error"}), 500
     except Exception as e:
-        app.logger.exception(f"Error renaming deck {deckId}: {str(e)}")
-        if 'conn' in locals() and conn:
-            conn.rollback()
+        app.logger.exception("Error renaming deck %s: %s", deckId, e)
         return jsonify({"error": "Failed to rename deck"}), 500
-    finally:
-        if 'conn' in locals() and conn:
-            conn.close()
 
 @app.route('/decks/<deckId>/cards', methods=['GET'])
 @login_required
 def get_deck_cards(deckId):
     user_id = session['user_id']
-    db_path = get_user_db_path(user_id)
     
-    # Check if user's database exists
-    if not os.path.exists(db_path):
-        app.logger.error(f"Database not found for user {user_id}")
-        return jsonify({"error": "User database not found"}), 404
-    
-    # Get pagination parameters
+    # Get pagination parameters: afterId (the last cardId of the previous page)
+    # seeks straight to the next page; page/offset is kept for older clients
+    afterId = request.args.get('afterId', type=int)
     page = request.args.get('page', 1, type=int)
     perPage = request.args.get('perPage', 10, type=int)
     
@@ -2615,80 +3565,86 @@ def get_deck_cards(deckId):
     offset = (page - 1) * perPage
     
     try:
-        conn = sqlite3.connect(db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        # First, check if the deck exists by querying the col table's decks JSON field
-        cursor.execute("SELECT decks FROM col LIMIT 1")
-        col_data = cursor.fetchone()
-        if not col_data or not col_data['decks']:
-            app.logger.warning("Collection data not found or invalid")
-            return jsonify({"error": "Collection data not found"}), 500
-            
-        decks_dict = json.loads(col_data['decks'])
-        if str(deckId) not in decks_dict:
-            app.logger.warning(f"Deck {deckId} not found")
-            return jsonify({"error": "Deck not found"}), 404
+        with get_user_db_conn(user_id) as conn:
+            cursor = conn.cursor()
+        
+            # Check the deck exists and get its name, card count and version from decks_index
+            deck_row = cursor.execute("SELECT name, card_count, version FROM decks_index WHERE id = ?",
+                                      (deckId,)).fetchone()
+            if not deck_row:
+                app.logger.warning("Deck %s not found", deckId)
+                return jsonify({"error": "Deck not found"}), 404
             
-        deck_name = decks_dict[str(deckId)]['name']
-        
-        # Get total number of cards in the deck
-        cursor.execute("""
-            SELECT COUNT(*) 
-            FROM cards c
-            WHERE c.did = ?
-        """, (deckId,))
-        total_cards = cursor.fetchone()[0]
-        
-        # Query to get cards for the deck with pagination
-        cursor.execute("""
-            SELECT c.id, n.id AS note_id, n.flds, c.mod
-            FROM cards c
-            JOIN notes n ON c.nid = n.id
-            WHERE c.did = ?
-            ORDER BY c.id DESC
-            LIMIT ? OFFSET ?
-        """, (deckId, perPage, offset))
-        
-        cards_data = []
-        for row in cursor.fetchall():
-            card_id, note_id, fields, mod_time = row
-            # Parse fields from the note (separated by the Anki separator \x1f)
-            field_list = fields.split('\x1f')
-            if len(field_list) >= 2:
-                cards_data.append({
-                    "cardId": card_id,
-                    "noteId": note_id,
-                    "front": field_list[0],
-                    "back": field_list[1],
-                    "modified": mod_time  # This is epoch timestamp
-                })
-        
+            deck_name, total_cards, deck_version = deck_row
+
+            # The deck version changes with everything the listing shows (see
+            # decks_index), so a client polling with If-None-Match gets an empty
+            # 304 without the page being queried or encoded. The tag also names
+            # the page: a validator seen on one page must not match another
+            etag = f"{user_id}-{deckId}-{deck_version}-{afterId}-{page}-{perPage}"
+            if request.if_none_match.contains(etag):
+                response = app.response_class(status=304)
+                response.set_etag(etag)
+                return response
+        
+            # Query to get cards for the deck with pagination (ix_cards_deck_id
+            # keeps both forms from sorting; only the keyset one skips no rows)
+            if afterId is not None:
+                page_sql, json_sql = SQL_SELECT_DECK_CARDS_AFTER, SQL_SELECT_DECK_CARDS_AFTER_JSON
+                page_params = (deckId, afterId, perPage)
+            else:
+                page_sql, json_sql = SQL_SELECT_DECK_CARDS_PAGE, SQL_SELECT_DECK_CARDS_PAGE_JSON
+                page_params = (deckId, perPage, offset)
+
+            if SQLITE_HAS_JSON and SQLITE_HAS_AGGREGATE_FILTER:
+                # SQLite encodes the cards: no per-row tuples or dicts in Python
+                cards_json, row_count, last_card_id = cursor.execute(json_sql, page_params).fetchone()
+            else:
+                rows = cursor.execute(page_sql, page_params).fetchall()
+                row_count = len(rows)
+                last_card_id = rows[-1][0] if rows else None
+                cards_data = []
+                for card_id, note_id, front, back, mod_time in rows:
+                    # front is NULL for notes without the two Anki fields
+                    if front is not None:
+                        cards_data.append({
+                            "cardId": card_id,
+                            "noteId": note_id,
+                            "front": front,
+                            "back": back,
+                            "modified": mod_time  # This is epoch timestamp
+                        })
+                cards_json = json_dumps(cards_data)
+
         # Return the cards with pagination metadata using camelCase
-        return jsonify({
+        body = json_dumps({
             "deckId": deckId,
             "deckName": deck_name,
-            "cards": cards_data,
             "pagination": {
                 "total": total_cards,
                 "page": page,
                 "perPage": perPage,
-                "totalPages": (total_cards + perPage - 1) // perPage
+                "totalPages": (total_cards + perPage - 1) // perPage,
+                # afterId for the next page; None on the last one
+                "nextCursor": last_card_id if row_count == perPage else None
             }
         })
+        # Splice in the already encoded cards array
+        response = app.response_class(f'{body[:-1]},"cards":{cards_json}}}', mimetype='application/json')
+        response.set_etag(etag)
+        return response
         
+    except UserDbNotFoundError:
+        app.logger.error("Database not found for user %s", user_id)
+        return jsonify({"error": "User database not found"}), 404
     except Exception as e:
-        app.logger.exception(f"Error fetching cards for deck {deckId}: {str(e)}")
+        app.logger.exception("Error fetching cards for deck %s: %s", deckId, e)
         return jsonify({"error": f"Error fetching cards: {str(e)}"}), 500
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 # --- Server Start ---
 if __name__ == '__main__':
     # Initialize databases if they don't exist
     # TODO: Call database initialization functions here
     init_admin_db() # Initialize the admin database
-    app.logger.info(f"Starting server on port {PORT}...") # Use logger
+    app.logger.info("Starting server on port %s...", PORT) # Use logger
     app.run(host='0.0.0.0', port=PORT, debug=True) # debug=True for development 
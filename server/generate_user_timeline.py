@@ -123,10 +123,19 @@ class UserTimelineGenerator:
             r'(\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}:\d{2}).*?User\s+\d+\s+\(([^)]+)\)\s+deleted\s+deck\s+(\d+)\s+\(([^)]+)\)\s+with\s+(\d+)\s+cards'
         )
 
+        # Every pattern captures the user name inside parentheses and requires it to
+        # equal username, so lines without this literal cannot match any of them
+        needle = f"({username})"
+
         with open(self.log_file, 'r') as f:
             for line in f:
+                if needle not in line:
+                    continue
+                # Each pattern below only runs when its verb is on the line
+                # (a substring test is far cheaper than a failed regex search)
+
                 # Check for deck switches
-                match = deck_switch_pattern.search(line)
+                match = deck_switch_pattern.search(line) if 'current' in line else None
                 if match and match.group(2) == username:
                     timestamp_str, user, deck_id = match.groups()
                     timestamp = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
@@ -144,7 +153,7 @@ class UserTimelineGenerator:
                     continue
 
                 # Check for logins
-                match = login_pattern.search(line)
+                match = login_pattern.search(line) if 'logged' in line else None
                 if match and match.group(2) == username:
                     timestamp_str = match.group(1)
                     timestamp = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
@@ -161,7 +170,7 @@ class UserTimelineGenerator:
                     continue
 
                 # Check for logouts
-                match = logout_pattern.search(line)
+                match = logout_pattern.search(line) if 'logged' in line else None
                 if match and match.group(2) == username:
                     timestamp_str = match.group(1)
                     timestamp = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
@@ -178,7 +187,7 @@ class UserTimelineGenerator:
                     continue
 
                 # NEW: Check for card creation
-                match = card_create_pattern.search(line)
+                match = card_create_pattern.search(line) if 'created' in line else None
                 if match and match.group(2) == username:
                     timestamp_str, user, card_id, deck_id, deck_name, front = match.groups()
                     timestamp = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
@@ -201,7 +210,7 @@ class UserTimelineGenerator:
                     continue
 
                 # NEW: Check for card review
-                match = card_review_pattern.search(line)
+                match = card_review_pattern.search(line) if 'reviewed' in line else None
                 if match and match.group(2) == username:
                     timestamp_str, user, card_id, front, ease, old_state, new_state = match.groups()
                     timestamp = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
@@ -225,7 +234,7 @@ class UserTimelineGenerator:
                     continue
 
                 # NEW: Check for card deletion
-                match = card_delete_pattern.search(line)
+                match = card_delete_pattern.search(line) if 'deleted' in line else None
                 if match and match.group(2) == username:
                     timestamp_str, user, card_id, deck_id, deck_name, front, state = match.groups()
                     timestamp = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
@@ -249,7 +258,7 @@ class UserTimelineGenerator:
                     continue
 
                 # NEW: Check for deck deletion
-                match = deck_delete_pattern.search(line)
+                match = deck_delete_pattern.search(line) if 'deleted' in line else None
                 if match and match.group(2) == username:
                     timestamp_str, user, deck_id, deck_name, card_count = match.groups()
                     timestamp = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
@@ -0,0 +1,127 @@
+"""
+Card Scheduler
+
+The Anki-style (SM-2 variant) scheduling rules applied by answer_card. Pure
+functions of the card's scheduling fields, the answer and the deck options:
+no database, Flask or clock access, so they can be tested and replaced on
+their own.
+"""
+
+from collections import namedtuple
+
+# New scheduling state for a card after an answer. log_type is the revlog type.
+SchedResult = namedtuple('SchedResult', ['queue', 'type', 'due', 'ivl', 'factor', 'left', 'lapses', 'log_type'])
+
+def _sched_keep(card, ease, now, dayCutoff, deck_conf, schedule_conf):
+    """Leaves the card state untouched (queues without scheduling rules)."""
+    return SchedResult(card['queue'], card['type'], card['due'], card['ivl'],
+                       card['factor'], card['left'], card['lapses'], card['type'])
+
+def _sched_graduate(card, dayCutoff, log_type):
+    """Moves a learning card to the review queue with a 1 day interval."""
+    return SchedResult(2, 2, dayCutoff + 1, 1, card['factor'], 0, card['lapses'], log_type)
+
+def _sched_step(card, now, delay, queue, card_type):
+    """Puts the card on a learning step: due in delay minutes, delay kept in left."""
+    return SchedResult(queue, card_type, now + delay * 60, card['ivl'], card['factor'], delay, card['lapses'], card['type'])
+
+def _sched_new_again(card, ease, now, dayCutoff, deck_conf, schedule_conf):
+    """New card answered Again: enter learning at the first step."""
+    return _sched_step(card, now, schedule_conf['delays'][0], 1, 1)
+
+def _sched_new_pass(card, ease, now, dayCutoff, deck_conf, schedule_conf):
+    """New card answered Hard (first step) or Good/Easy (second step)."""
+    delays = schedule_conf['delays']
+    step_index = 0 if ease == 2 else 1
+    if step_index < len(delays):
+        return _sched_step(card, now, delays[step_index], 1, 1)
+    return _sched_graduate(card, dayCutoff, card['type'])
+
+def _sched_learn_again(card, ease, now, dayCutoff, deck_conf, schedule_conf):
+    """Learning card answered Again: back to the first step."""
+    return _sched_step(card, now, schedule_conf['delays'][0], card['queue'], card['type'])
+
+def _sched_learn_hard(card, ease, now, dayCutoff, deck_conf, schedule_conf):
+    """Learning card answered Hard: repeat the current step."""
+    return _sched_step(card, now, card['left'], card['queue'], card['type'])
+
+def _sched_learn_good(card, ease, now, dayCutoff, deck_conf, schedule_conf):
+    """Learning card answered Good/Easy: next step, or graduate on the last step or Easy."""
+    delays = schedule_conf['delays']
+    if card['left'] != 0 and ease != 4 and 1 < len(delays):
+        return _sched_step(card, now, delays[1], card['queue'], card['type'])
+    return _sched_graduate(card, dayCutoff, card['type'])
+
+def _sched_review_lapse(card, ease, now, dayCutoff, deck_conf, schedule_conf):
+    """Review card answered Again: lapse into relearning (log type 2)."""
+    lapse_conf = deck_conf.get('lapse', {})
+    lapse_delays = lapse_conf.get('delays', [10]) # Default delay if missing
+    lapses = card['lapses'] + 1
+    if len(lapse_delays) > 0:
+        delay = lapse_delays[0]
+        # Interval is 0 during learning/relearning steps
+        return SchedResult(1, 3, now + delay * 60, 0, card['factor'], delay, lapses, 2)
+    # No relearning steps defined, reschedule based on lapse multiplier
+    new_interval = max(1, int(card['ivl'] * lapse_conf.get('mult', 0.0)))
+    return SchedResult(2, 2, dayCutoff + new_interval, new_interval, card['factor'], 0, lapses, 2)
+
+def _sched_review_pass(card, ease, now, dayCutoff, deck_conf, schedule_conf):
+    """Review card answered Hard/Good/Easy: grow the interval and adjust the ease factor."""
+    rev_conf = deck_conf.get('rev', {})
+    interval_factor = rev_conf.get('ivlFct', 1.0) # General interval factor
+    option, default, scaled, factor_change = REVIEW_EASE_PARAMS[ease]
+    interval_adjust = rev_conf.get(option, default) if option else default
+    if scaled:
+        interval_adjust *= interval_factor
+    # Simplified: Interval = Previous Interval * Ease Multiplier * General Interval Factor
+    current_interval = card['ivl']
+    new_interval = max(current_interval + 1, int(current_interval * interval_adjust * interval_factor))
+    new_factor = max(1300, card['factor'] + factor_change) # Ease factor floor is 1300
+    return SchedResult(2, 2, dayCutoff + new_interval, new_interval, new_factor, 0, card['lapses'], 1)
+
+# Review answers: ease -> (rev option holding the interval multiplier, its default,
+# whether ivlFct scales it, ease factor change). Good has no option of its own
+# (multiplier 1.0, no factor change in this SM-2 variant); Easy's bonus is
+# called ease4 in Anki's JSON. Factor changes are Anki-like.
+REVIEW_EASE_PARAMS = {
+    2: ('hardFactor', 1.2, False, -150), # Hard
+    3: (None, 1.0, True, 0), # Good
+    4: ('ease4', 1.3, True, 150), # Easy
+}
+
+# (queue, ease) -> scheduling rule; queues without an entry keep their state
+SCHEDULE_TABLE = {
+    (0, 1): _sched_new_again,
+    (0, 2): _sched_new_pass,
+    (0, 3): _sched_new_pass,
+    (0, 4): _sched_new_pass,
+    (1, 1): _sched_learn_again,
+    (1, 2): _sched_learn_hard,
+    (1, 3): _sched_learn_good,
+    (1, 4): _sched_learn_good,
+    (2, 1): _sched_review_lapse,
+    (2, 2): _sched_review_pass,
+    (2, 3): _sched_review_pass,
+    (2, 4): _sched_review_pass,
+}
+
+def schedule_conf_for(deck_conf, card_type, queue):
+    """Returns the deck options group (new, lapse or rev) that schedules a card."""
+    if card_type == 0:  # 0 = new
+        return deck_conf['new']
+    if card_type == 1:  # 1 = learning
+        return deck_conf['lapse'] if queue == 1 else deck_conf['new']
+    if card_type == 2:  # 2 = review
+        return deck_conf['rev']
+    if card_type == 3:  # 3 = relearning
+        return deck_conf['lapse']
+    return deck_conf['new']  # Default fallback
+
+def schedule(card, ease, now, dayCutoff, deck_conf, schedule_conf):
+    """Returns the card's SchedResult after an answer with the given ease (1-4).
+
+    card maps type, queue, due, ivl, factor, left and lapses; now is in epoch
+    seconds and dayCutoff in days since the collection was created.
+    """
+    rule = SCHEDULE_TABLE.get((card['queue'], ease), _sched_keep)
+    return rule(card, ease, now, dayCutoff, deck_conf, schedule_conf)
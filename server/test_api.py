@@ -50,6 +50,9 @@ class TestFlaskApi(unittest.TestCase):
         # Assuming it was imported from app:
         import app as app_module
         app_module.ADMIN_DB_PATH = self.admin_db_path
+        # Cheapest bcrypt cost: every test registers a user
+        self.original_bcrypt_rounds = app_module.BCRYPT_ROUNDS
+        app_module.BCRYPT_ROUNDS = 4
 
         # Initialize admin DB using the now-overridden path
         init_admin_db() 
@@ -89,6 +92,7 @@ class TestFlaskApi(unittest.TestCase):
         try:
             import app as app_module
             app_module.ADMIN_DB_PATH = self.original_admin_db_path_in_app
+            app_module.BCRYPT_ROUNDS = self.original_bcrypt_rounds
         except (ImportError, AttributeError):
             pass # Ignore if restoration fails
 
@@ -100,11 +104,12 @@ class TestFlaskApi(unittest.TestCase):
 
     def _register_user(self, username, name, password):
         """Helper to register a user via API."""
-        return self.client.post('/register', json={
+        response = self.client.post('/register', json={
             "username": username,
             "name": name,
             "password": password
         })
+        return response
 
     def _login_user(self, username, password):
         """Helper to login a user and return the client context."""
@@ -152,6 +157,80 @@ class TestFlaskApi(unittest.TestCase):
         self.assertIn("userId", data)
         # Check if user DB was created
         self.assertTrue(os.path.exists(self._get_test_user_db_path(data['userId'])))
+        # The Anki indexes are built after the sample cards are loaded
+        conn = sqlite3.connect(self._get_test_user_db_path(data['userId']))
+        indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        sample_cards = conn.execute("SELECT COUNT(*) FROM cards WHERE did = 2").fetchone()[0]
+        conn.close()
+        self.assertTrue({'ix_notes_usn', 'ix_cards_usn', 'ix_revlog_usn', 'ix_cards_nid',
+                         'ix_cards_sched', 'ix_revlog_cid', 'ix_notes_csum'} <= indexes)
+        self.assertGreater(sample_cards, 0)
+
+    def test_02a_register_name_is_escaped_in_col_json(self):
+        response = self._register_user("quoted", 'Ana "Q" \\ __CRT__', "password1234")
+        self.assertEqual(response.status_code, 201)
+        conn = sqlite3.connect(self._get_test_user_db_path(json.loads(response.data)['userId']))
+        crt, models, decks, dconf = conn.execute("SELECT crt, models, decks, dconf FROM col").fetchone()
+        conn.close()
+        decks = json.loads(decks)
+        self.assertEqual(decks["2"]["desc"], 'English verb tenses sample deck for Ana "Q" \\ __CRT__')
+        self.assertEqual(decks["1"]["mod"], crt)
+        self.assertEqual(json.loads(models)["1700000000001"]["mod"], crt)
+        self.assertEqual(json.loads(dconf)["1"]["mod"], crt)
+
+    def test_02b_register_builds_db_before_answering(self):
+        import app as app_module
+        response = self.client.post('/register', json={
+            "username": "bguser", "name": "Setup User", "password": "password1234"})
+        self.assertEqual(response.status_code, 201)
+        user_id = json.loads(response.data)['userId']
+        # The file is in place for any worker process as soon as the 201 is sent
+        self.assertTrue(os.path.exists(self._get_test_user_db_path(user_id)))
+        with app_module.get_user_db_conn(user_id) as conn:
+            self.assertGreater(conn.execute("SELECT COUNT(*) FROM cards").fetchone()[0], 0)
+        leftovers = [f for f in os.listdir(self.user_db_dir) if f.endswith('.tmp')]
+        self.assertEqual(leftovers, [])
+
+    def test_02e_failed_db_setup_frees_username(self):
+        import app as app_module
+        from unittest import mock
+        with mock.patch.object(app_module, 'setup_user_db', side_effect=OSError("disk full")):
+            response = self._register_user("failuser", "Fail User", "password1234")
+        self.assertEqual(response.status_code, 500)
+        # The username was not kept for a user without a collection
+        self.assertEqual(self._register_user("failuser", "Fail User", "password1234").status_code, 201)
+
+    def test_02c_sample_note_and_card_ids_are_disjoint(self):
+        import app as app_module
+        response = self._register_user("idsuser", "Ids User", "password1234")
+        user_id = json.loads(response.data)['userId']
+        with app_module.get_user_db_conn(user_id) as conn:
+            note_ids = [r[0] for r in conn.execute("SELECT id FROM notes ORDER BY id")]
+            card_ids = [r[0] for r in conn.execute("SELECT id FROM cards ORDER BY id")]
+        self.assertEqual(len(note_ids), len(card_ids))
+        self.assertLess(note_ids[-1], card_ids[0])
+
+    def test_02d_new_collections_are_copied_from_template(self):
+        import app as app_module
+        user_ids = [json.loads(self._register_user(u, f"Name {u}", "password1234").data)['userId']
+                    for u in ("tpl_a", "tpl_b")]
+        self.assertTrue(os.path.exists(os.path.join(self.user_db_dir, app_module._TEMPLATE_DB_NAME)))
+        guids = []
+        for user_id, username in zip(user_ids, ("tpl_a", "tpl_b")):
+            with app_module.get_user_db_conn(user_id) as conn:
+                crt, decks = conn.execute("SELECT crt, decks FROM col").fetchone()
+                self.assertIn(f"Name {username}", json.loads(decks)["2"]["desc"])
+                note_id, guid, mod = conn.execute("SELECT id, guid, mod FROM notes ORDER BY id LIMIT 1").fetchone()
+                self.assertEqual(mod, crt)
+                self.assertGreater(note_id, crt) # Shifted to the registration time (ms)
+                self.assertEqual(conn.execute("SELECT COUNT(*) FROM cards c JOIN notes n ON c.nid = n.id "
+                                              "WHERE c.due = n.id").fetchone()[0],
+                                 len(app_module._INITIAL_CARDS_PRECOMPUTED))
+                guids.append(guid)
+                self.assertRegex(guid, r'^[0-9a-f]{10}$') # Same form as the other insert paths
+                # Deck versions (card listing ETags) start at the registration, not the template build
+                self.assertEqual(conn.execute("SELECT MIN(version) FROM decks_index").fetchone()[0] // 1000, crt)
+        self.assertNotEqual(guids[0], guids[1])
 
     def test_03_register_duplicate_username(self):
         response = self._register_user("testuser", "Another Test", "password123") # Already registered in setUp
@@ -225,7 +304,20 @@ class TestFlaskApi(unittest.TestCase):
             # Assert against the names used during registration
             deck_names = [d['name'] for d in data]
             self.assertIn("MyFirstDeck", deck_names)
-            self.assertIn("Verbal Tenses", deck_names) 
+            self.assertIn("Verbal Tenses", deck_names)
+
+    def test_10a_get_decks_sorted_list_cached(self):
+        with self.client as c:
+            self._login_user("testuser", "password123")
+            first = json.loads(c.get('/decks').data)
+            self.assertEqual([d['name'] for d in first], sorted(d['name'] for d in first))
+            self.assertEqual(json.loads(c.get('/decks').data), first)
+
+            # A new deck changes col.mod, so the list is rebuilt
+            self._create_deck(c, "AAA Deck")
+            names = [d['name'] for d in json.loads(c.get('/decks').data)]
+            self.assertEqual(names[0], "AAA Deck")
+            self.assertEqual(len(names), len(first) + 1)
 
     def test_11_get_decks_unauthorized(self):
         response = self.client.get('/decks')
@@ -301,6 +393,13 @@ class TestFlaskApi(unittest.TestCase):
                 self.assertIn("front", data)
                 self.assertIn("back", data)
 
+    def test_21a_get_next_card_picks_random_new_card(self):
+        with self.client as c:
+            self._login_user("testuser", "password123")
+            self.assertEqual(c.put('/decks/current', json={'deckId': 2}).status_code, 200) # Sample cards
+            card_ids = {json.loads(self._get_next_card(c).data)["cardId"] for _ in range(10)}
+            self.assertGreater(len(card_ids), 1)
+
     def test_22_get_next_card_no_cards_available(self):
          with self.client as c:
             self._login_user("testuser", "password123")
@@ -345,6 +444,39 @@ class TestFlaskApi(unittest.TestCase):
 
             # Optional: Verify card state changed in DB (more complex)
 
+    def test_24a_answer_card_revlog_flushed(self):
+         import app as app_module
+         with self.client as c:
+            self._login_user("testuser", "password123")
+            self._add_card(c, "Q Log", "A Log")
+            self._get_next_card(c)
+            response = c.post('/answer', json={'ease': 3, 'timeTaken': 2000})
+            self.assertEqual(response.status_code, 200)
+
+            # The review is buffered until flushed
+            app_module.flush_revlog(self.test_user_id)
+            conn = sqlite3.connect(self._get_test_user_db_path(self.test_user_id))
+            rows = conn.execute("SELECT ease, time, type FROM revlog").fetchall()
+            conn.close()
+            self.assertEqual(rows, [(3, 2000, 0)])
+            self.assertEqual(app_module.pending_revlog(self.test_user_id), [])
+
+    def test_24b_revlog_rows_in_same_millisecond_are_kept(self):
+         import app as app_module
+         conn = sqlite3.connect(self._get_test_user_db_path(self.test_user_id))
+         card_id = conn.execute("SELECT id FROM cards LIMIT 1").fetchone()[0]
+         conn.close()
+
+         same_ms = 4102444800123
+         app_module.queue_revlog(self.test_user_id, (same_ms, card_id, -1, 3, 1, 0, 2500, 1000, 0))
+         app_module.queue_revlog(self.test_user_id, (same_ms, card_id, -1, 1, 0, 1, 2500, 2000, 1))
+         app_module.flush_revlog(self.test_user_id)
+
+         conn = sqlite3.connect(self._get_test_user_db_path(self.test_user_id))
+         rows = conn.execute("SELECT id, ease, time FROM revlog ORDER BY id").fetchall()
+         conn.close()
+         self.assertEqual(rows, [(same_ms, 3, 1000), (same_ms + 1, 1, 2000)])
+
     def test_25_answer_card_invalid_ease(self):
          with self.client as c:
             self._login_user("testuser", "password123")
@@ -360,6 +492,66 @@ class TestFlaskApi(unittest.TestCase):
             response = self._answer_card(c, ease=3)
             self.assertEqual(response.status_code, 400) # Missing card info
 
+    def test_26a_answer_batch(self):
+         with self.client as c:
+            self._login_user("testuser", "password123")
+            add_resp = c.post('/add_cards', json={'cards': [
+                {'front': 'Batch Q1', 'back': 'Batch A1'},
+                {'front': 'Batch Q2', 'back': 'Batch A2'},
+            ]})
+            self.assertEqual(add_resp.status_code, 201)
+            card1, card2 = [card["card_id"] for card in json.loads(add_resp.data)["cards"]]
+
+            # An unknown card rejects the whole batch
+            response = c.post('/answer_batch', json={'answers': [
+                {'cardId': card1, 'ease': 3, 'timeTaken': 1000},
+                {'cardId': 1, 'ease': 3, 'timeTaken': 1000},
+            ]})
+            self.assertEqual(response.status_code, 404)
+            response = c.post('/answer_batch', json={'answers': [{'cardId': card1, 'ease': 5}]})
+            self.assertEqual(response.status_code, 400)
+            for time_taken in ("1000", -1, [1], True):
+                response = c.post('/answer_batch', json={'answers': [{'cardId': card1, 'ease': 3, 'timeTaken': time_taken}]})
+                self.assertEqual(response.status_code, 400)
+
+            response = c.post('/answer_batch', json={'answers': [
+                {'cardId': card1, 'ease': 1, 'timeTaken': 1000},
+                {'cardId': card2, 'ease': 4, 'timeTaken': 2000},
+                {'cardId': card1, 'ease': 3, 'timeTaken': 3000},
+            ]})
+            self.assertEqual(response.status_code, 200)
+
+            conn = sqlite3.connect(self._get_test_user_db_path(self.test_user_id))
+            revlog = conn.execute("SELECT cid, ease, time FROM revlog ORDER BY id").fetchall()
+            reps = dict(conn.execute("SELECT id, reps FROM cards WHERE id IN (?, ?)", (card1, card2)).fetchall())
+            conn.close()
+            self.assertEqual(revlog, [(card1, 1, 1000), (card2, 4, 2000), (card1, 3, 3000)])
+            self.assertEqual(reps, {card1: 2, card2: 1})
+
+    def test_26b_answer_batch_after_buffered_answer(self):
+         import app as app_module
+         from unittest import mock
+         with self.client as c:
+            self._login_user("testuser", "password123")
+            c.put('/decks/current', json={'deckId': 2}) # The sample cards
+            self._get_next_card(c)
+            fixed_ms = 4102444800123
+            with mock.patch.object(app_module, 'clock_ms', return_value=fixed_ms):
+                self.assertEqual(self._answer_card(c, ease=3).status_code, 200)
+                card_id = json.loads(self._get_next_card(c).data)["cardId"]
+                # Same millisecond as the buffered /answer row
+                response = c.post('/answer_batch', json={'answers': [
+                    {'cardId': card_id, 'ease': 3, 'timeTaken': 1000},
+                    {'cardId': card_id, 'ease': 3, 'timeTaken': 2000},
+                ]})
+            self.assertEqual(response.status_code, 200)
+            app_module.flush_revlog(self.test_user_id)
+
+            conn = sqlite3.connect(self._get_test_user_db_path(self.test_user_id))
+            ids = [row[0] for row in conn.execute("SELECT id FROM revlog ORDER BY id")]
+            conn.close()
+            self.assertEqual(ids, [fixed_ms, fixed_ms + 1, fixed_ms + 2])
+
     # GET /decks/<int:deck_id>/stats
     def test_27_get_stats_success(self):
         with self.client as c:
@@ -376,6 +568,21 @@ class TestFlaskApi(unittest.TestCase):
             self.assertGreaterEqual(data["total"], 1) # Should have at least the card we added
             self.assertGreaterEqual(data["counts"]["New"], 1) # Should be counted as new
 
+    def test_27a_get_stats_buckets(self):
+        import app as app_module
+        with app_module.get_user_db_conn(self.test_user_id) as conn:
+            ids = [r[0] for r in conn.execute("SELECT id FROM cards WHERE did = 2 ORDER BY id LIMIT 6")]
+            conn.executemany("UPDATE cards SET queue = ?, ivl = ? WHERE id = ?",
+                             [(2, 30, ids[0]), (2, 5, ids[1]), (1, 0, ids[2]), (3, 0, ids[3]),
+                              (-1, 0, ids[4]), (-3, 0, ids[5])])
+            total = conn.execute("SELECT COUNT(*) FROM cards WHERE did = 2").fetchone()[0]
+        with self.client as c:
+            self._login_user("testuser", "password123")
+            data = json.loads(c.get('/decks/2/stats').data)
+        self.assertEqual(data["total"], total)
+        self.assertEqual(data["counts"], {"New": total - 6, "Learning": 1, "Relearning": 1, "Young": 1,
+                                          "Mature": 1, "Suspended": 1, "Buried": 1})
+
     def test_28_get_stats_invalid_deck_id(self):
         with self.client as c:
             self._login_user("testuser", "password123")
@@ -400,6 +607,13 @@ class TestFlaskApi(unittest.TestCase):
             # Remove double quote from assertion string
             self.assertIn('.apkg', response.headers['Content-Disposition']) 
 
+            # The APKG is streamed from an in-memory copy of the collection
+            import io
+            import zipfile
+            with zipfile.ZipFile(io.BytesIO(response.data)) as zf:
+                self.assertEqual(sorted(zf.namelist()), ['collection.anki2', 'media'])
+            response.close()
+
     def test_31_export_unauthorized(self):
         response = self.client.get('/export')
         self.assertEqual(response.status_code, 401)
@@ -424,7 +638,23 @@ class TestFlaskApi(unittest.TestCase):
             self.assertIn("message", data)
             self.assertIn("card_id", data)
             self.assertIn("note_id", data)
-            
+
+    def test_31a1_add_card_without_sqlite_json(self):
+        import app as app_module
+        from unittest import mock
+        with self.client as c:
+            self._login_user("testuser", "password123")
+            with mock.patch.object(app_module, 'SQLITE_HAS_JSON', False):
+                response = c.post('/add_card', json={"front": "Fallback Front", "back": "Fallback Back"})
+            self.assertEqual(response.status_code, 201)
+            note_id = json.loads(response.data)["note_id"]
+
+            conn = sqlite3.connect(self._get_test_user_db_path(self.test_user_id))
+            models_json = conn.execute("SELECT models FROM col").fetchone()[0]
+            mid = conn.execute("SELECT mid FROM notes WHERE id = ?", (note_id,)).fetchone()[0]
+            conn.close()
+            self.assertEqual(str(mid), next(iter(json.loads(models_json))))
+
     def test_31b_add_card_invalid_data(self):
         with self.client as c:
             self._login_user("testuser", "password123")
@@ -451,6 +681,35 @@ class TestFlaskApi(unittest.TestCase):
         })
         self.assertEqual(response.status_code, 401)
 
+    # POST /add_cards
+    def test_31d_add_cards_success(self):
+        with self.client as c:
+            self._login_user("testuser", "password123")
+            response = c.post('/add_cards', json={'cards': [
+                {"front": "Bulk Front 1", "back": "Bulk Back 1"},
+                {"front": "Bulk Front 2", "back": "Bulk Back 2"},
+                {"front": "Bulk Front 3", "back": "Bulk Back 3"}
+            ]})
+            self.assertEqual(response.status_code, 201)
+            data = json.loads(response.data)
+            self.assertEqual(len(data["cards"]), 3)
+            card_ids = [card["card_id"] for card in data["cards"]]
+            self.assertEqual(len(set(card_ids)), 3) # Unique even within the same millisecond
+
+            # Every card is readable with its own content
+            for i, card_id in enumerate(card_ids, start=1):
+                get_resp = c.get(f'/cards/{card_id}')
+                self.assertEqual(get_resp.status_code, 200)
+                self.assertEqual(json.loads(get_resp.data)["front"], f"Bulk Front {i}")
+
+    def test_31e_add_cards_invalid_data(self):
+        with self.client as c:
+            self._login_user("testuser", "password123")
+            response = c.post('/add_cards', json={'cards': []})
+            self.assertEqual(response.status_code, 400)
+            response = c.post('/add_cards', json={'cards': [{"front": "Only Front"}]})
+            self.assertEqual(response.status_code, 400)
+
     # GET /cards/<card_id>
     def test_32_get_card_details_success(self):
         with self.client as c:
@@ -505,6 +764,14 @@ class TestFlaskApi(unittest.TestCase):
             self.assertEqual(get_data["front"], "Updated Front")
             self.assertEqual(get_data["back"], "Updated Back")
 
+            # csum is the SHA-1 based checksum of the new first field
+            import hashlib
+            conn = sqlite3.connect(self._get_test_user_db_path(self.test_user_id))
+            csum = conn.execute("SELECT n.csum FROM notes n JOIN cards c ON c.nid = n.id WHERE c.id = ?",
+                                (card_id,)).fetchone()[0]
+            conn.close()
+            self.assertEqual(csum, int(hashlib.sha1(b"Updated Front").hexdigest(), 16) & 0xFFFFFFFF)
+
     def test_33a_update_card_invalid_data(self):
         with self.client as c:
             self._login_user("testuser", "password123")
@@ -529,6 +796,31 @@ class TestFlaskApi(unittest.TestCase):
             })
             self.assertEqual(response.status_code, 404)
 
+    def test_33c_update_cards_bulk(self):
+        with self.client as c:
+            self._login_user("testuser", "password123")
+            conn = sqlite3.connect(self._get_test_user_db_path(self.test_user_id))
+            card1, card2 = [row[0] for row in conn.execute("SELECT id FROM cards WHERE did = 2 ORDER BY id LIMIT 2")]
+            conn.close()
+
+            # An unknown card rejects the whole batch
+            response = c.put('/cards', json={'cards': [
+                {'cardId': card1, 'front': 'Bulk F1', 'back': 'Bulk B1'},
+                {'cardId': 99999, 'front': 'Bulk F2', 'back': 'Bulk B2'},
+            ]})
+            self.assertEqual(response.status_code, 404)
+            response = c.put('/cards', json={'cards': [{'cardId': card1, 'front': ' ', 'back': 'B'}]})
+            self.assertEqual(response.status_code, 400)
+
+            response = c.put('/cards', json={'cards': [
+                {'cardId': card1, 'front': 'Bulk F1', 'back': 'Bulk B1'},
+                {'cardId': card2, 'front': 'Bulk F2', 'back': 'Bulk B2'},
+            ]})
+            self.assertEqual(response.status_code, 200)
+            for card_id, front, back in ((card1, 'Bulk F1', 'Bulk B1'), (card2, 'Bulk F2', 'Bulk B2')):
+                data = json.loads(c.get(f'/cards/{card_id}').data)
+                self.assertEqual((data["front"], data["back"]), (front, back))
+
     # GET /decks/<deck_id>/cards
     def test_34_get_deck_cards_success(self):
         with self.client as c:
@@ -556,6 +848,12 @@ class TestFlaskApi(unittest.TestCase):
             self.assertIn("page", data["pagination"])
             self.assertIn("perPage", data["pagination"])
             self.assertIn("totalPages", data["pagination"])
+            self.assertEqual(data["pagination"]["total"], 2) # Deck 1 starts empty
+
+            # The counter follows card deletes
+            c.delete(f'/cards/{data["cards"][0]["cardId"]}')
+            data = json.loads(c.get('/decks/1/cards').data)
+            self.assertEqual(data["pagination"]["total"], 1)
             
             # Check card structure
             if len(data["cards"]) > 0:
@@ -574,7 +872,92 @@ class TestFlaskApi(unittest.TestCase):
             data = json.loads(response.data)
             self.assertEqual(data["pagination"]["perPage"], 1)
             self.assertEqual(len(data["cards"]), 1)  # Only one card per page
+
+            # The total matches the sample cards actually in deck #2
+            conn = sqlite3.connect(self._get_test_user_db_path(self.test_user_id))
+            sample_count = conn.execute("SELECT COUNT(*) FROM cards WHERE did = 2").fetchone()[0]
+            conn.close()
+            self.assertEqual(data["pagination"]["total"], sample_count)
+
+    def test_34a1_get_deck_cards_keyset_pagination(self):
+        with self.client as c:
+            self._login_user("testuser", "password123")
+            by_page = json.loads(c.get('/decks/2/cards?perPage=1000').data)["cards"]
+
+            # Following nextCursor walks the same cards, newest first, without gaps
+            seen = []
+            url = '/decks/2/cards?perPage=3'
+            while True:
+                data = json.loads(c.get(url).data)
+                seen.extend(card["cardId"] for card in data["cards"])
+                cursor = data["pagination"]["nextCursor"]
+                if cursor is None:
+                    break
+                url = f'/decks/2/cards?perPage=3&afterId={cursor}'
+            self.assertEqual(seen, [card["cardId"] for card in by_page])
+            self.assertEqual(seen, sorted(seen, reverse=True))
     
+    def test_34a2_get_deck_cards_first_two_fields(self):
+        with self.client as c:
+            self._login_user("testuser", "password123")
+            conn = sqlite3.connect(self._get_test_user_db_path(self.test_user_id))
+            newest, older = conn.execute("SELECT nid FROM cards WHERE did = 2 ORDER BY id DESC LIMIT 2").fetchall()
+            conn.execute("UPDATE notes SET flds = ? WHERE id = ?", ("Front\x1fBack\x1f<img src=x.png>", newest[0]))
+            conn.execute("UPDATE notes SET flds = ? WHERE id = ?", ("No separator", older[0]))
+            conn.commit()
+            conn.close()
+
+            cards = json.loads(c.get('/decks/2/cards?perPage=2').data)["cards"]
+            # Notes without a second field are left out of the listing
+            self.assertEqual([(card["front"], card["back"]) for card in cards], [("Front", "Back")])
+
+    def test_34a3_get_deck_cards_json_matches_fallback(self):
+        import app as app_module
+        from unittest import mock
+        with self.client as c:
+            self._login_user("testuser", "password123")
+            for url in ('/decks/2/cards?perPage=4&page=2', '/decks/2/cards?perPage=4&afterId=9999999999999'):
+                built_by_sqlite = json.loads(c.get(url).data)
+                with mock.patch.object(app_module, 'SQLITE_HAS_JSON', False):
+                    built_in_python = json.loads(c.get(url).data)
+                self.assertEqual(built_by_sqlite, built_in_python)
+                self.assertEqual(len(built_by_sqlite["cards"]), 4)
+
+    def test_34a4_get_deck_cards_etag(self):
+        with self.client as c:
+            self._login_user("testuser", "password123")
+            response = c.get('/decks/2/cards?perPage=2')
+            etag = response.headers["ETag"]
+            response = c.get('/decks/2/cards?perPage=2', headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b"")
+
+            # Another view of the same deck does not match the tag
+            for query in ('page=2&perPage=2', 'perPage=3', 'perPage=2&afterId=1'):
+                response = c.get(f'/decks/2/cards?{query}', headers={"If-None-Match": etag})
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response.headers["ETag"], etag)
+
+            # Editing a card on the page changes the tag at once
+            card_id = json.loads(c.get('/decks/2/cards?perPage=2').data)["cards"][0]["cardId"]
+            c.put(f'/cards/{card_id}', json={"front": "Tagged Front", "back": "Tagged Back"})
+            response = c.get('/decks/2/cards?perPage=2', headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers["ETag"], etag)
+
+            # So does a write to a card of the deck (e.g. an answer) and a rename
+            etag = response.headers["ETag"]
+            import app as app_module
+            with app_module.get_user_db_conn(self.test_user_id) as conn:
+                conn.execute("UPDATE cards SET mod = mod + 1 WHERE id = ?", (card_id,))
+            response = c.get('/decks/2/cards?perPage=2', headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers["ETag"]
+            self.assertEqual(c.put('/decks/2/rename', json={"name": "Tagged Deck"}).status_code, 200)
+            response = c.get('/decks/2/cards?perPage=2', headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data)["deckName"], "Tagged Deck")
+
     def test_34b_get_deck_cards_not_found(self):
         with self.client as c:
             self._login_user("testuser", "password123")
@@ -636,12 +1019,32 @@ class TestFlaskApi(unittest.TestCase):
             data = json.loads(response.data)
             self.assertIn("message", data)
             self.assertIn("deleted successfully", data["message"])
+            self.assertIn("1 cards", data["message"])
+
+            # The card's note went with it
+            conn = sqlite3.connect(self._get_test_user_db_path(self.test_user_id))
+            orphans = conn.execute("SELECT COUNT(*) FROM notes WHERE sfld = ?", ("Card in deleted deck",)).fetchone()[0]
+            conn.close()
+            self.assertEqual(orphans, 0)
             
             # Verify the deck is gone
             decks_resp = c.get('/decks')
             decks = json.loads(decks_resp.data)
             self.assertFalse(any(d["id"] == deck_id for d in decks))
     
+    def test_36c_delete_empty_deck(self):
+        with self.client as c:
+            self._login_user("testuser", "password123")
+            self._add_card(c, "Kept Front", "Kept Back") # Goes to the default deck
+            deck_id = json.loads(self._create_deck(c, "Empty Deck").data)["id"]
+            response = c.delete(f'/decks/{deck_id}')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("0 cards", json.loads(response.data)["message"])
+            decks = json.loads(c.get('/decks').data)
+            self.assertNotIn(deck_id, [d["id"] for d in decks])
+            # The default deck and its cards are untouched
+            self.assertEqual(json.loads(c.get('/decks/1/cards').data)["pagination"]["total"], 1)
+
     def test_36a_delete_deck_not_found(self):
         with self.client as c:
             self._login_user("testuser", "password123")
@@ -693,7 +1096,33 @@ class TestFlaskApi(unittest.TestCase):
             # Try to rename the second deck to the same name as the first
             response = c.put(f'/decks/{deck_id2}/rename', json={"name": "Original Deck"})
             self.assertEqual(response.status_code, 409)  # Conflict
+
+            # The comparison is case insensitive...
+            response = c.put(f'/decks/{deck_id2}/rename', json={"name": "original DECK"})
+            self.assertEqual(response.status_code, 409)
+
+            # ...but a deck may change the case of its own name
+            response = c.put(f'/decks/{deck_id1}/rename', json={"name": "ORIGINAL DECK"})
+            self.assertEqual(response.status_code, 200)
     
+    def test_37e_rename_deck_uses_one_clock_reading(self):
+        import app as app_module
+        from unittest import mock
+        with self.client as c:
+            self._login_user("testuser", "password123")
+            deck_id = json.loads(self._create_deck(c, "Clocked Deck").data)["id"]
+
+            fixed_ms = 4102444800123  # 2100-01-01, well past any existing mod
+            with mock.patch.object(app_module, 'clock_ms', return_value=fixed_ms):
+                response = c.put(f'/decks/{deck_id}/rename', json={"name": "Clocked Again"})
+            self.assertEqual(response.status_code, 200)
+
+            conn = sqlite3.connect(self._get_test_user_db_path(self.test_user_id))
+            decks_json, col_mod = conn.execute("SELECT decks, mod FROM col").fetchone()
+            conn.close()
+            self.assertEqual(json.loads(decks_json)[str(deck_id)]["mod"], fixed_ms // 1000)
+            self.assertEqual(col_mod, fixed_ms)
+
     def test_37b_rename_deck_empty_name(self):
         with self.client as c:
             self._login_user("testuser", "password123")
@@ -717,6 +1146,207 @@ class TestFlaskApi(unittest.TestCase):
         response = self.client.put('/decks/1/rename', json={"name": "New Name"})
         self.assertEqual(response.status_code, 401)
 
+    def test_37f_json_provider_round_trip(self):
+        import app as app_module
+        with app.app_context():
+            body = app.json.dumps({"b": 1, 2: "two", "a": [1.5, None]})
+        self.assertEqual(json.loads(body), {"a": [1.5, None], "b": 1, "2": "two"})
+        if app_module.orjson is not None:
+            self.assertIsInstance(app.json, app_module.OrjsonProvider)
+        # Malformed bodies are still rejected as a client error
+        with self.client as c:
+            self._login_user("testuser", "password123")
+            response = c.post('/decks', data="{not json", content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+    # User DB connection pool
+    def test_38_user_db_pool_reuses_connection(self):
+        import app as app_module
+        with app_module.get_user_db_conn(self.test_user_id) as conn:
+            first_conn = conn
+            conn.execute("BEGIN")
+            conn.execute("UPDATE col SET mod = mod + 1")
+            # Leaving the block with an open transaction rolls it back
+
+        with app_module.get_user_db_conn(self.test_user_id) as conn:
+            self.assertIs(conn, first_conn)
+            self.assertFalse(conn.in_transaction)
+
+        # Recreating the user's DB (register) drops the pooled connections
+        app_module.close_user_db_pool(self.test_user_id)
+        with app_module.get_user_db_conn(self.test_user_id) as conn:
+            self.assertIsNot(conn, first_conn)
+
+
+    def test_38c_missing_user_db_is_404(self):
+        import app as app_module
+        app_module.close_user_db_pool(self.test_user_id)
+        os.remove(self._get_test_user_db_path(self.test_user_id))
+        with self.client as c:
+            self._login_user("testuser", "password123")
+            response = c.get('/decks/1/cards')
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(json.loads(response.data)["error"], "User database not found")
+            response = c.get('/export')
+            self.assertEqual(response.status_code, 404)
+            # The pool must not have created an empty file
+            self.assertFalse(os.path.exists(self._get_test_user_db_path(self.test_user_id)))
+
+    def test_38e_pool_restores_card_indexes(self):
+        import app as app_module
+        db_path = self._get_test_user_db_path(self.test_user_id)
+        conn = sqlite3.connect(db_path)
+        conn.execute("DROP INDEX ix_cards_nid")
+        conn.execute("DROP INDEX ix_cards_sched")
+        conn.commit()
+        conn.close()
+        app_module.close_user_db_pool(self.test_user_id)
+
+        with app_module.get_user_db_conn(self.test_user_id) as conn:
+            plan = " ".join(row[3] for row in conn.execute(
+                "EXPLAIN QUERY PLAN SELECT 1 FROM cards WHERE nid = ? LIMIT 1", (1,)))
+            self.assertIn("ix_cards_nid", plan)
+            plan = " ".join(row[3] for row in conn.execute(
+                "EXPLAIN QUERY PLAN DELETE FROM cards WHERE did = ?", (1,)))
+            self.assertIn("INDEX ix_cards_", plan)
+            indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            self.assertTrue({"ix_cards_sched", "ix_cards_deck_id"} <= indexes)
+
+    def test_38g_learning_card_is_earliest_across_queues(self):
+        import app as app_module
+        with app_module.get_user_db_conn(self.test_user_id) as conn:
+            ids = [r[0] for r in conn.execute("SELECT id FROM cards WHERE did = 2 ORDER BY id LIMIT 3")]
+            conn.executemany("UPDATE cards SET queue = ?, due = ? WHERE id = ?",
+                             [(1, 500, ids[0]), (3, 300, ids[1]), (1, 100, ids[2])])
+            pick = lambda now: conn.execute(app_module.SQL_SELECT_DUE_LEARNING_CARD, (2, now)).fetchone()
+            self.assertEqual(pick(1000)[0], ids[2])
+            self.assertIsNone(pick(50))
+            conn.execute("UPDATE cards SET due = 600 WHERE id = ?", (ids[2],))
+            self.assertEqual(pick(1000)[0], ids[1]) # Day-learning queue wins when earlier
+            conn.rollback()
+
+    def test_38a_decks_cache_follows_decks_writes(self):
+        import app as app_module
+        with app_module.get_user_db_conn(self.test_user_id) as conn:
+            decks = app_module.load_decks(conn, self.test_user_id)
+            self.assertIs(app_module.load_decks(conn, self.test_user_id), decks) # Served from cache
+
+            # Card writes move col.mod but leave the cached decks valid
+            conn.execute("UPDATE col SET mod = mod + 1000")
+            self.assertIs(app_module.load_decks(conn, self.test_user_id), decks)
+
+            # Writing col.decks behind the cache's back is noticed, even without a col.mod bump
+            conn.execute("UPDATE col SET decks = ?", (json.dumps({"1": {"name": "Other"}}),))
+            self.assertEqual(app_module.load_decks(conn, self.test_user_id), {"1": {"name": "Other"}})
+
+    def test_38f_col_conf_cache_follows_current_deck(self):
+        import app as app_module
+        with self.client as c:
+            self._login_user("testuser", "password123")
+            with app_module.get_user_db_conn(self.test_user_id) as conn:
+                crt, current_deck_id = app_module.load_col_conf(conn, self.test_user_id)
+                self.assertEqual(current_deck_id, 1)
+                self.assertEqual(conn.execute("SELECT crt FROM col").fetchone()[0], crt)
+
+            deck_id = json.loads(self._create_deck(c, "Conf Deck").data)["id"]
+            self.assertEqual(c.put('/decks/current', json={'deckId': deck_id}).status_code, 200)
+            with app_module.get_user_db_conn(self.test_user_id) as conn:
+                self.assertEqual(app_module.load_col_conf(conn, self.test_user_id), (crt, int(deck_id)))
+                # Card writes move col.mod but leave the cached config valid
+                entry = app_module._col_conf_entry(conn, self.test_user_id)
+                conn.execute("UPDATE col SET mod = mod + 1000")
+                self.assertIs(app_module._col_conf_entry(conn, self.test_user_id), entry)
+
+                # Another process changing conf is noticed, even without a col.mod bump
+                conn.execute("UPDATE col SET conf = json_set(conf, '$.curDeck', 1)")
+                self.assertEqual(app_module.load_col_conf(conn, self.test_user_id), (crt, 1))
+
+                # The deck options come from the same cache entry
+                sched_crt, dconf = app_module.load_sched_conf(conn, self.test_user_id)
+                self.assertEqual(sched_crt, crt)
+                self.assertEqual(dconf, json.loads(conn.execute("SELECT dconf FROM col").fetchone()[0]))
+                self.assertIs(app_module.load_sched_conf(conn, self.test_user_id)[1], dconf)
+
+    def test_38d_decks_snapshot_skips_json_on_cache_miss(self):
+        import app as app_module
+        import marshal
+        with self.client as c:
+            self._login_user("testuser", "password123")
+            deck_id = json.loads(self._create_deck(c, "Snapshot Deck").data)["id"]
+
+        with app_module.get_user_db_conn(self.test_user_id) as conn:
+            decks_json = conn.execute("SELECT decks FROM col").fetchone()[0]
+            data = conn.execute("SELECT data FROM decks_bin").fetchone()[0]
+            self.assertEqual(marshal.loads(data), json.loads(decks_json))
+
+            # Card writes (col.mod only) keep the snapshot usable
+            conn.execute("UPDATE col SET mod = mod + 1000")
+            self.assertEqual(conn.execute("SELECT data FROM decks_bin").fetchone()[0], data)
+
+            # Another worker's cache miss reads the snapshot
+            app_module.discard_decks(self.test_user_id)
+            decks = app_module.load_decks(conn, self.test_user_id)
+            self.assertEqual(decks[str(deck_id)]["name"], "Snapshot Deck")
+
+            # A stale snapshot (col.decks written by someone else) is ignored
+            conn.execute("UPDATE col SET decks = ?", (json.dumps({"1": {"name": "Other"}}),))
+            self.assertIsNone(conn.execute("SELECT data FROM decks_bin").fetchone()[0])
+            app_module.discard_decks(self.test_user_id)
+            self.assertEqual(app_module.load_decks(conn, self.test_user_id), {"1": {"name": "Other"}})
+
+
+    def test_38b_export_is_plain_anki_collection(self):
+        import app as app_module
+        import io
+        import zipfile
+        # A collection created before decks_index existed
+        db_path = self._get_test_user_db_path(self.test_user_id)
+        conn = sqlite3.connect(db_path)
+        conn.execute("DROP TABLE decks_index")
+        conn.commit()
+        conn.close()
+        app_module.close_user_db_pool(self.test_user_id)
+
+        with self.client as c:
+            self._login_user("testuser", "password123")
+            response = self._create_deck(c, "myfirstdeck") # Clashes with the default deck
+            self.assertEqual(response.status_code, 409)
+
+            response = c.get('/export')
+            self.assertEqual(response.status_code, 200)
+            with zipfile.ZipFile(io.BytesIO(response.data)) as zf:
+                self.assertEqual(json.loads(zf.read('media')), {})
+                exported = os.path.join(self.user_db_dir, 'exported.anki2')
+                with open(exported, 'wb') as f:
+                    f.write(zf.read('collection.anki2'))
+            conn = sqlite3.connect(exported)
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+            conn.close()
+            self.assertEqual(journal_mode, 'delete') # User DBs run in WAL; the export must not
+            self.assertIn('cards', tables)
+            self.assertNotIn('decks_index', tables)
+            self.assertNotIn('decks_bin', tables)
+            self.assertIn('ix_cards_sched', indexes)
+            self.assertNotIn('ix_cards_deck_id', indexes)
+
+
+    def test_39_scheduler_rules(self):
+        from scheduler import schedule
+        deck_conf = {"new": {"delays": [1, 10]}, "lapse": {"delays": [10]},
+                     "rev": {"ivlFct": 1, "hardFactor": 1.2, "ease4": 1.3}}
+        card = {"type": 2, "queue": 2, "due": 100, "ivl": 10, "factor": 2500, "left": 0, "lapses": 0}
+        good = schedule(card, 3, 1000, 100, deck_conf, deck_conf["rev"])
+        self.assertEqual((good.queue, good.ivl, good.due, good.factor, good.log_type), (2, 11, 111, 2500, 1))
+        hard = schedule(card, 2, 1000, 100, deck_conf, deck_conf["rev"])
+        self.assertEqual((hard.ivl, hard.factor), (12, 2350))
+        lapse = schedule(card, 1, 1000, 100, deck_conf, deck_conf["lapse"])
+        self.assertEqual((lapse.queue, lapse.type, lapse.due, lapse.lapses, lapse.log_type), (1, 3, 1600, 1, 2))
+        new = dict(card, type=0, queue=0, ivl=0)
+        self.assertEqual(schedule(new, 3, 1000, 100, deck_conf, deck_conf["new"]).due, 1600)
+        suspended = dict(card, queue=-1)
+        self.assertEqual(schedule(suspended, 3, 1000, 100, deck_conf, deck_conf["rev"]).due, 100)
 
 if __name__ == '__main__':
     unittest.main()